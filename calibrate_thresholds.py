@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Script to calibrate per-branch match thresholds from logged match distances
+
+The runner-up distance of every logged search is a distance to a different
+person, so it samples the impostor distribution of that branch's traffic.
+Each branch threshold is set so that at most --far of those impostor
+distances would be accepted, capped at the global tolerance.
+"""
+
+import sys
+import os
+import json
+import argparse
+from collections import defaultdict
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models.match_log import match_log_files
+
+load_dotenv()
+
+
+def load_runner_up_distances(log_paths):
+    """Group runner-up distances by branch"""
+    distances = defaultdict(list)
+    for log_path in log_paths:
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('runner_up') is not None:
+                    distances[record.get('branch_id', 'UNKNOWN')].append(float(record['runner_up']))
+    return distances
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate per-branch face match thresholds")
+    parser.add_argument('--log', default=os.getenv('FACE_MATCH_LOG', 'logs/match_distances.jsonl'),
+                        help="Match distance log written by the server (its rotated files are read too)")
+    parser.add_argument('--output', default=os.getenv('FACE_BRANCH_THRESHOLDS_FILE', 'branch_thresholds.json'),
+                        help="Where to write the branch thresholds")
+    parser.add_argument('--far', type=float, default=0.01,
+                        help="Target false accept rate against impostor distances (default: 0.01)")
+    parser.add_argument('--min-samples', type=int, default=200,
+                        help="Branches with fewer logged searches keep the global tolerance")
+    parser.add_argument('--floor', type=float, default=0.35,
+                        help="Lowest threshold ever written")
+    args = parser.parse_args()
+
+    tolerance = float(os.getenv('FACE_RECOGNITION_TOLERANCE', 0.6))
+
+    print("=" * 60)
+    print("Match Threshold Calibration")
+    print("=" * 60)
+
+    log_paths = match_log_files(args.log)
+    if not log_paths:
+        print(f"\n✗ Match log not found: {args.log}")
+        sys.exit(1)
+
+    distances_by_branch = load_runner_up_distances(log_paths)
+    thresholds = {}
+
+    print(f"\n{'Branch':<20} {'Samples':>8} {'Threshold':>10}")
+    for branch_id, distances in sorted(distances_by_branch.items()):
+        if len(distances) < args.min_samples:
+            print(f"{branch_id:<20} {len(distances):>8} {'(global)':>10}")
+            continue
+
+        threshold = float(np.quantile(np.asarray(distances), args.far))
+        threshold = round(min(tolerance, max(args.floor, threshold)), 4)
+        thresholds[branch_id] = threshold
+        print(f"{branch_id:<20} {len(distances):>8} {threshold:>10.4f}")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(thresholds, f, indent=2, sort_keys=True)
+
+    print(f"\n✓ Wrote {len(thresholds)} branch thresholds to {args.output}")
+    print("  Restart the server to apply them")
+
+
+if __name__ == "__main__":
+    main()
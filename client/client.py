@@ -7,18 +7,30 @@ import socket
 import json
 import base64
 import os
-from typing import Dict, Any, Optional
+import threading
+import time
+from typing import Dict, Any, Optional, Tuple, Iterable, Iterator
 from PIL import Image
 import io
 
+# Frame header flag (high bit of the length) for MessagePack payloads
+FRAME_MSGPACK_FLAG = 0x80000000
+
 
 class FaceRecognitionClient:
     """Client for communicating with Face Recognition Server"""
     
-    def __init__(self, host: str = 'localhost', port: int = 8888):
+    def __init__(self, host: str = 'localhost', port: int = 8888, busy_retries: int = 2, binary: bool = False):
         self.host = host
         self.port = port
         self.socket = None
+        # How many times to retry a request the server shed with BUSY
+        self.busy_retries = busy_retries
+        # Send and receive MessagePack frames instead of JSON (needs the msgpack package)
+        self.binary = binary
+        if binary:
+            import msgpack
+            self._msgpack = msgpack
     
     def connect(self):
         """Connect to server"""
@@ -48,29 +60,85 @@ class FaceRecognitionClient:
         except Exception as e:
             raise Exception(f"Failed to read image: {str(e)}")
     
-    def _send_request(self, message: Dict[str, Any]) -> bytes:
-        """Send request and receive response"""
-        if not self.socket:
-            raise Exception("Not connected to server")
-        
-        # Serialize message
-        message_json = json.dumps(message)
-        message_bytes = message_json.encode('utf-8')
+    def _crop_image_to_base64(self, image_path: str, face_box: Tuple[int, int, int, int], padding: float = 0.3) -> str:
+        """
+        Crop image to a padded face box and return it as base64 JPEG
+        Args:
+            image_path: Path to image file
+            face_box: (top, right, bottom, left) face location in the image
+            padding: Fraction of the box size added on each side
+        """
+        try:
+            top, right, bottom, left = face_box
+            pad_y = int((bottom - top) * padding)
+            pad_x = int((right - left) * padding)
+            
+            with Image.open(image_path) as image:
+                width, height = image.size
+                crop = image.crop((
+                    max(0, left - pad_x),
+                    max(0, top - pad_y),
+                    min(width, right + pad_x),
+                    min(height, bottom + pad_y)
+                ))
+                if crop.mode != 'RGB':
+                    crop = crop.convert('RGB')
+                
+                buffer = io.BytesIO()
+                crop.save(buffer, format='JPEG', quality=90)
+            
+            return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        except Exception as e:
+            raise Exception(f"Failed to crop image: {str(e)}")
+    
+    def _image_payload(self, image_path: str, face_box: Optional[Tuple[int, int, int, int]], crop_face: bool) -> Dict[str, Any]:
+        """Build the image fields of a request, optionally with a face hint or crop"""
+        if face_box is not None and crop_face:
+            return {
+                'image_data': self._crop_image_to_base64(image_path, face_box),
+                'face_crop': True
+            }
         
-        # Send message length first (4 bytes, big-endian)
+        payload = {'image_data': self._image_to_base64(image_path)}
+        if face_box is not None:
+            payload['face_box'] = list(face_box)
+        return payload
+    
+    def _encode(self, message: Dict[str, Any]) -> bytes:
+        """Serialize a message in the client's wire encoding"""
+        if self.binary:
+            return self._msgpack.packb(message, use_bin_type=True)
+        return json.dumps(message).encode('utf-8')
+    
+    def _send_frame(self, message_bytes: bytes):
+        """Send one length-prefixed frame"""
+        # Send message length first (4 bytes, big-endian; high bit flags MessagePack)
         message_length = len(message_bytes)
+        if self.binary and message_length > 0:
+            message_length |= FRAME_MSGPACK_FLAG
         length_bytes = message_length.to_bytes(4, byteorder='big')
         self.socket.sendall(length_bytes)
         
         # Send message data
         self.socket.sendall(message_bytes)
-        
+    
+    def _receive_message(self) -> Dict[str, Any]:
+        """Receive one frame and decode it as JSON or MessagePack per its header flag"""
+        response_bytes, is_msgpack = self._receive_frame()
+        if is_msgpack:
+            return self._msgpack.unpackb(response_bytes, raw=False, strict_map_key=False)
+        return json.loads(response_bytes.decode('utf-8'))
+    
+    def _receive_frame(self) -> Tuple[bytes, bool]:
+        """Receive one length-prefixed frame; returns (payload, is_msgpack)"""
         # Receive response length first
         length_data = self.socket.recv(4)
         if not length_data or len(length_data) != 4:
             raise Exception("Failed to receive response length")
         
         response_length = int.from_bytes(length_data, byteorder='big')
+        is_msgpack = bool(response_length & FRAME_MSGPACK_FLAG)
+        response_length &= ~FRAME_MSGPACK_FLAG
         
         # Receive response data
         response_chunks = []
@@ -85,33 +153,68 @@ class FaceRecognitionClient:
             received += len(chunk)
         
         response_bytes = b''.join(response_chunks)
-        return response_bytes
+        return response_bytes, is_msgpack
+    
+    def _send_request(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Send request and receive the decoded response"""
+        if not self.socket:
+            raise Exception("Not connected to server")
+        
+        # Serialize message
+        self._send_frame(self._encode(message))
+        
+        return self._receive_message()
+    
+    def _request_with_retry(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Send a request and decode the response, retrying when the server is BUSY
+        The server closes the connection after each response, so every retry
+        reconnects after waiting the server's retry_after_ms hint.
+        """
+        for attempt in range(self.busy_retries + 1):
+            response = self._send_request(message)
+            if response.get('error_code') != 'BUSY' or attempt == self.busy_retries:
+                return response
+            
+            retry_after = response.get('retry_after_ms', 500) / 1000.0
+            print(f"⚠ Server busy, retrying in {retry_after:.1f}s ({attempt + 1}/{self.busy_retries})")
+            time.sleep(retry_after)
+            self.disconnect()
+            if not self.connect():
+                return response
+        
+        return response
     
-    def recognize_face(self, image_path: str, branch_id: str = "BRANCH_001", request_id: Optional[str] = None) -> Dict[str, Any]:
+    def recognize_face(
+        self,
+        image_path: str,
+        branch_id: str = "BRANCH_001",
+        request_id: Optional[str] = None,
+        face_box: Optional[Tuple[int, int, int, int]] = None,
+        crop_face: bool = False
+    ) -> Dict[str, Any]:
         """
         Send RECOGNIZE request
         Args:
             image_path: Path to image file
             branch_id: Branch identifier
             request_id: Optional request ID
+            face_box: Optional (top, right, bottom, left) face location hint
+            crop_face: If True, upload only the padded face crop instead of the full frame
         Returns:
             Response dictionary
         """
         try:
-            # Convert image to base64
-            image_base64 = self._image_to_base64(image_path)
-            
             # Create request message
             message = {
                 'request_type': 'RECOGNIZE',
-                'image_data': image_base64,
                 'branch_id': branch_id,
                 'request_id': request_id or f"req_{os.urandom(4).hex()}"
             }
+            message.update(self._image_payload(image_path, face_box, crop_face))
             
             # Send request and get response
-            response_bytes = self._send_request(message)
-            response = json.loads(response_bytes.decode('utf-8'))
+            response = self._request_with_retry(message)
             
             return response
             
@@ -122,13 +225,125 @@ class FaceRecognitionClient:
                 'error_message': str(e)
             }
     
+    def recognize_faces(self, image_path: str, branch_id: str = "BRANCH_001", request_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Send RECOGNIZE_MULTI request (recognize every face in the image)
+        Args:
+            image_path: Path to image file
+            branch_id: Branch identifier
+            request_id: Optional request ID
+        Returns:
+            Response dictionary with a 'faces' list
+        """
+        try:
+            message = {
+                'request_type': 'RECOGNIZE_MULTI',
+                'image_data': self._image_to_base64(image_path),
+                'branch_id': branch_id,
+                'request_id': request_id or f"req_{os.urandom(4).hex()}"
+            }
+            
+            return self._request_with_retry(message)
+            
+        except Exception as e:
+            return {
+                'status': 'error',
+                'error_code': 'CLIENT_ERROR',
+                'error_message': str(e)
+            }
+    
+    def recognize_batch(self, image_paths: Iterable[str], branch_id: str = "BRANCH_001") -> Iterator[Dict[str, Any]]:
+        """
+        Send RECOGNIZE_BATCH request, streaming one frame per image
+        Images are read and sent from a background thread while results are
+        received, so neither side buffers the whole batch.
+        Args:
+            image_paths: Paths to image files
+            branch_id: Branch identifier
+        Yields:
+            One result dict per image (with 'index'), then a summary dict
+            with 'batch_complete': True
+        """
+        if not self.socket:
+            raise Exception("Not connected to server")
+        
+        self._send_frame(self._encode({
+            'request_type': 'RECOGNIZE_BATCH',
+            'stream': True,
+            'branch_id': branch_id,
+            'request_id': f"batch_{os.urandom(4).hex()}"
+        }))
+        
+        def send_images():
+            try:
+                for image_path in image_paths:
+                    try:
+                        item = {'image_data': self._image_to_base64(image_path)}
+                    except Exception as e:
+                        # Unreadable file: send an empty item so result indexes stay aligned
+                        print(f"✗ {str(e)}")
+                        item = {}
+                    self._send_frame(self._encode(item))
+                # Zero-length frame ends the stream
+                self._send_frame(b'')
+            except Exception as e:
+                print(f"✗ Failed to send batch: {str(e)}")
+        
+        sender = threading.Thread(target=send_images, daemon=True)
+        sender.start()
+        
+        try:
+            while True:
+                result = self._receive_message()
+                yield result
+                if result.get('batch_complete') or 'index' not in result:
+                    break
+        finally:
+            sender.join(timeout=1.0)
+    
+    def recognize_stream(self, frames: Iterable[Any], branch_id: str = "BRANCH_001") -> Iterator[Dict[str, Any]]:
+        """
+        Open a RECOGNIZE_STREAM session and send video frames one by one
+        Args:
+            frames: Image file paths or encoded image bytes (e.g. JPEG frames)
+            branch_id: Branch identifier
+        Yields:
+            One result per frame with 'events' and 'tracks', then a session
+            summary with 'session_complete': True
+        """
+        if not self.socket:
+            raise Exception("Not connected to server")
+        
+        opening = self._send_request({
+            'request_type': 'RECOGNIZE_STREAM',
+            'branch_id': branch_id,
+            'request_id': f"stream_{os.urandom(4).hex()}"
+        })
+        if opening.get('status') != 'success':
+            yield opening
+            return
+        
+        for frame_id, frame in enumerate(frames):
+            if isinstance(frame, (bytes, bytearray)):
+                image_base64 = base64.b64encode(frame).decode('utf-8')
+            else:
+                image_base64 = self._image_to_base64(frame)
+            
+            yield self._send_request({'image_data': image_base64, 'frame_id': frame_id})
+        
+        # Zero-length frame ends the session
+        self._send_frame(b'')
+        yield self._receive_message()
+    
     def register_customer(
         self,
         image_path: str,
         customer_name: str,
         order_details: str,
         branch_id: str = "BRANCH_001",
-        request_id: Optional[str] = None
+        request_id: Optional[str] = None,
+        face_box: Optional[Tuple[int, int, int, int]] = None,
+        crop_face: bool = False
     ) -> Dict[str, Any]:
         """
         Send REGISTER request
@@ -138,26 +353,24 @@ class FaceRecognitionClient:
             order_details: Order details
             branch_id: Branch identifier
             request_id: Optional request ID
+            face_box: Optional (top, right, bottom, left) face location hint
+            crop_face: If True, upload only the padded face crop instead of the full frame
         Returns:
             Response dictionary
         """
         try:
-            # Convert image to base64
-            image_base64 = self._image_to_base64(image_path)
-            
             # Create request message
             message = {
                 'request_type': 'REGISTER',
-                'image_data': image_base64,
                 'customer_name': customer_name,
                 'order_details': order_details,
                 'branch_id': branch_id,
                 'request_id': request_id or f"req_{os.urandom(4).hex()}"
             }
+            message.update(self._image_payload(image_path, face_box, crop_face))
             
             # Send request and get response
-            response_bytes = self._send_request(message)
-            response = json.loads(response_bytes.decode('utf-8'))
+            response = self._request_with_retry(message)
             
             return response
             
@@ -169,17 +382,91 @@ class FaceRecognitionClient:
             }
 
 
+    def get_order_history(
+        self,
+        customer_id: int,
+        limit: int = 20,
+        cursor: Optional[str] = None,
+        since: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Send ORDER_HISTORY request (one page, newest first)
+        Args:
+            customer_id: Customer whose orders to list
+            limit: Page size (the server caps it)
+            cursor: 'next_cursor' of the previous page
+            since: 'cursor' of an order already seen; only newer orders are returned
+        Returns:
+            Response dictionary with 'orders' and 'next_cursor'
+        """
+        try:
+            message = {
+                'request_type': 'ORDER_HISTORY',
+                'customer_id': customer_id,
+                'limit': limit,
+                'request_id': f"req_{os.urandom(4).hex()}"
+            }
+            if cursor:
+                message['cursor'] = cursor
+            if since:
+                message['since'] = since
+            
+            return self._request_with_retry(message)
+            
+        except Exception as e:
+            return {
+                'status': 'error',
+                'error_code': 'CLIENT_ERROR',
+                'error_message': str(e)
+            }
+    
+    def delete_customer(self, customer_id: int, admin_token: str) -> Dict[str, Any]:
+        """
+        Send DELETE_CUSTOMER request (erase the customer, their encoding and orders)
+        Args:
+            customer_id: Customer to erase
+            admin_token: The server's ADMIN_TOKEN
+        Returns:
+            Response dictionary with 'erased' counts
+        """
+        try:
+            message = {
+                'request_type': 'DELETE_CUSTOMER',
+                'customer_id': customer_id,
+                'admin_token': admin_token,
+                'request_id': f"req_{os.urandom(4).hex()}"
+            }
+            
+            return self._request_with_retry(message)
+            
+        except Exception as e:
+            return {
+                'status': 'error',
+                'error_code': 'CLIENT_ERROR',
+                'error_message': str(e)
+            }
+
+
 def main():
     """Example usage of the client"""
     import sys
     
+    # --msgpack: use the compact binary encoding instead of JSON
+    binary = '--msgpack' in sys.argv
+    if binary:
+        sys.argv.remove('--msgpack')
+    
     if len(sys.argv) < 2:
-        print("Usage:")
+        print("Usage: python client.py [--msgpack] <command> ...")
         print("  python client.py recognize <image_path>")
+        print("  python client.py recognize-multi <image_path>")
+        print("  python client.py recognize-batch <image_path> [<image_path> ...]")
         print("  python client.py register <image_path> <customer_name> <order_details>")
+        print("  python client.py orders <customer_id> [<cursor>]")
+        print("  python client.py delete <customer_id>   (needs ADMIN_TOKEN in the environment)")
         return
     
-    client = FaceRecognitionClient()
+    client = FaceRecognitionClient(binary=binary)
     
     if not client.connect():
         return
@@ -210,6 +497,43 @@ def main():
                 else:
                     print("\n✗ Customer not recognized")
         
+        elif command == 'recognize-multi':
+            if len(sys.argv) < 3:
+                print("Error: Missing image path")
+                return
+            
+            image_path = sys.argv[2]
+            print(f"\n📸 Recognizing all faces in: {image_path}")
+            
+            response = client.recognize_faces(image_path)
+            print("\n📋 Response:")
+            print(json.dumps(response, indent=2, default=str))
+            
+            if response.get('status') == 'success':
+                for face in response.get('faces', []):
+                    if face.get('recognized'):
+                        print(f"\n✓ {face.get('customer_name')} (ID: {face.get('customer_id')}) at {face.get('face_box')}")
+                    else:
+                        print(f"\n✗ Unknown face at {face.get('face_box')}")
+        
+        elif command == 'recognize-batch':
+            if len(sys.argv) < 3:
+                print("Error: Missing image paths")
+                return
+            
+            image_paths = sys.argv[2:]
+            print(f"\n📸 Recognizing {len(image_paths)} images in one batch")
+            
+            for result in client.recognize_batch(image_paths):
+                if result.get('batch_complete'):
+                    print(f"\n✓ Batch complete: {result.get('processed')} processed, {result.get('recognized_count')} recognized")
+                elif result.get('status') == 'success' and result.get('recognized'):
+                    print(f"✓ [{image_paths[result['index']]}] {result.get('customer_name')} (ID: {result.get('customer_id')})")
+                elif result.get('status') == 'success':
+                    print(f"✗ [{image_paths[result['index']]}] Not recognized")
+                else:
+                    print(f"✗ [{image_paths[result.get('index', 0)]}] {result.get('error_code')}: {result.get('error_message')}")
+        
         elif command == 'register':
             if len(sys.argv) < 5:
                 print("Error: Missing arguments")
@@ -233,6 +557,36 @@ def main():
                 print(f"\n✓ Customer registered successfully!")
                 print(f"  Customer ID: {response.get('customer_id')}")
         
+        elif command == 'orders':
+            if len(sys.argv) < 3:
+                print("Error: Please provide customer ID")
+                return
+            
+            customer_id = int(sys.argv[2])
+            cursor = sys.argv[3] if len(sys.argv) > 3 else None
+            
+            response = client.get_order_history(customer_id, cursor=cursor)
+            if response.get('status') != 'success':
+                print(json.dumps(response, indent=2, default=str))
+                return
+            
+            print(f"\n📋 Orders of customer {customer_id}:")
+            for order in response['orders']:
+                print(f"  {order.get('order_date')}  [{order.get('branch_id')}]  {order.get('order_details')}")
+            if response.get('next_cursor'):
+                print(f"\n→ More: python client.py orders {customer_id} {response['next_cursor']}")
+        
+        elif command == 'delete':
+            if len(sys.argv) < 3:
+                print("Error: Please provide customer ID")
+                return
+            
+            customer_id = int(sys.argv[2])
+            response = client.delete_customer(customer_id, os.getenv('ADMIN_TOKEN', ''))
+            print(json.dumps(response, indent=2, default=str))
+            if response.get('status') == 'success':
+                print(f"\n✓ Customer {customer_id} erased")
+        
         else:
             print(f"Unknown command: {command}")
     
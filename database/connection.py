@@ -4,12 +4,106 @@ Handles database connection and initialization
 """
 
 import os
-from pymongo import MongoClient
+import importlib.util
+import threading
+import time
+from typing import Any, Dict
+from pymongo import MongoClient, ReadPreference, WriteConcern
 from pymongo.errors import ConnectionFailure, OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
 from dotenv import load_dotenv
 
 load_dotenv()
 
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+# Python modules needed by the optional wire compressors
+COMPRESSOR_MODULES = {
+    'zstd': 'zstandard',
+    'snappy': 'snappy',
+}
+
+
+class PoolWaitMonitor(ConnectionPoolListener):
+    """Measures how long threads wait to check a connection out of the pool"""
+    
+    def __init__(self, slow_checkout_ms: float):
+        self.slow_checkout_ms = slow_checkout_ms
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {
+            'checkouts': 0,
+            'checkout_failures': 0,
+            'slow_checkouts': 0,
+            'checked_out': 0,
+            'connections_created': 0,
+            'connections_closed': 0,
+            'pool_clears': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+        }
+    
+    # Check-out events fire on the requesting thread, so the start time is thread-local
+    def connection_check_out_started(self, event):
+        self._local.started = time.monotonic()
+    
+    def connection_checked_out(self, event):
+        wait_ms = (time.monotonic() - getattr(self._local, 'started', time.monotonic())) * 1000.0
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['checked_out'] += 1
+            self._stats['total_wait_ms'] += wait_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+            if wait_ms >= self.slow_checkout_ms:
+                self._stats['slow_checkouts'] += 1
+    
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._stats['checkout_failures'] += 1
+        print(f"⚠ MongoDB connection check-out failed ({event.reason})")
+    
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._stats['checked_out'] -= 1
+    
+    def connection_created(self, event):
+        with self._lock:
+            self._stats['connections_created'] += 1
+    
+    def connection_ready(self, event):
+        pass
+    
+    def connection_closed(self, event):
+        with self._lock:
+            self._stats['connections_closed'] += 1
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        with self._lock:
+            self._stats['pool_clears'] += 1
+    
+    def pool_closed(self, event):
+        pass
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['avg_wait_ms'] = round(stats['total_wait_ms'] / stats['checkouts'], 3) if stats['checkouts'] else 0.0
+        stats['max_wait_ms'] = round(stats['max_wait_ms'], 3)
+        del stats['total_wait_ms']
+        return stats
+
 
 class DatabaseConnection:
     """Singleton class for MongoDB connection"""
@@ -26,7 +120,41 @@ class DatabaseConnection:
     
     def __init__(self):
         # Don't auto-connect on import to avoid errors
-        pass
+        if not hasattr(self, 'pool_monitor'):
+            self.pool_monitor = PoolWaitMonitor(float(os.getenv('MONGODB_SLOW_CHECKOUT_MS', 50)))
+            self.read_preference = READ_PREFERENCES.get(
+                os.getenv('MONGODB_READ_PREFERENCE', 'secondaryPreferred'),
+                ReadPreference.SECONDARY_PREFERRED
+            )
+    
+    def _client_options(self) -> Dict[str, Any]:
+        """Pool, timeout and compression settings shared by every connection mode"""
+        options = {
+            'serverSelectionTimeoutMS': int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+            'connectTimeoutMS': int(os.getenv('MONGODB_CONNECT_TIMEOUT_MS', 5000)),
+            'socketTimeoutMS': int(os.getenv('MONGODB_SOCKET_TIMEOUT_MS', 10000)),
+            'maxPoolSize': int(os.getenv('MONGODB_MAX_POOL_SIZE', 50)),
+            'minPoolSize': int(os.getenv('MONGODB_MIN_POOL_SIZE', 5)),
+            'maxIdleTimeMS': int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', 300000)),
+            # Fail fast instead of queueing forever when the pool is exhausted
+            'waitQueueTimeoutMS': int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', 2000)),
+            'event_listeners': [self.pool_monitor],
+        }
+        
+        # Only offer compressors whose library is installed (zlib is built in)
+        compressors = [
+            name.strip() for name in os.getenv('MONGODB_COMPRESSORS', 'zstd,snappy,zlib').split(',')
+            if name.strip() and (name.strip() not in COMPRESSOR_MODULES or importlib.util.find_spec(COMPRESSOR_MODULES[name.strip()]))
+        ]
+        if compressors:
+            options['compressors'] = ','.join(compressors)
+        
+        # Client-side operation timeout (covers selection, pool wait and the round trip)
+        timeout_ms = int(os.getenv('MONGODB_TIMEOUT_MS', 0))
+        if timeout_ms > 0:
+            options['timeoutMS'] = timeout_ms
+        
+        return options
     
     def connect(self):
         """Establish connection to MongoDB"""
@@ -51,7 +179,7 @@ class DatabaseConnection:
                 
                 self._client = MongoClient(
                     mongodb_url,
-                    serverSelectionTimeoutMS=5000
+                    **self._client_options()
                 )
                 print(f"✓ Connecting to MongoDB using connection string")
             else:
@@ -71,7 +199,7 @@ class DatabaseConnection:
                     connection_string = f"mongodb://{username}:{password}@{host}:{port}/{database_name}?authSource={auth_source}"
                     self._client = MongoClient(
                         connection_string,
-                        serverSelectionTimeoutMS=5000
+                        **self._client_options()
                     )
                     print(f"✓ Connecting to MongoDB with authentication: {host}:{port}/{database_name}")
                 else:
@@ -79,7 +207,7 @@ class DatabaseConnection:
                     self._client = MongoClient(
                         host=host,
                         port=port,
-                        serverSelectionTimeoutMS=5000
+                        **self._client_options()
                     )
                     print(f"✓ Connecting to MongoDB without authentication: {host}:{port}/{database_name}")
             
@@ -96,11 +224,27 @@ class DatabaseConnection:
             
         except ConnectionFailure as e:
             print(f"✗ Failed to connect to MongoDB: {e}")
+            self._discard_client()
             raise
         except Exception as e:
             print(f"✗ Error connecting to MongoDB: {e}")
+            self._discard_client()
             raise
     
+    def _discard_client(self):
+        """
+        Close a client whose first ping failed
+        Edge mode retries connect() while offline; without this every attempt
+        would leak a MongoClient with its monitor threads and pool.
+        """
+        if self._client is not None:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+        self._client = None
+        self._db = None
+    
     def _create_indexes(self):
         """Create indexes for better query performance"""
         try:
@@ -113,6 +257,21 @@ class DatabaseConnection:
                 if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
                     print(f"⚠ Warning creating customer_id index: {e}")
             
+            # Index on home_branch_id for loading one gallery shard
+            try:
+                self._db.customers.create_index("home_branch_id")
+            except OperationFailure as e:
+                if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
+                    print(f"⚠ Warning creating customers.home_branch_id index: {e}")
+            
+            # Edge cache sync: incremental pulls by updated_at, idempotent pushes by edge_ref
+            try:
+                self._db.customers.create_index("updated_at")
+                self._db.customers.create_index("edge_ref", unique=True, sparse=True)
+            except OperationFailure as e:
+                if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
+                    print(f"⚠ Warning creating customers edge sync indexes: {e}")
+            
             # Index on customer_id in orders for fast order queries
             try:
                 self._db.orders.create_index("customer_id")
@@ -120,13 +279,29 @@ class DatabaseConnection:
                 if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
                     print(f"⚠ Warning creating orders.customer_id index: {e}")
             
-            # Index on order_date for sorting latest orders
+            # Latest orders and order pages: (order_date, _id) is the page sort and
+            # cursor, so pages are read from the index without an in-memory sort
             try:
-                self._db.orders.create_index([("customer_id", 1), ("order_date", -1)])
+                self._db.orders.create_index([("customer_id", 1), ("order_date", -1), ("_id", -1)])
             except OperationFailure as e:
                 if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
                     print(f"⚠ Warning creating orders compound index: {e}")
             
+            # order_ids come from the counters collection; the index seeds the
+            # counter from the highest id and rejects a duplicate outright
+            try:
+                self._db.orders.create_index("order_id", unique=True)
+            except OperationFailure as e:
+                if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
+                    print(f"⚠ Warning creating orders.order_id index: {e}")
+            
+            # Edge cache sync pulls the orders placed since its last sync
+            try:
+                self._db.orders.create_index("order_date")
+            except OperationFailure as e:
+                if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
+                    print(f"⚠ Warning creating orders.order_date index: {e}")
+            
             # Index on branch_id if needed
             try:
                 self._db.orders.create_index("branch_id")
@@ -134,6 +309,31 @@ class DatabaseConnection:
                 if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
                     print(f"⚠ Warning creating orders.branch_id index: {e}")
             
+            # Visit events are scanned by time range, per branch, by the rollup job
+            try:
+                self._db.visits.create_index([("visited_at", 1)])
+                self._db.visits.create_index([("branch_id", 1), ("visited_at", 1)])
+            except OperationFailure as e:
+                if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
+                    print(f"⚠ Warning creating visits indexes: {e}")
+            
+            # Erase: visits are detached from the customer, tombstones are pulled by edge replicas
+            try:
+                self._db.visits.create_index("customer_id")
+                self._db.customer_deletions.create_index("customer_id", unique=True)
+                self._db.customer_deletions.create_index("deleted_at")
+            except OperationFailure as e:
+                if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
+                    print(f"⚠ Warning creating erase indexes: {e}")
+            
+            # One rollup document per branch and hour
+            try:
+                self._db.visit_rollups.create_index([("branch_id", 1), ("hour", 1)], unique=True)
+                self._db.visit_rollups.create_index([("hour", -1)])
+            except OperationFailure as e:
+                if "already exists" not in str(e).lower() and "unauthorized" not in str(e).lower():
+                    print(f"⚠ Warning creating visit_rollups indexes: {e}")
+            
             print("✓ Database indexes checked/created")
             
         except Exception as e:
@@ -151,6 +351,29 @@ class DatabaseConnection:
         """Get collection instance"""
         return self.get_database()[collection_name]
     
+    def get_read_collection(self, collection_name):
+        """
+        Collection for reads that tolerate replication lag (gallery loads,
+        order history), routed by MONGODB_READ_PREFERENCE so they can be
+        served by secondaries instead of the primary
+        """
+        return self.get_collection(collection_name).with_options(read_preference=self.read_preference)
+    
+    def get_durable_write_concern(self) -> WriteConcern:
+        """Write concern for writes a response depends on: journaled, acknowledged by MONGODB_DURABLE_WRITE_W"""
+        w = os.getenv('MONGODB_DURABLE_WRITE_W', 'majority')
+        return WriteConcern(w=int(w) if w.isdigit() else w, j=True)
+    
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Connection pool wait statistics"""
+        stats = self.pool_monitor.snapshot()
+        if self._client is not None:
+            options = self._client.options.pool_options
+            stats['max_pool_size'] = options.max_pool_size
+            stats['min_pool_size'] = options.min_pool_size
+        stats['read_preference'] = self.read_preference.mongos_mode
+        return stats
+    
     def close(self):
         """Close database connection"""
         if self._client:
@@ -0,0 +1,418 @@
+"""
+Branch Edge Cache
+Local SQLite replica of the gallery and latest orders for a branch server,
+with a durable outbox for registrations, reconciled with the central
+MongoDB by a background sync thread
+"""
+
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+import numpy as np
+from pymongo.errors import PyMongoError
+from dotenv import load_dotenv
+from database.models import CustomerModel, OrderModel
+
+load_dotenv()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (
+    customer_id INTEGER PRIMARY KEY,
+    name TEXT,
+    face_encoding BLOB NOT NULL,
+    home_branch_id TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS customers_home_branch ON customers (home_branch_id);
+CREATE TABLE IF NOT EXISTS latest_orders (
+    customer_id INTEGER PRIMARY KEY,
+    order_details TEXT,
+    order_date TEXT NOT NULL,
+    branch_id TEXT
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    edge_ref TEXT NOT NULL UNIQUE,
+    customer_name TEXT NOT NULL,
+    face_encoding BLOB NOT NULL,
+    order_details TEXT,
+    branch_id TEXT,
+    created_at TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class EdgeCache:
+    """
+    Persistent branch replica
+    Customers registered at the branch get a provisional negative id
+    (-outbox_id) and are recognizable immediately; once the outbox entry
+    reaches MongoDB the provisional rows are renumbered to the real id.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv('EDGE_CACHE_PATH', 'edge_cache.db')
+        self.sync_interval = float(os.getenv('EDGE_SYNC_INTERVAL_S', 30))
+        # Re-read this much before the last watermark: orders written behind
+        # can land in MongoDB after newer ones
+        self.sync_overlap = timedelta(seconds=float(os.getenv('EDGE_SYNC_OVERLAP_S', 600)))
+        self.page_size = int(os.getenv('EDGE_SYNC_PAGE_SIZE', 1000))
+
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._closing = False
+        # Bumped on every change to the customers table; request handlers
+        # rebuild their gallery when it moves
+        self.version = 0
+        self.stats = {
+            'online': None, 'last_sync_at': None, 'last_error': None,
+            'syncs': 0, 'failed_syncs': 0, 'pushed': 0, 'pulled_customers': 0, 'pulled_orders': 0,
+            'pulled_deletions': 0
+        }
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """One SQLite connection per thread (WAL: readers never wait for the sync writer)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30.0)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Outbox rows must survive power loss once REGISTER has answered
+            connection.execute('PRAGMA synchronous=FULL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _encode_vector(encoding) -> bytes:
+        return np.asarray(encoding, dtype=np.float64).tobytes()
+
+    @staticmethod
+    def _decode_vector(blob: bytes) -> np.ndarray:
+        return np.frombuffer(blob, dtype=np.float64)
+
+    @staticmethod
+    def _order_from_row(row) -> Dict[str, Any]:
+        return {
+            'customer_id': row['customer_id'],
+            'order_details': row['order_details'],
+            'order_date': datetime.fromisoformat(row['order_date']),
+            'branch_id': row['branch_id']
+        }
+
+    # ------------------------------------------------------------------
+    # Reads served to requests
+    # ------------------------------------------------------------------
+
+    def load_customers(self, home_branch_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Customers with encodings, shaped like CustomerModel.get_all_customers_with_encodings"""
+        query = 'SELECT customer_id, name, face_encoding, home_branch_id FROM customers'
+        params = ()
+        if home_branch_id:
+            query += ' WHERE home_branch_id = ?'
+            params = (home_branch_id,)
+        return [
+            {
+                'customer_id': row['customer_id'],
+                'name': row['name'],
+                'face_encoding': self._decode_vector(row['face_encoding']),
+                'home_branch_id': row['home_branch_id']
+            }
+            for row in self._connection().execute(query, params)
+        ]
+
+    def get_customer(self, customer_id: int) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            'SELECT customer_id, name, home_branch_id FROM customers WHERE customer_id = ?', (customer_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def get_latest_order(self, customer_id: int) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            'SELECT * FROM latest_orders WHERE customer_id = ?', (customer_id,)
+        ).fetchone()
+        return self._order_from_row(row) if row else None
+
+    def get_latest_orders(self, customer_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        if not customer_ids:
+            return {}
+        placeholders = ','.join('?' * len(customer_ids))
+        rows = self._connection().execute(
+            f'SELECT * FROM latest_orders WHERE customer_id IN ({placeholders})', list(customer_ids)
+        )
+        return {row['customer_id']: self._order_from_row(row) for row in rows}
+
+    # ------------------------------------------------------------------
+    # Local registrations
+    # ------------------------------------------------------------------
+
+    def queue_registration(self, customer_name: str, face_encoding, order_details: str, branch_id: str) -> int:
+        """
+        Register a customer locally and queue it for the central database
+        Returns: the provisional (negative) customer_id
+        """
+        now = datetime.now().isoformat()
+        encoding_blob = self._encode_vector(face_encoding)
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                cursor = connection.execute(
+                    'INSERT INTO outbox (edge_ref, customer_name, face_encoding, order_details, branch_id, created_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (uuid.uuid4().hex, customer_name, encoding_blob, order_details, branch_id, now)
+                )
+                provisional_id = -cursor.lastrowid
+                connection.execute(
+                    'INSERT OR REPLACE INTO customers VALUES (?, ?, ?, ?, ?)',
+                    (provisional_id, customer_name, encoding_blob, branch_id, now)
+                )
+                connection.execute(
+                    'INSERT OR REPLACE INTO latest_orders VALUES (?, ?, ?, ?)',
+                    (provisional_id, order_details, now, branch_id)
+                )
+            self.version += 1
+
+        print(f"✓ Queued registration {provisional_id} - {customer_name} (pending sync)")
+        # Push it now rather than at the next sync interval
+        self._wake.set()
+        return provisional_id
+
+    def delete_customer(self, customer_id: int) -> bool:
+        """
+        Remove a customer and their latest order from the replica
+        A provisional (negative) id also cancels its queued registration.
+        Returns: True if anything was removed
+        """
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                removed = connection.execute('DELETE FROM customers WHERE customer_id = ?', (customer_id,)).rowcount
+                connection.execute('DELETE FROM latest_orders WHERE customer_id = ?', (customer_id,))
+                if customer_id < 0:
+                    removed += connection.execute('DELETE FROM outbox WHERE outbox_id = ?', (-customer_id,)).rowcount
+            if removed:
+                self.version += 1
+        return removed > 0
+
+    def pending_count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    # ------------------------------------------------------------------
+    # Sync with the central database
+    # ------------------------------------------------------------------
+
+    def push_outbox(self) -> int:
+        """Send queued registrations oldest first; returns how many reached MongoDB"""
+        connection = self._connection()
+        pushed = 0
+        for entry in connection.execute('SELECT * FROM outbox ORDER BY outbox_id').fetchall():
+            provisional_id = -entry['outbox_id']
+            try:
+                # A retry after a lost acknowledgement finds the customer instead of duplicating it
+                customer = CustomerModel.get_customer_by_edge_ref(entry['edge_ref'])
+                if customer is None:
+                    customer = CustomerModel.create_customer(
+                        entry['customer_name'],
+                        self._decode_vector(entry['face_encoding']).tolist(),
+                        home_branch_id=entry['branch_id'],
+                        edge_ref=entry['edge_ref']
+                    )
+                    OrderModel.create_order_deferred(customer['customer_id'], entry['order_details'], entry['branch_id'])
+            except PyMongoError as e:
+                with self._write_lock, connection:
+                    connection.execute(
+                        'UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE outbox_id = ?',
+                        (str(e), entry['outbox_id'])
+                    )
+                raise
+
+            customer_id = customer['customer_id']
+            with self._write_lock:
+                with connection:
+                    # Renumber the provisional rows; a pull may already have stored the real id
+                    connection.execute(
+                        'UPDATE OR REPLACE customers SET customer_id = ? WHERE customer_id = ?',
+                        (customer_id, provisional_id)
+                    )
+                    connection.execute(
+                        'UPDATE OR REPLACE latest_orders SET customer_id = ? WHERE customer_id = ?',
+                        (customer_id, provisional_id)
+                    )
+                    connection.execute('DELETE FROM outbox WHERE outbox_id = ?', (entry['outbox_id'],))
+                self.version += 1
+            pushed += 1
+            print(f"✓ Synced registration {provisional_id} as customer {customer_id}")
+
+        return pushed
+
+    def _get_state(self, key: str) -> Optional[datetime]:
+        row = self._connection().execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return datetime.fromisoformat(row['value']) if row else None
+
+    def _set_state(self, connection: sqlite3.Connection, key: str, value: datetime):
+        connection.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', (key, value.isoformat()))
+
+    def pull(self):
+        """Copy customers and latest orders changed since the last sync"""
+        connection = self._connection()
+        pulled_customers = pulled_orders = 0
+
+        # Customers: keyset pages on (updated_at, customer_id)
+        watermark = self._get_state('customers_updated_at')
+        since = watermark - self.sync_overlap if watermark else None
+        after_customer_id = None
+        while True:
+            customers = CustomerModel.get_customers_updated_since(since, after_customer_id, limit=self.page_size)
+            if not customers:
+                break
+            with self._write_lock:
+                with connection:
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO customers VALUES (?, ?, ?, ?, ?)',
+                        [
+                            (
+                                customer['customer_id'], customer.get('name'),
+                                self._encode_vector(customer['face_encoding']),
+                                customer.get('home_branch_id'),
+                                customer['updated_at'].isoformat() if customer.get('updated_at') else None
+                            )
+                            for customer in customers
+                        ]
+                    )
+                    last = customers[-1]
+                    if last.get('updated_at') and (watermark is None or last['updated_at'] > watermark):
+                        watermark = last['updated_at']
+                        self._set_state(connection, 'customers_updated_at', watermark)
+                self.version += 1
+            pulled_customers += len(customers)
+            if len(customers) < self.page_size or not last.get('updated_at'):
+                break
+            since, after_customer_id = last['updated_at'], last['customer_id']
+
+        # Erased customers: drop them and their orders (after the customer pass,
+        # so a page read just before the delete cannot bring one back)
+        deletion_watermark = self._get_state('customers_deleted_at')
+        deletions = CustomerModel.get_deleted_since(deletion_watermark - self.sync_overlap if deletion_watermark else None)
+        if deletions:
+            erased = [(deletion['customer_id'],) for deletion in deletions]
+            with self._write_lock:
+                with connection:
+                    removed = connection.executemany('DELETE FROM customers WHERE customer_id = ?', erased).rowcount
+                    connection.executemany('DELETE FROM latest_orders WHERE customer_id = ?', erased)
+                    self._set_state(connection, 'customers_deleted_at', deletions[-1]['deleted_at'])
+                # Tombstones inside the overlap window are seen again; only real removals move the version
+                if removed:
+                    self.version += 1
+                    self.stats['pulled_deletions'] += removed
+
+        # Latest orders: only replace an order with a newer one
+        order_watermark = self._get_state('orders_order_date')
+        latest_orders = OrderModel.get_latest_orders_since(order_watermark - self.sync_overlap if order_watermark else None)
+        if latest_orders:
+            newest = max(order['order_date'] for order in latest_orders.values())
+            with self._write_lock, connection:
+                connection.executemany(
+                    'INSERT INTO latest_orders VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(customer_id) DO UPDATE SET order_details = excluded.order_details, '
+                    'order_date = excluded.order_date, branch_id = excluded.branch_id '
+                    'WHERE excluded.order_date > latest_orders.order_date',
+                    [
+                        (customer_id, order.get('order_details'), order['order_date'].isoformat(), order.get('branch_id'))
+                        for customer_id, order in latest_orders.items()
+                    ]
+                )
+                if order_watermark is None or newest > order_watermark:
+                    self._set_state(connection, 'orders_order_date', newest)
+            pulled_orders = len(latest_orders)
+
+        self.stats['pulled_customers'] += pulled_customers
+        self.stats['pulled_orders'] += pulled_orders
+        return pulled_customers, pulled_orders
+
+    def sync(self) -> bool:
+        """Push the outbox, then pull changes; False if the central database was unreachable"""
+        try:
+            pushed = self.push_outbox()
+            pulled_customers, pulled_orders = self.pull()
+        except Exception as e:
+            if self.stats['online'] is not False:
+                print(f"⚠ Edge sync failed, serving from the local replica: {e}")
+            self.stats.update({'online': False, 'last_error': str(e)})
+            self.stats['failed_syncs'] += 1
+            return False
+
+        if self.stats['online'] is False:
+            print("✓ Edge sync reconnected to the central database")
+        if pushed or pulled_customers:
+            print(f"✓ Edge sync: {pushed} pushed, {pulled_customers} customers and {pulled_orders} orders pulled")
+        self.stats.update({'online': True, 'last_sync_at': datetime.now().isoformat(), 'last_error': None})
+        self.stats['pushed'] += pushed
+        self.stats['syncs'] += 1
+        return True
+
+    def _run(self):
+        backoff = self.sync_interval
+        while not self._closing:
+            online = self.sync()
+            # Back off while the link is down, up to ten intervals
+            backoff = self.sync_interval if online else min(backoff * 2, self.sync_interval * 10)
+            self._wake.wait(backoff)
+            self._wake.clear()
+
+    def start(self):
+        """Start the background sync thread (the first sync runs immediately)"""
+        if self._thread is not None:
+            return
+        if self.get_stats()['customers'] == 0:
+            # A new branch would otherwise answer with an empty gallery until the first pull
+            self.sync()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='edge-sync', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._closing = True
+        self._wake.set()
+        self._thread.join(timeout=10.0)
+        self._thread = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        connection = self._connection()
+        stats = dict(self.stats)
+        stats['path'] = self.path
+        stats['customers'] = connection.execute('SELECT COUNT(*) FROM customers').fetchone()[0]
+        stats['outbox_pending'] = self.pending_count()
+        return stats
+
+
+_edge_cache = None
+_edge_cache_lock = threading.Lock()
+
+
+def get_edge_cache() -> Optional[EdgeCache]:
+    """Edge cache when EDGE_MODE is on, or None when requests read MongoDB directly"""
+    global _edge_cache
+    if os.getenv('EDGE_MODE', 'false').lower() not in ('1', 'true', 'yes'):
+        return None
+    if _edge_cache is None:
+        with _edge_cache_lock:
+            if _edge_cache is None:
+                _edge_cache = EdgeCache()
+    return _edge_cache
@@ -3,11 +3,21 @@ Database Models and Operations
 Handles CRUD operations for customers and orders
 """
 
-from datetime import datetime
-from typing import Optional, List, Dict, Any
+import base64
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple
+from bson import ObjectId
 from database.connection import db_connection
+from database.write_behind import write_behind, reserve_sequence, CUSTOMER_DELETIONS
 import json
 
+# Order history pages: default and maximum page size, and the fields a client may request
+ORDER_PAGE_DEFAULT = 20
+ORDER_PAGE_MAX = 100
+ORDER_FIELDS = ['order_id', 'order_details', 'order_date', 'branch_id']
+# Order dates are stored naive; cursors count microseconds from this naive epoch
+CURSOR_EPOCH = datetime(1970, 1, 1)
+
 
 class CustomerModel:
     """Customer database operations"""
@@ -16,21 +26,41 @@ class CustomerModel:
     def get_collection():
         return db_connection.get_collection('customers')
     
+    @staticmethod
+    def get_deletions_collection():
+        """Tombstones of erased customers: customer_id and deleted_at only"""
+        return db_connection.get_collection(CUSTOMER_DELETIONS)
+    
     @staticmethod
     def get_next_customer_id() -> int:
-        """Get next available customer_id"""
+        """Get next available customer_id (ids of erased customers are never reused)"""
         collection = CustomerModel.get_collection()
         last_customer = collection.find_one(
             sort=[("customer_id", -1)]
         )
-        if last_customer:
-            return last_customer['customer_id'] + 1
-        return 1
+        last_deletion = CustomerModel.get_deletions_collection().find_one(
+            sort=[("customer_id", -1)]
+        )
+        last_id = max(
+            last_customer['customer_id'] if last_customer else 0,
+            last_deletion['customer_id'] if last_deletion else 0
+        )
+        return last_id + 1
     
     @staticmethod
-    def create_customer(name: str, face_encoding: List[float]) -> Dict[str, Any]:
-        """Create a new customer"""
-        collection = CustomerModel.get_collection()
+    def create_customer(
+        name: str,
+        face_encoding: List[float],
+        home_branch_id: Optional[str] = None,
+        edge_ref: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Create a new customer (journaled: the register response only waits for this write)
+        Args:
+            edge_ref: Id of a registration queued by a branch edge cache, so a
+                      retried sync finds the customer instead of creating it twice
+        """
+        collection = CustomerModel.get_collection().with_options(write_concern=db_connection.get_durable_write_concern())
         
         customer_id = CustomerModel.get_next_customer_id()
         
@@ -38,9 +68,12 @@ class CustomerModel:
             'customer_id': customer_id,
             'name': name,
             'face_encoding': face_encoding,  # Store as array in MongoDB
+            'home_branch_id': home_branch_id,  # Gallery shard the customer belongs to
             'created_at': datetime.now(),
             'updated_at': datetime.now()
         }
+        if edge_ref:
+            customer['edge_ref'] = edge_ref
         
         result = collection.insert_one(customer)
         
@@ -62,12 +95,28 @@ class CustomerModel:
         return customer
     
     @staticmethod
-    def get_all_customers_with_encodings() -> List[Dict[str, Any]]:
-        """Get all customers with their face encodings for recognition"""
-        collection = CustomerModel.get_collection()
+    def get_customer_by_edge_ref(edge_ref: str) -> Optional[Dict[str, Any]]:
+        """Customer created from an edge cache registration, if it already reached the database"""
+        customer = CustomerModel.get_collection().find_one({'edge_ref': edge_ref})
+        if customer:
+            customer.pop('_id', None)
+        return customer
+    
+    @staticmethod
+    def get_read_collection(fresh: bool = False):
+        """Customers collection for bulk reads; fresh=True reads the primary (e.g. right after a write)"""
+        if fresh:
+            return CustomerModel.get_collection()
+        return db_connection.get_read_collection('customers')
+    
+    @staticmethod
+    def get_all_customers_with_encodings(home_branch_id: Optional[str] = None, fresh: bool = False) -> List[Dict[str, Any]]:
+        """Get all customers (optionally of one home branch) with their face encodings"""
+        collection = CustomerModel.get_read_collection(fresh)
+        query = {'home_branch_id': home_branch_id} if home_branch_id else {}
         customers = list(collection.find(
-            {},
-            {'customer_id': 1, 'name': 1, 'face_encoding': 1}
+            query,
+            {'customer_id': 1, 'name': 1, 'face_encoding': 1, 'home_branch_id': 1}
         ))
         
         # Remove MongoDB _id field
@@ -76,6 +125,78 @@ class CustomerModel:
         
         return customers
     
+    @staticmethod
+    def get_customers_for_shard(shard_index: int, shard_count: int, fresh: bool = False) -> List[Dict[str, Any]]:
+        """Get the customers owned by one gallery shard node (customer_id % shard_count == shard_index)"""
+        collection = CustomerModel.get_read_collection(fresh)
+        customers = list(collection.find(
+            {'customer_id': {'$mod': [shard_count, shard_index]}},
+            {'customer_id': 1, 'name': 1, 'face_encoding': 1, 'home_branch_id': 1}
+        ))
+        
+        for customer in customers:
+            customer.pop('_id', None)
+        
+        return customers
+    
+    @staticmethod
+    def get_customers_updated_since(
+        since: Optional[datetime] = None,
+        after_customer_id: Optional[int] = None,
+        limit: int = 1000
+    ) -> List[Dict[str, Any]]:
+        """
+        Customers (with encodings) changed after a (updated_at, customer_id)
+        position, oldest change first; pass the last row's position to get
+        the next page
+        """
+        collection = CustomerModel.get_read_collection()
+        if since is None:
+            query = {}
+        elif after_customer_id is None:
+            query = {'updated_at': {'$gt': since}}
+        else:
+            query = {'$or': [
+                {'updated_at': {'$gt': since}},
+                {'updated_at': since, 'customer_id': {'$gt': after_customer_id}}
+            ]}
+        customers = list(collection.find(
+            query,
+            {'customer_id': 1, 'name': 1, 'face_encoding': 1, 'home_branch_id': 1, 'updated_at': 1}
+        ).sort([('updated_at', 1), ('customer_id', 1)]).limit(limit))
+        
+        for customer in customers:
+            customer.pop('_id', None)
+        
+        return customers
+    
+    @staticmethod
+    def backfill_home_branches() -> int:
+        """Set home_branch_id from the first order's branch for customers without one"""
+        collection = CustomerModel.get_collection()
+        missing = [
+            customer['customer_id']
+            for customer in collection.find({'home_branch_id': None}, {'customer_id': 1})
+        ]
+        if not missing:
+            return 0
+        
+        first_orders = OrderModel.get_collection().aggregate([
+            {'$match': {'customer_id': {'$in': missing}}},
+            {'$sort': {'customer_id': 1, 'order_date': 1}},
+            {'$group': {'_id': '$customer_id', 'branch_id': {'$first': '$branch_id'}}}
+        ])
+        
+        updated = 0
+        for first_order in first_orders:
+            result = collection.update_one(
+                {'customer_id': first_order['_id']},
+                {'$set': {'home_branch_id': first_order['branch_id']}}
+            )
+            updated += result.modified_count
+        
+        return updated
+    
     @staticmethod
     def update_customer(customer_id: int, updates: Dict[str, Any]):
         """Update customer information"""
@@ -88,6 +209,41 @@ class CustomerModel:
         )
         
         return result.modified_count > 0
+    
+    @staticmethod
+    def delete_customer(customer_id: int) -> bool:
+        """
+        Delete a customer (with the face encoding) and leave a tombstone
+        The tombstone is written first, so branch replicas and queued
+        write-behind records learn about the erase even if the process stops
+        halfway; a retry completes the delete.
+        Returns: True if the customer existed
+        """
+        write_concern = db_connection.get_durable_write_concern()
+        if CustomerModel.get_collection().find_one({'customer_id': customer_id}, {'_id': 1}) is None:
+            return False
+        
+        CustomerModel.get_deletions_collection().with_options(write_concern=write_concern).update_one(
+            {'customer_id': customer_id},
+            {'$setOnInsert': {'customer_id': customer_id, 'deleted_at': datetime.now()}},
+            upsert=True
+        )
+        result = CustomerModel.get_collection().with_options(write_concern=write_concern).delete_one(
+            {'customer_id': customer_id}
+        )
+        print(f"✓ Deleted customer: {customer_id}")
+        return result.deleted_count > 0
+    
+    @staticmethod
+    def get_deleted_since(since: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Tombstones recorded after a time (all if since is None), oldest first"""
+        query = {'deleted_at': {'$gt': since}} if since else {}
+        deletions = list(CustomerModel.get_deletions_collection().find(
+            query,
+            {'_id': 0, 'customer_id': 1, 'deleted_at': 1},
+            sort=[('deleted_at', 1)]
+        ))
+        return deletions
 
 
 class OrderModel:
@@ -99,14 +255,8 @@ class OrderModel:
     
     @staticmethod
     def get_next_order_id() -> int:
-        """Get next available order_id"""
-        collection = OrderModel.get_collection()
-        last_order = collection.find_one(
-            sort=[("order_id", -1)]
-        )
-        if last_order:
-            return last_order['order_id'] + 1
-        return 1
+        """Get next available order_id (same counter as write-behind batches)"""
+        return reserve_sequence('orders', 'order_id')
     
     @staticmethod
     def create_order(customer_id: int, order_details: str, branch_id: str) -> Dict[str, Any]:
@@ -131,6 +281,22 @@ class OrderModel:
         else:
             raise Exception("Failed to create order")
     
+    @staticmethod
+    def create_order_deferred(customer_id: int, order_details: str, branch_id: str) -> Dict[str, Any]:
+        """
+        Queue a new order on the write-behind queue
+        The order is in the local spool when this returns (fsynced with the
+        next batch); it reaches MongoDB with that batch, and its order_id is
+        allocated then.
+        """
+        order = {
+            'customer_id': customer_id,
+            'order_details': order_details,
+            'order_date': datetime.now(),
+            'branch_id': branch_id
+        }
+        return write_behind.enqueue('orders', order, sequence_field='order_id')
+    
     @staticmethod
     def get_latest_order(customer_id: int) -> Optional[Dict[str, Any]]:
         """Get the latest order for a customer"""
@@ -144,10 +310,135 @@ class OrderModel:
             order.pop('_id', None)
         return order
     
+    @staticmethod
+    def get_latest_orders(customer_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Get the latest order for each customer in a single $in query"""
+        if not customer_ids:
+            return {}
+        
+        collection = OrderModel.get_collection()
+        results = collection.aggregate([
+            {'$match': {'customer_id': {'$in': list(customer_ids)}}},
+            {'$sort': {'customer_id': 1, 'order_date': -1}},
+            {'$group': {'_id': '$customer_id', 'order': {'$first': '$$ROOT'}}}
+        ])
+        
+        latest_orders = {}
+        for result in results:
+            order = result['order']
+            order.pop('_id', None)
+            latest_orders[result['_id']] = order
+        
+        return latest_orders
+    
+    @staticmethod
+    def get_latest_orders_since(since: Optional[datetime] = None) -> Dict[int, Dict[str, Any]]:
+        """Latest order of every customer who ordered after a time (all customers if since is None)"""
+        pipeline = [{'$match': {'order_date': {'$gt': since}}}] if since else []
+        pipeline += [
+            {'$sort': {'customer_id': 1, 'order_date': -1}},
+            {'$group': {'_id': '$customer_id', 'order': {'$first': '$$ROOT'}}}
+        ]
+        
+        latest_orders = {}
+        for result in db_connection.get_read_collection('orders').aggregate(pipeline, allowDiskUse=True):
+            order = result['order']
+            order.pop('_id', None)
+            latest_orders[result['_id']] = order
+        
+        return latest_orders
+    
+    @staticmethod
+    def encode_order_cursor(order: Dict[str, Any]) -> str:
+        """Opaque keyset cursor for an order: its (order_date, _id) position"""
+        micros = (order['order_date'] - CURSOR_EPOCH) // timedelta(microseconds=1)
+        raw = f"{micros}:{order['_id']}"
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+    
+    @staticmethod
+    def decode_order_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+        """Inverse of encode_order_cursor; raises ValueError for a malformed cursor"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+            micros, object_id = raw.split(':', 1)
+            return CURSOR_EPOCH + timedelta(microseconds=int(micros)), ObjectId(object_id)
+        except Exception as e:
+            raise ValueError(f"Invalid cursor: {cursor}") from e
+    
+    @staticmethod
+    def get_orders_page(
+        customer_id: int,
+        limit: int = ORDER_PAGE_DEFAULT,
+        cursor: Optional[str] = None,
+        since: Optional[str] = None,
+        fields: Optional[List[str]] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        One page of a customer's orders, newest first, using the
+        (customer_id, order_date, _id) index instead of skip/limit
+        Args:
+            limit: Page size, capped at ORDER_PAGE_MAX
+            cursor: next_cursor of the previous page; returns the orders after it
+            since: Cursor of an order already seen (e.g. the newest one on screen);
+                   only strictly newer orders are returned
+            fields: Order fields to return (subset of ORDER_FIELDS); default all
+        Returns:
+            (orders, next_cursor) where next_cursor is None on the last page;
+            each order carries its own 'cursor'
+        """
+        limit = min(max(int(limit), 1), ORDER_PAGE_MAX)
+        fields = [field for field in (fields or ORDER_FIELDS) if field in ORDER_FIELDS]
+        
+        conditions = [{'customer_id': customer_id}]
+        if cursor:
+            # Strictly after the cursor in (order_date desc, _id desc) order
+            order_date, object_id = OrderModel.decode_order_cursor(cursor)
+            conditions.append({'$or': [
+                {'order_date': {'$lt': order_date}},
+                {'order_date': order_date, '_id': {'$lt': object_id}}
+            ]})
+        if since:
+            order_date, object_id = OrderModel.decode_order_cursor(since)
+            conditions.append({'$or': [
+                {'order_date': {'$gt': order_date}},
+                {'order_date': order_date, '_id': {'$gt': object_id}}
+            ]})
+        query = conditions[0] if len(conditions) == 1 else {'$and': conditions}
+        
+        projection = {field: 1 for field in fields}
+        projection['order_date'] = 1  # needed for the cursor
+        
+        collection = db_connection.get_read_collection('orders')
+        # One extra document tells whether another page exists
+        orders = list(collection.find(
+            query,
+            projection,
+            sort=[('order_date', -1), ('_id', -1)],
+            limit=limit + 1
+        ))
+        
+        has_more = len(orders) > limit
+        orders = orders[:limit]
+        
+        for order in orders:
+            order['cursor'] = OrderModel.encode_order_cursor(order)
+            order.pop('_id', None)
+            if 'order_date' not in fields:
+                order.pop('order_date', None)
+        
+        next_cursor = orders[-1]['cursor'] if has_more else None
+        return orders, next_cursor
+    
+    @staticmethod
+    def delete_orders_for_customer(customer_id: int) -> int:
+        """Delete every order of a customer; returns how many were deleted"""
+        collection = OrderModel.get_collection().with_options(write_concern=db_connection.get_durable_write_concern())
+        return collection.delete_many({'customer_id': customer_id}).deleted_count
+    
     @staticmethod
     def get_all_orders_by_customer(customer_id: int) -> List[Dict[str, Any]]:
         """Get all orders for a customer"""
-        collection = OrderModel.get_collection()
+        collection = db_connection.get_read_collection('orders')
         orders = list(collection.find(
             {'customer_id': customer_id},
             sort=[('order_date', -1)]
@@ -158,3 +449,57 @@ class OrderModel:
         
         return orders
 
+
+class VisitModel:
+    """Recognition event (visit) operations"""
+    
+    @staticmethod
+    def get_collection():
+        return db_connection.get_collection('visits')
+    
+    @staticmethod
+    def get_rollup_collection():
+        return db_connection.get_collection('visit_rollups')
+    
+    @staticmethod
+    def record_visit(
+        branch_id: str,
+        outcome: str,
+        customer_id: Optional[int] = None,
+        distance: Optional[float] = None,
+        latency_ms: Optional[Dict[str, float]] = None
+    ) -> Dict[str, Any]:
+        """Queue one recognition outcome on the write-behind queue"""
+        visit = {
+            'branch_id': branch_id,
+            'outcome': outcome,
+            'recognized': outcome == 'RECOGNIZED',
+            'customer_id': customer_id,
+            'distance': None if distance is None else round(float(distance), 4),
+            'latency_ms': {stage: round(value, 2) for stage, value in (latency_ms or {}).items()},
+            'visited_at': datetime.now()
+        }
+        return write_behind.enqueue('visits', visit)
+    
+    @staticmethod
+    def anonymize_customer(customer_id: int) -> int:
+        """Detach a customer from their visit events (rollup counts are kept); returns how many changed"""
+        result = VisitModel.get_collection().update_many(
+            {'customer_id': customer_id},
+            {'$set': {'customer_id': None}}
+        )
+        return result.modified_count
+    
+    @staticmethod
+    def get_rollups(branch_id: Optional[str] = None, since: Optional[datetime] = None, limit: int = 168) -> List[Dict[str, Any]]:
+        """Hourly visit aggregates (see rollup_visits.py), newest first"""
+        query = {}
+        if branch_id:
+            query['branch_id'] = branch_id
+        if since:
+            query['hour'] = {'$gte': since}
+        
+        collection = db_connection.get_read_collection('visit_rollups')
+        rollups = list(collection.find(query, {'_id': 0}, sort=[('hour', -1), ('branch_id', 1)], limit=limit))
+        return rollups
+
@@ -0,0 +1,369 @@
+"""
+Write-Behind Queue
+Non-critical inserts (orders, visit events) are appended to a local spool
+file and written to MongoDB in batches by a background thread
+"""
+
+import fcntl
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId, json_util
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
+from dotenv import load_dotenv
+from database.connection import db_connection
+
+load_dotenv()
+
+DUPLICATE_KEY_ERROR = 11000
+
+# Tombstones of erased customers (see CustomerModel.delete_customer)
+CUSTOMER_DELETIONS = 'customer_deletions'
+# One {'_id': '<collection>.<field>', 'value': last id} document per sequence
+COUNTERS = 'counters'
+# Queued documents of an erased customer in these collections are dropped;
+# in the others the customer_id is cleared
+ERASE_DROP_COLLECTIONS = {'orders'}
+
+
+_seeded_sequences = set()
+_seed_lock = threading.Lock()
+
+
+def reserve_sequence(collection_name: str, field: str, count: int = 1) -> int:
+    """
+    Reserve count consecutive ids of an integer id field; returns the first
+    The $inc on the counter document is atomic, so processes flushing at the
+    same time get disjoint blocks. The counter is first raised to the
+    highest id already in the collection (idempotent $max), once per process.
+    """
+    counters = db_connection.get_collection(COUNTERS)
+    key = f"{collection_name}.{field}"
+    if key not in _seeded_sequences:
+        with _seed_lock:
+            if key not in _seeded_sequences:
+                last = db_connection.get_collection(collection_name).find_one(
+                    {field: {'$exists': True}}, {field: 1}, sort=[(field, -1)]
+                )
+                counters.update_one({'_id': key}, {'$max': {'value': last[field] if last else 0}}, upsert=True)
+                _seeded_sequences.add(key)
+    counter = counters.find_one_and_update(
+        {'_id': key}, {'$inc': {'value': count}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return counter['value'] - count + 1
+
+
+class WriteBehindQueue:
+    """
+    Batches inserts into insert_many
+    Every document gets its _id before it is spooled, so replaying a spool
+    segment after a crash re-inserts nothing that already reached MongoDB
+    (duplicate key errors on replay are expected and ignored). A spool
+    segment is deleted once every record in it has been written.
+    Processes may share WRITE_BEHIND_DIR: each names its segments with its own
+    prefix and holds an exclusive flock on every segment it has records
+    pending in, until the segment is deleted. At startup only unlocked
+    segments (left by a process that is gone) are claimed and replayed.
+    Appends are only flushed to the OS; the writer fsyncs the spool once per
+    batch (group commit), so a record survives a process crash as soon as it
+    is enqueued and a power loss from the next batch on.
+    """
+
+    def __init__(self):
+        self.spool_dir = os.getenv('WRITE_BEHIND_DIR', 'spool')
+        self.batch_size = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 200))
+        # How long the writer waits for more records before flushing a partial batch
+        self.linger_s = float(os.getenv('WRITE_BEHIND_LINGER_MS', 200)) / 1000.0
+        self.segment_records = int(os.getenv('WRITE_BEHIND_SEGMENT_RECORDS', 5000))
+        self.fsync = os.getenv('WRITE_BEHIND_FSYNC', 'true').lower() in ('1', 'true', 'yes')
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._segment_path = None
+        self._segment_file = None
+        self._segment_written = 0
+        self._segment_prefix = f"writes-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._files = {}            # segment path -> open file holding its lock
+        self._pending = {}          # segment path -> records not yet in MongoDB
+        self._thread = None
+        self._closing = False
+        self.stats = {'enqueued': 0, 'written': 0, 'duplicates': 0, 'batches': 0, 'failed_batches': 0, 'replayed': 0, 'erased': 0, 'fsyncs': 0}
+
+    def start(self):
+        """Replay leftover spool segments and start the writer thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._replay()
+            self._closing = False
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def _replay(self):
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith('.jsonl'):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            if path in self._files:
+                continue
+            f = self._claim(path)
+            if f is None:
+                continue
+            records = []
+            for line in f:
+                try:
+                    records.append(json_util.loads(line))
+                except ValueError:
+                    # Torn last line from a crash mid-write: that request never got a response
+                    continue
+            if not records:
+                os.remove(path)
+                f.close()
+                continue
+            self._files[path] = f
+            self._pending[path] = len(records)
+            for record in records:
+                self._queue.put((path, record))
+            self.stats['replayed'] += len(records)
+            print(f"→ Replaying {len(records)} spooled writes from {path}")
+
+    @staticmethod
+    def _claim(path: str):
+        """
+        Lock a segment for replay; None if its writer is still running, or
+        another process claimed and deleted it first
+        """
+        try:
+            f = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Locked after the owner deleted it: the path is gone or a new file
+            if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                raise FileNotFoundError(path)
+        except OSError:
+            f.close()
+            return None
+        return f
+
+    def enqueue(self, collection_name: str, document: Dict[str, Any], sequence_field: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Append a document to the spool and queue it for insertion
+        Args:
+            collection_name: Target collection
+            document: Document to insert; an _id is assigned if missing
+            sequence_field: Optional integer id field (e.g. 'order_id') allocated at flush time
+        Returns: the document with its _id
+        """
+        if self._thread is None:
+            self.start()
+
+        document.setdefault('_id', ObjectId())
+        record = {'collection': collection_name, 'sequence_field': sequence_field, 'document': document}
+        line = json_util.dumps(record, json_options=json_util.CANONICAL_JSON_OPTIONS) + '\n'
+
+        with self._lock:
+            if self._segment_file is None or self._segment_written >= self.segment_records:
+                self._open_segment()
+            self._segment_file.write(line)
+            self._segment_file.flush()
+            self._segment_written += 1
+            self._pending[self._segment_path] = self._pending.get(self._segment_path, 0) + 1
+            self.stats['enqueued'] += 1
+            path = self._segment_path
+
+        self._queue.put((path, record))
+        return document
+
+    def _open_segment(self):
+        """
+        Seal the current segment (if any) and start a new one; caller holds the lock
+        A sealed segment stays open, and locked, until _complete deletes it.
+        """
+        if self._segment_file is not None and self.fsync:
+            os.fsync(self._segment_file.fileno())
+        self._segment_path = os.path.join(self.spool_dir, f"{self._segment_prefix}-{time.time_ns()}.jsonl")
+        self._segment_file = open(self._segment_path, 'a', encoding='utf-8')
+        fcntl.flock(self._segment_file.fileno(), fcntl.LOCK_EX)
+        self._files[self._segment_path] = self._segment_file
+        self._segment_written = 0
+
+    def _take_batch(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Wait for a first record, then collect more until the batch is full or the linger time passes"""
+        try:
+            batch = [self._queue.get(timeout=1.0)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.linger_s
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                if self._closing:
+                    return
+                continue
+            self._sync()
+
+            # Retry the same batch until it lands; it is safe in the spool meanwhile
+            while True:
+                try:
+                    self._flush(batch)
+                    backoff = 0.5
+                    break
+                except PyMongoError as e:
+                    self.stats['failed_batches'] += 1
+                    print(f"✗ Write-behind flush of {len(batch)} records failed: {e}")
+                    if self._closing:
+                        return
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 30.0)
+
+    def _sync(self):
+        """
+        Group commit: one fsync of the open segment covers every record appended
+        so far. It runs on a duplicate descriptor outside the lock, so
+        enqueue() keeps appending (or seals the segment) meanwhile.
+        """
+        if not self.fsync:
+            return
+        with self._lock:
+            if self._segment_file is None:
+                return
+            fd = os.dup(self._segment_file.fileno())
+        try:
+            os.fsync(fd)
+            self.stats['fsyncs'] += 1
+        except OSError as e:
+            print(f"⚠ Could not fsync spool segment: {e}")
+        finally:
+            os.close(fd)
+
+    def _flush(self, batch: List[Tuple[str, Dict[str, Any]]]):
+        by_collection = {}
+        for path, record in batch:
+            by_collection.setdefault((record['collection'], record.get('sequence_field')), []).append(record['document'])
+
+        for (collection_name, sequence_field), documents in by_collection.items():
+            collection = db_connection.get_collection(collection_name)
+            documents = self._without_erased(collection_name, documents)
+            if not documents:
+                continue
+
+            if sequence_field:
+                # Reserve the sequential ids for the whole batch with one counter update
+                missing = [document for document in documents if sequence_field not in document]
+                if missing:
+                    next_id = reserve_sequence(collection_name, sequence_field, len(missing))
+                    for document in missing:
+                        document[sequence_field] = next_id
+                        next_id += 1
+
+            try:
+                result = collection.insert_many(documents, ordered=False)
+                written, duplicates = len(result.inserted_ids), 0
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                if any(error.get('code') != DUPLICATE_KEY_ERROR for error in errors):
+                    raise
+                # Already written before a crash or a failed attempt: nothing to redo
+                written, duplicates = e.details.get('nInserted', 0), len(errors)
+
+            self.stats['written'] += written
+            self.stats['duplicates'] += duplicates
+
+        self.stats['batches'] += 1
+        self._complete(path for path, _ in batch)
+
+    def _without_erased(self, collection_name: str, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Keep documents queued before a customer was erased from bringing them back
+        One tombstone lookup per batch; works across restarts and processes
+        """
+        customer_ids = {document['customer_id'] for document in documents if document.get('customer_id') is not None}
+        if not customer_ids:
+            return documents
+        erased = {
+            deletion['customer_id']
+            for deletion in db_connection.get_collection(CUSTOMER_DELETIONS).find(
+                {'customer_id': {'$in': list(customer_ids)}}, {'customer_id': 1}
+            )
+        }
+        if not erased:
+            return documents
+
+        kept = []
+        for document in documents:
+            if document.get('customer_id') in erased:
+                self.stats['erased'] += 1
+                if collection_name in ERASE_DROP_COLLECTIONS:
+                    continue
+                document['customer_id'] = None
+            kept.append(document)
+        return kept
+
+    def _complete(self, paths):
+        """Drop spool segments whose records are all in MongoDB"""
+        with self._lock:
+            for path in paths:
+                self._pending[path] -= 1
+            for path in [path for path, count in self._pending.items() if count == 0]:
+                del self._pending[path]
+                if path == self._segment_path:
+                    self._segment_file = None
+                    self._segment_path = None
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"⚠ Could not remove spool segment {path}: {e}")
+                # Unlock only once deleted, so no other process replays it
+                f = self._files.pop(path, None)
+                if f is not None:
+                    f.close()
+
+    def close(self, timeout: float = 10.0):
+        """Flush what is queued; anything left stays in the spool for the next start"""
+        if self._thread is None:
+            return
+        self._closing = True
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._thread.join(max(0.0, deadline - time.monotonic()) + 1.5)
+        self._thread = None
+        with self._lock:
+            if self._segment_file is not None and self.fsync:
+                os.fsync(self._segment_file.fileno())
+            # Unflushed segments are left unlocked for the next start to replay
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+            self._segment_file = None
+            self._segment_path = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['pending'] = sum(self._pending.values())
+            stats['spool_segments'] = len(self._pending)
+        return stats
+
+
+# Global instance shared by all request handlers
+write_behind = WriteBehindQueue()
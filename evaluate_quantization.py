@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Script to measure the compressed gallery search modes against exact search
+
+For each quantization mode and PCA size it reports the memory held for
+search, the bytes scanned per probe, latency, and how often the compressed
+search agrees with the exact float64 distance used by
+face_recognition.face_distance (np.linalg.norm(gallery - probe, axis=1)).
+
+Probes are gallery encodings with added noise (a new capture of a known
+customer) plus noisy encodings of held-out customers (people who are not
+in the gallery). Use the real gallery (--source db) for numbers that
+reflect production; --source synthetic needs no database.
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models.gallery import FaceGallery, ENCODING_SIZE
+
+load_dotenv()
+
+
+def load_db_encodings():
+    from database.connection import db_connection
+    from database.models import CustomerModel
+
+    db_connection.connect()
+    customers = CustomerModel.get_all_customers_with_encodings()
+    db_connection.close()
+    return np.asarray([customer['face_encoding'] for customer in customers], dtype=np.float64)
+
+
+def synthetic_encodings(size, rng):
+    """Identity vectors with a decaying spectrum, spread like dlib encodings (~0.9 apart)"""
+    spectrum = np.exp(-np.arange(ENCODING_SIZE) / 40.0)
+    spectrum *= 0.9 / np.sqrt(2.0 * np.sum(spectrum ** 2))
+    return rng.standard_normal((size, ENCODING_SIZE)) * spectrum
+
+
+def exact_top_k(encodings, probe, k):
+    """Reference search: the face_recognition.face_distance formula in float64"""
+    distances = np.linalg.norm(encodings - probe, axis=1)
+    order = np.argsort(distances)[:k]
+    return order, distances[order]
+
+
+def evaluate(gallery, encodings, probes, reference, k, threshold):
+    """Compare one gallery configuration with the exact reference results"""
+    top1_agree = decision_agree = 0
+    recall = []
+    distance_errors = []
+    started = time.perf_counter()
+    results = [gallery.top_k(probe[None, :], k) for probe in probes]
+    elapsed_ms = (time.perf_counter() - started) * 1000.0
+
+    for (indices, distances), (ref_indices, ref_distances) in zip(results, reference):
+        indices, distances = indices[0], distances[0]
+        top1_agree += int(indices[0] == ref_indices[0])
+        recall.append(len(set(indices.tolist()) & set(ref_indices.tolist())) / len(ref_indices))
+
+        accepted = distances[0] <= threshold
+        ref_accepted = ref_distances[0] <= threshold
+        same = accepted == ref_accepted and (not accepted or indices[0] == ref_indices[0])
+        decision_agree += int(same)
+        if indices[0] == ref_indices[0]:
+            distance_errors.append(abs(float(distances[0]) - float(ref_distances[0])))
+
+    usage = gallery.memory_usage()
+    exact_bytes = encodings.nbytes + 8 * len(encodings)
+    if gallery.index is not None:
+        scanned = gallery.index.codes.nbytes
+    else:
+        scanned = gallery.encodings.nbytes
+    return {
+        'search_mode': usage['search_mode'],
+        'dims': usage.get('index_dims', ENCODING_SIZE),
+        'pca_explained_variance': usage.get('pca_explained_variance'),
+        'memory_bytes': usage['total_bytes'],
+        'memory_saved_pct': round(100.0 * (1 - usage['total_bytes'] / exact_bytes), 1),
+        'scanned_bytes_per_probe': int(scanned),
+        'latency_ms_per_probe': round(elapsed_ms / len(probes), 3),
+        'top1_agreement': round(top1_agree / len(probes), 4),
+        f'recall_at_{k}': round(float(np.mean(recall)), 4),
+        'decision_agreement': round(decision_agree / len(probes), 4),
+        'max_distance_error': float(max(distance_errors)) if distance_errors else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate quantized gallery search against exact search")
+    parser.add_argument('--source', choices=['db', 'synthetic'], default='db',
+                        help="Gallery encodings: the customers collection or synthetic identities")
+    parser.add_argument('--size', type=int, default=20000,
+                        help="Synthetic gallery size (default: 20000)")
+    parser.add_argument('--probes', type=int, default=500,
+                        help="Number of probes (default: 500)")
+    parser.add_argument('--impostor-fraction', type=float, default=0.2,
+                        help="Share of probes from people held out of the gallery (default: 0.2)")
+    parser.add_argument('--noise', type=float, default=0.03,
+                        help="Per-dimension noise of a new capture (default: 0.03, ~0.35 distance)")
+    parser.add_argument('--modes', default='float16,int8',
+                        help="Comma-separated quantization modes to evaluate")
+    parser.add_argument('--dims', default='32,64,128',
+                        help="Comma-separated PCA sizes (128 = no projection)")
+    parser.add_argument('--rerank', type=int, default=int(os.getenv('GALLERY_RERANK_CANDIDATES', 32)),
+                        help="Candidates re-ranked with exact float32 distances")
+    parser.add_argument('--k', type=int, default=5,
+                        help="Top-k compared for recall (default: 5)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', dest='json_path', default=None,
+                        help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    threshold = float(os.getenv('FACE_RECOGNITION_TOLERANCE', 0.6))
+    rng = np.random.default_rng(args.seed)
+
+    print("=" * 60)
+    print("Quantized Gallery Search Evaluation")
+    print("=" * 60)
+
+    if args.source == 'db':
+        try:
+            all_encodings = load_db_encodings()
+        except Exception as e:
+            print(f"\n✗ Failed to load customers: {e}")
+            sys.exit(1)
+    else:
+        all_encodings = synthetic_encodings(args.size, rng)
+
+    if len(all_encodings) < 10:
+        print(f"\n✗ Need at least 10 encodings, found {len(all_encodings)}")
+        sys.exit(1)
+
+    # Hold some identities out of the gallery to serve as impostor probes
+    permutation = rng.permutation(len(all_encodings))
+    held_out_count = max(1, int(len(all_encodings) * args.impostor_fraction / 2))
+    held_out = all_encodings[permutation[:held_out_count]]
+    encodings = all_encodings[permutation[held_out_count:]]
+
+    impostors = int(args.probes * args.impostor_fraction)
+    sources = np.vstack([
+        encodings[rng.integers(0, len(encodings), args.probes - impostors)],
+        held_out[rng.integers(0, len(held_out), impostors)]
+    ])
+    probes = sources + rng.standard_normal(sources.shape) * args.noise
+
+    print(f"\n📊 Gallery: {len(encodings)} encodings ({args.source}), {len(probes)} probes ({impostors} impostors)")
+    print(f"   Exact float64 gallery: {encodings.nbytes / 1024 / 1024:.2f} MB")
+
+    reference = [exact_top_k(encodings, probe, args.k) for probe in probes]
+    customers = [{'customer_id': i, 'face_encoding': encoding} for i, encoding in enumerate(encodings)]
+
+    os.environ['GALLERY_QUANTIZE_MIN_SIZE'] = '0'
+    os.environ['GALLERY_RERANK_CANDIDATES'] = str(args.rerank)
+
+    results = [evaluate(FaceGallery(customers, search_mode='exact'), encodings, probes, reference, args.k, threshold)]
+    for mode in [mode.strip() for mode in args.modes.split(',') if mode.strip()]:
+        for dims in [int(dims) for dims in args.dims.split(',') if dims.strip()]:
+            os.environ['GALLERY_PCA_DIMS'] = str(dims)
+            results.append(evaluate(FaceGallery(customers, search_mode=mode), encodings, probes, reference, args.k, threshold))
+
+    print(f"\n{'Mode':<8} {'Dims':>5} {'Memory MB':>10} {'Saved':>7} {'Scan KB':>9} {'ms/probe':>9} "
+          f"{'Top-1':>7} {f'R@{args.k}':>7} {'Decision':>9} {'Max err':>9}")
+    for result in results:
+        max_error = f"{result['max_distance_error']:.2e}" if result['max_distance_error'] is not None else '-'
+        print(f"{result['search_mode']:<8} {result['dims']:>5} {result['memory_bytes'] / 1024 / 1024:>10.2f} "
+              f"{result['memory_saved_pct']:>6.1f}% {result['scanned_bytes_per_probe'] / 1024:>9.0f} "
+              f"{result['latency_ms_per_probe']:>9.3f} {result['top1_agreement']:>7.4f} "
+              f"{result[f'recall_at_{args.k}']:>7.4f} {result['decision_agreement']:>9.4f} {max_error:>9}")
+
+    print("\nTop-1 / decision agreement are measured against the exact float64 face_distance;")
+    print(f"decisions use the global threshold {threshold}.")
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({'gallery_size': len(encodings), 'probes': len(probes), 'results': results}, f, indent=2)
+        print(f"\n✓ Results written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
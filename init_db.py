@@ -33,6 +33,11 @@ def main():
             print("\n✓ Database is empty and ready to use")
         else:
             print("\n✓ Database already contains data")
+            
+            # Assign gallery shards to customers registered before branch sharding
+            backfilled = CustomerModel.backfill_home_branches()
+            if backfilled:
+                print(f"✓ Assigned home branch to {backfilled} customers from their first order")
         
         print("\n✓ Database initialization complete!")
         
@@ -23,18 +23,27 @@ export const api = {
         }
     },
 
-    async recognize(base64Image) {
+    // faceBox: optional [top, right, bottom, left] from on-device face detection.
+    // faceCrop: true if base64Image is already cropped to the face.
+    async recognize(base64Image, { faceBox = null, faceCrop = false } = {}) {
         try {
+            const payload = {
+                request_type: 'RECOGNIZE',
+                image_data: base64Image,
+                branch_id: 'MOBILE_APP_01',
+            };
+            if (faceBox) {
+                payload.face_box = faceBox;
+            }
+            if (faceCrop) {
+                payload.face_crop = true;
+            }
             const response = await fetch(`${this.baseUrl}/api/recognize`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({
-                    request_type: 'RECOGNIZE',
-                    image_data: base64Image,
-                    branch_id: 'MOBILE_APP_01',
-                }),
+                body: JSON.stringify(payload),
             });
             return await response.json();
         } catch (error) {
@@ -64,4 +73,21 @@ export const api = {
             throw error;
         }
     },
+
+    async getOrderHistory(customerId, { limit = 20, cursor = null, since = null } = {}) {
+        try {
+            const params = new URLSearchParams({ limit: String(limit) });
+            if (cursor) {
+                params.append('cursor', cursor);
+            }
+            if (since) {
+                params.append('since', since);
+            }
+            const response = await fetch(`${this.baseUrl}/api/customers/${customerId}/orders?${params.toString()}`);
+            return await response.json();
+        } catch (error) {
+            console.error('Order history failed:', error);
+            throw error;
+        }
+    },
 };
@@ -42,10 +42,17 @@ export const COLORS = {
 export const ERROR_MESSAGES = {
   NO_FACE_DETECTED: 'Không phát hiện khuôn mặt. Vui lòng chụp lại với ánh sáng tốt hơn.',
   FACE_ENCODING_FAILED: 'Không thể xử lý ảnh. Vui lòng thử lại.',
+  FACE_TOO_SMALL: 'Khuôn mặt quá nhỏ. Vui lòng đến gần camera hơn.',
+  FACE_TOO_BLURRY: 'Ảnh bị mờ. Vui lòng giữ yên và chụp lại.',
+  POOR_LIGHTING: 'Ảnh quá tối hoặc quá sáng. Vui lòng điều chỉnh ánh sáng.',
+  FACE_NOT_FRONTAL: 'Vui lòng nhìn thẳng vào camera.',
   PROCESSING_ERROR: 'Lỗi xử lý. Vui lòng thử lại.',
   SERVER_ERROR: 'Lỗi server. Vui lòng thử lại sau.',
   INVALID_REQUEST: 'Yêu cầu không hợp lệ.',
   UNKNOWN_REQUEST_TYPE: 'Loại yêu cầu không xác định.',
+  BUSY: 'Server đang bận. Vui lòng thử lại sau giây lát.',
+  PAYLOAD_TOO_LARGE: 'Ảnh quá lớn. Vui lòng chụp lại với độ phân giải thấp hơn.',
+  CUSTOMER_NOT_FOUND: 'Không tìm thấy khách hàng.',
   NETWORK_ERROR: 'Không có kết nối mạng. Vui lòng kiểm tra WiFi/Mobile Data.',
   CONNECTION_REFUSED: 'Không thể kết nối đến server. Vui lòng kiểm tra cài đặt.',
   CONNECTION_TIMEOUT: 'Kết nối timeout. Vui lòng thử lại.',
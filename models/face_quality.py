@@ -0,0 +1,57 @@
+"""
+Face Quality Measures
+Cheap image-quality scores computed on a face crop before encoding
+"""
+
+import cv2
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+# Face crops are resized to this side before scoring so thresholds do not
+# depend on the camera resolution
+NORMALIZED_FACE_SIZE = 128
+
+
+def face_crop_gray(image_array: np.ndarray, face_location: Tuple[int, int, int, int]) -> np.ndarray:
+    """Grayscale face crop resized to NORMALIZED_FACE_SIZE"""
+    top, right, bottom, left = face_location
+    height, width = image_array.shape[:2]
+    crop = image_array[max(0, top):min(height, bottom), max(0, left):min(width, right)]
+    gray = cv2.cvtColor(np.ascontiguousarray(crop), cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, (NORMALIZED_FACE_SIZE, NORMALIZED_FACE_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def blur_score(face_gray: np.ndarray) -> float:
+    """Variance of the Laplacian; low values mean a blurry face"""
+    return float(cv2.Laplacian(face_gray, cv2.CV_64F).var())
+
+
+def exposure_scores(face_gray: np.ndarray) -> Tuple[float, float]:
+    """
+    Mean brightness (0-255) and fraction of clipped pixels
+    Returns: (brightness, clipped_fraction)
+    """
+    brightness = float(face_gray.mean())
+    clipped = np.count_nonzero((face_gray <= 10) | (face_gray >= 245))
+    return brightness, clipped / float(face_gray.size)
+
+
+def yaw_score(landmarks: Dict[str, List[Tuple[int, int]]]) -> Optional[float]:
+    """
+    Horizontal offset of the nose tip from the eye midpoint, in units of the
+    inter-eye distance: about 0 for a frontal face, growing as the head turns
+    Works with both the 5-point and 68-point landmark sets.
+    """
+    try:
+        left_eye = np.mean(landmarks['left_eye'], axis=0)
+        right_eye = np.mean(landmarks['right_eye'], axis=0)
+        nose_tip = np.mean(landmarks['nose_tip'], axis=0)
+    except (KeyError, ValueError):
+        return None
+
+    eye_distance = float(np.linalg.norm(right_eye - left_eye))
+    if eye_distance == 0:
+        return None
+
+    eye_midpoint = (left_eye + right_eye) / 2.0
+    return float(abs(nose_tip[0] - eye_midpoint[0]) / eye_distance)
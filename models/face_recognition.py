@@ -4,16 +4,38 @@ Handles face detection and recognition using face_recognition library
 """
 
 import os
-import face_recognition
+import threading
+import time
 import numpy as np
-from typing import Optional, Tuple, List, Dict
-from PIL import Image
-import io
+from typing import Optional, Tuple, List, Dict, Union
 import base64
+import json
 from dotenv import load_dotenv
+from models.gallery import FaceGallery, ShardedGallery, RemoteGallery
+from models.face_quality import face_crop_gray, blur_score, exposure_scores, yaw_score
+from models.match_log import MatchDistanceLog
+from models.preprocessing import FALLBACK_TURNS, decode_image, downscaled, rotated
 
 load_dotenv()
 
+# face_recognition imports dlib and loads its model weights, which takes
+# seconds; it is imported on first use instead of with this module
+_face_recognition = None
+_import_lock = threading.Lock()
+
+
+def _load_face_recognition():
+    """The face_recognition module, imported on first call"""
+    global _face_recognition
+    if _face_recognition is None:
+        with _import_lock:
+            if _face_recognition is None:
+                started = time.perf_counter()
+                import face_recognition
+                _face_recognition = face_recognition
+                print(f"✓ Face recognition models loaded ({(time.perf_counter() - started) * 1000.0:.0f} ms)")
+    return _face_recognition
+
 
 class FaceRecognitionEngine:
     """Face Recognition Engine using face_recognition library"""
@@ -21,44 +43,316 @@ class FaceRecognitionEngine:
     def __init__(self):
         self.tolerance = float(os.getenv('FACE_RECOGNITION_TOLERANCE', 0.6))
         self.model = os.getenv('FACE_RECOGNITION_MODEL', 'hog')  # 'hog' or 'cnn'
+        # Fraction of the hinted box size added on each side before detection
+        self.hint_padding = float(os.getenv('FACE_HINT_PADDING', 0.3))
+        
+        # Matching: accept only if the best distance is within the (branch)
+        # threshold and the runner-up is at least match_margin further away
+        self.match_top_k = int(os.getenv('FACE_MATCH_TOP_K', 5))
+        self.match_margin = float(os.getenv('FACE_MATCH_MARGIN', 0.05))
+        self.branch_thresholds = self._load_branch_thresholds(
+            os.getenv('FACE_BRANCH_THRESHOLDS_FILE', 'branch_thresholds.json')
+        )
+        match_log_path = os.getenv('FACE_MATCH_LOG', 'logs/match_distances.jsonl')
+        self.match_log = MatchDistanceLog(
+            match_log_path,
+            max_bytes=int(os.getenv('FACE_MATCH_LOG_MAX_BYTES', 64 * 1024 * 1024)),
+            max_files=int(os.getenv('FACE_MATCH_LOG_MAX_FILES', 5))
+        ) if match_log_path else None
+        
+        # Quality gate run before encoding, so poor captures fail fast
+        self.quality_gate = os.getenv('FACE_QUALITY_GATE', 'true').lower() in ('1', 'true', 'yes')
+        self.min_face_size = int(os.getenv('FACE_MIN_SIZE', 60))
+        self.min_blur_score = float(os.getenv('FACE_MIN_BLUR_SCORE', 40.0))
+        self.min_brightness = float(os.getenv('FACE_MIN_BRIGHTNESS', 40.0))
+        self.max_brightness = float(os.getenv('FACE_MAX_BRIGHTNESS', 220.0))
+        self.max_clipped_fraction = float(os.getenv('FACE_MAX_CLIPPED_FRACTION', 0.4))
+        self.max_yaw = float(os.getenv('FACE_MAX_YAW', 0.35))
+        
+        # When nothing is found upright, search rotated copies of the frame
+        # downscaled to rotation_probe_side for a sideways or upside-down face
+        self.rotation_fallback = os.getenv('FACE_ROTATION_FALLBACK', 'true').lower() in ('1', 'true', 'yes')
+        self.rotation_probe_side = int(os.getenv('FACE_ROTATION_PROBE_SIDE', 480))
+        
+        # Encoding profiles: a fast one for RECOGNIZE and a high-quality,
+        # multi-jitter one for one-time REGISTER
+        self.profiles = {
+            'recognize': {
+                # 'large' (68-point, same landmarks as REGISTER) or opt-in 'small' (5-point, faster)
+                'landmark_model': os.getenv('FACE_RECOGNIZE_LANDMARK_MODEL', 'large'),
+                'num_jitters': int(os.getenv('FACE_RECOGNIZE_JITTERS', 1)),
+                'upsample': int(os.getenv('FACE_RECOGNIZE_UPSAMPLE', 1)),
+            },
+            'register': {
+                'landmark_model': os.getenv('FACE_REGISTER_LANDMARK_MODEL', 'large'),
+                'num_jitters': int(os.getenv('FACE_REGISTER_JITTERS', 5)),
+                'upsample': int(os.getenv('FACE_REGISTER_UPSAMPLE', 1)),
+            },
+        }
+        self._profile_stats = {
+            name: {'count': 0, 'detect_ms': 0.0, 'encode_ms': 0.0, 'max_total_ms': 0.0, 'rotation_attempts': 0, 'rotation_rescues': 0}
+            for name in self.profiles
+        }
+        self._stats_lock = threading.Lock()
+        self.warmed_up = False
         print(f"✓ Face Recognition Engine initialized (tolerance: {self.tolerance}, model: {self.model})")
+        print(f"  Encoding profiles: {self.profiles}")
+    
+    def warm_up(self) -> Dict[str, float]:
+        """
+        Load the models and run one dummy inference per encoding profile, so
+        the first real request does not pay for model loading
+        Returns: milliseconds spent on each step
+        """
+        timings = {}
+        started = time.perf_counter()
+        api = _load_face_recognition()
+        timings['load_ms'] = (time.perf_counter() - started) * 1000.0
+        
+        # Textured dummy frame so detection runs the full HOG pyramid
+        dummy = np.random.default_rng(0).integers(0, 256, size=(240, 240, 3), dtype=np.uint8)
+        
+        started = time.perf_counter()
+        api.face_locations(dummy, number_of_times_to_upsample=self.profiles['recognize']['upsample'], model=self.model)
+        timings['detect_ms'] = (time.perf_counter() - started) * 1000.0
+        
+        for name, settings in self.profiles.items():
+            started = time.perf_counter()
+            api.face_encodings(dummy, [(40, 200, 200, 40)], num_jitters=1, model=settings['landmark_model'])
+            timings[f'encode_{name}_ms'] = (time.perf_counter() - started) * 1000.0
+        
+        self.warmed_up = True
+        print(f"✓ Face engine warmed up: " + ", ".join(f"{step} {ms:.0f}" for step, ms in timings.items()))
+        return timings
+    
+    def _load_branch_thresholds(self, path: str) -> Dict[str, float]:
+        """Load per-branch thresholds written by calibrate_thresholds.py"""
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                thresholds = {branch: float(value) for branch, value in json.load(f).items()}
+            print(f"✓ Loaded match thresholds for {len(thresholds)} branches from {path}")
+            return thresholds
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"⚠ Ignoring branch thresholds file {path}: {e}")
+            return {}
+    
+    def threshold_for(self, branch_id: Optional[str]) -> float:
+        """Match threshold for a branch, falling back to the global tolerance"""
+        return self.branch_thresholds.get(branch_id, self.tolerance)
     
     def decode_image_from_base64(self, base64_string: str) -> np.ndarray:
-        """Decode base64 string to image array"""
+        """Decode base64 string to an upright, contiguous RGB image array (EXIF orientation applied)"""
         try:
             # Remove data URL prefix if present
             if ',' in base64_string:
                 base64_string = base64_string.split(',')[1]
             
-            # Decode base64
-            image_data = base64.b64decode(base64_string)
-            
-            # Convert to PIL Image
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Convert to numpy array
-            image_array = np.array(image)
-            
-            return image_array
+            return decode_image(base64.b64decode(base64_string))
             
         except Exception as e:
             raise Exception(f"Failed to decode image: {str(e)}")
     
-    def detect_and_extract_face_encoding(self, image_array: np.ndarray) -> Tuple[Optional[np.ndarray], str]:
+    def _padded_roi(self, face_box, image_shape) -> Optional[Tuple[int, int, int, int]]:
         """
-        Detect face in image and extract encoding
-        Returns: (face_encoding, status_message)
+        Expand a client face box hint by hint_padding and clip it to the image
+        Returns: (top, right, bottom, left) or None if the hint is unusable
         """
         try:
-            # Detect faces
-            face_locations = face_recognition.face_locations(
+            if isinstance(face_box, dict):
+                top, right, bottom, left = (int(face_box[key]) for key in ('top', 'right', 'bottom', 'left'))
+            else:
+                top, right, bottom, left = (int(value) for value in face_box)
+        except (KeyError, TypeError, ValueError):
+            return None
+        
+        height, width = image_shape[:2]
+        if bottom <= top or right <= left:
+            return None
+        
+        pad_y = int((bottom - top) * self.hint_padding)
+        pad_x = int((right - left) * self.hint_padding)
+        top = max(0, top - pad_y)
+        left = max(0, left - pad_x)
+        bottom = min(height, bottom + pad_y)
+        right = min(width, right + pad_x)
+        
+        if bottom <= top or right <= left:
+            return None
+        return top, right, bottom, left
+    
+    def _profile(self, profile: str) -> Dict:
+        if profile not in self.profiles:
+            raise ValueError(f"Unknown encoding profile: {profile}")
+        return self.profiles[profile]
+    
+    def _record_profile_latency(self, profile: str, detect_ms: float, encode_ms: float):
+        """Accumulate per-profile stage latencies"""
+        with self._stats_lock:
+            stats = self._profile_stats[profile]
+            stats['count'] += 1
+            stats['detect_ms'] += detect_ms
+            stats['encode_ms'] += encode_ms
+            stats['max_total_ms'] = max(stats['max_total_ms'], detect_ms + encode_ms)
+    
+    def _record_rotation(self, profile: str, rescued: bool):
+        with self._stats_lock:
+            stats = self._profile_stats[profile]
+            stats['rotation_attempts'] += 1
+            stats['rotation_rescues'] += int(rescued)
+    
+    def get_profile_stats(self) -> Dict[str, Dict]:
+        """Average detection and encoding latency per encoding profile"""
+        with self._stats_lock:
+            result = {}
+            for name, stats in self._profile_stats.items():
+                count = stats['count']
+                result[name] = dict(self.profiles[name])
+                result[name].update({
+                    'count': count,
+                    'avg_detect_ms': round(stats['detect_ms'] / count, 2) if count else 0.0,
+                    'avg_encode_ms': round(stats['encode_ms'] / count, 2) if count else 0.0,
+                    'max_total_ms': round(stats['max_total_ms'], 2),
+                    'rotation_attempts': stats['rotation_attempts'],
+                    'rotation_rescues': stats['rotation_rescues']
+                })
+            return result
+    
+    def locate_faces(self, image_array: np.ndarray, face_box=None, face_crop: bool = False, profile: str = 'recognize') -> List[Tuple[int, int, int, int]]:
+        """
+        Find face locations, using the client hint to avoid full-frame detection
+        
+        Hints are untrusted: a face must still be detected by the server inside
+        the hinted region, otherwise detection falls back to the full frame.
+        """
+        upsample = self._profile(profile)['upsample']
+        
+        if face_box is not None:
+            roi = self._padded_roi(face_box, image_array.shape)
+            if roi is not None:
+                roi_top, roi_right, roi_bottom, roi_left = roi
+                roi_array = np.ascontiguousarray(image_array[roi_top:roi_bottom, roi_left:roi_right])
+                roi_locations = _load_face_recognition().face_locations(
+                    roi_array,
+                    number_of_times_to_upsample=upsample,
+                    model=self.model
+                )
+                if roi_locations:
+                    return [
+                        (top + roi_top, right + roi_left, bottom + roi_top, left + roi_left)
+                        for top, right, bottom, left in roi_locations
+                    ]
+            print("⚠ Face box hint rejected, falling back to full-frame detection")
+        
+        face_locations = _load_face_recognition().face_locations(
+            image_array,
+            number_of_times_to_upsample=upsample,
+            model=self.model
+        )
+        
+        if len(face_locations) == 0 and face_crop:
+            # Tight client crops leave little context for HOG; upsampling a
+            # small crop one more level is still much cheaper than a full frame
+            face_locations = _load_face_recognition().face_locations(
                 image_array,
+                number_of_times_to_upsample=upsample + 1,
                 model=self.model
             )
+        
+        return face_locations
+    
+    def find_rotation(self, image_array: np.ndarray, profile: str = 'recognize') -> int:
+        """
+        Quarter turns (np.rot90 k) after which a face is detectable, or 0
+        Only a copy downscaled to rotation_probe_side is rotated and searched,
+        so a frame with no face at all costs three small detections.
+        """
+        probe = downscaled(image_array, self.rotation_probe_side)
+        upsample = self._profile(profile)['upsample']
+        for turns in FALLBACK_TURNS:
+            if _load_face_recognition().face_locations(rotated(probe, turns), number_of_times_to_upsample=upsample, model=self.model):
+                return turns
+        return 0
+    
+    def assess_face_quality(self, image_array: np.ndarray, face_location: Tuple[int, int, int, int]) -> Tuple[str, Dict[str, float]]:
+        """
+        Cheap quality checks on a detected face, cheapest first
+        Returns: (status, scores) where status is "OK" or the rejection code
+        """
+        top, right, bottom, left = face_location
+        scores = {'face_size': float(min(bottom - top, right - left))}
+        
+        if scores['face_size'] < self.min_face_size:
+            return "FACE_TOO_SMALL", scores
+        
+        face_gray = face_crop_gray(image_array, face_location)
+        scores['blur'] = round(blur_score(face_gray), 1)
+        scores['brightness'], clipped = exposure_scores(face_gray)
+        scores['brightness'] = round(scores['brightness'], 1)
+        scores['clipped'] = round(clipped, 3)
+        
+        if scores['blur'] < self.min_blur_score:
+            return "FACE_TOO_BLURRY", scores
+        
+        if (scores['brightness'] < self.min_brightness
+                or scores['brightness'] > self.max_brightness
+                or scores['clipped'] > self.max_clipped_fraction):
+            return "POOR_LIGHTING", scores
+        
+        # 5-point landmarks are enough for a yaw estimate and cost far less than encoding
+        landmarks = _load_face_recognition().face_landmarks(image_array, [face_location], model='small')
+        yaw = yaw_score(landmarks[0]) if landmarks else None
+        if yaw is not None:
+            scores['yaw'] = round(yaw, 3)
+            if yaw > self.max_yaw:
+                return "FACE_NOT_FRONTAL", scores
+        
+        return "OK", scores
+    
+    def _passes_quality_gate(self, image_array: np.ndarray, face_location: Tuple[int, int, int, int]) -> str:
+        """Run the quality gate if enabled and log the scores for threshold tuning"""
+        if not self.quality_gate:
+            return "OK"
+        
+        status, scores = self.assess_face_quality(image_array, face_location)
+        print(f"📊 Face quality {status}: {scores}")
+        return status
+    
+    def detect_and_extract_face_encoding(self, image_array: np.ndarray, face_box=None, face_crop: bool = False, profile: str = 'recognize', timings: Optional[Dict[str, float]] = None) -> Tuple[Optional[np.ndarray], str]:
+        """
+        Detect face in image and extract encoding
+        Args:
+            image_array: RGB image array (full frame or client-side face crop)
+            face_box: Optional (top, right, bottom, left) hint from the client
+            face_crop: True if the client already cropped the image to the face
+            profile: Encoding profile, 'recognize' (fast) or 'register' (high quality)
+            timings: Optional dict that receives 'detect_ms', 'quality_ms' and 'encode_ms'
+                ('rotation_ms' as well when the rotation fallback ran)
+        Returns: (face_encoding, status_message)
+        """
+        if timings is None:
+            timings = {}
+        try:
+            settings = self._profile(profile)
+            
+            # Detect faces
+            detect_started = time.perf_counter()
+            face_locations = self.locate_faces(image_array, face_box, face_crop, profile)
+            
+            if len(face_locations) == 0 and self.rotation_fallback:
+                # Sideways or upside-down capture without EXIF orientation
+                rotation_started = time.perf_counter()
+                turns = self.find_rotation(image_array, profile)
+                if turns:
+                    image_array = rotated(image_array, turns)
+                    face_locations = self.locate_faces(image_array, face_crop=face_crop, profile=profile)
+                    print(f"⚠ Face found after rotating the frame {turns * 90}° counter-clockwise")
+                self._record_rotation(profile, len(face_locations) > 0)
+                timings['rotation_ms'] = (time.perf_counter() - rotation_started) * 1000.0
+            
+            detect_ms = (time.perf_counter() - detect_started) * 1000.0
+            timings['detect_ms'] = detect_ms
             
             if len(face_locations) == 0:
                 return None, "NO_FACE_DETECTED"
@@ -78,11 +372,22 @@ class FaceRecognitionEngine:
             else:
                 face_location = face_locations[0]
             
+            quality_started = time.perf_counter()
+            quality_status = self._passes_quality_gate(image_array, face_location)
+            timings['quality_ms'] = (time.perf_counter() - quality_started) * 1000.0
+            if quality_status != "OK":
+                return None, quality_status
+            
             # Extract face encoding
-            face_encodings = face_recognition.face_encodings(
+            encode_started = time.perf_counter()
+            face_encodings = _load_face_recognition().face_encodings(
                 image_array,
-                [face_location]
+                [face_location],
+                num_jitters=settings['num_jitters'],
+                model=settings['landmark_model']
             )
+            timings['encode_ms'] = (time.perf_counter() - encode_started) * 1000.0
+            self._record_profile_latency(profile, detect_ms, timings['encode_ms'])
             
             if len(face_encodings) == 0:
                 return None, "FACE_ENCODING_FAILED"
@@ -94,6 +399,64 @@ class FaceRecognitionEngine:
         except Exception as e:
             raise Exception(f"Face detection error: {str(e)}")
     
+    def encode_face_locations(self, image_array: np.ndarray, face_locations: List[Tuple[int, int, int, int]], profile: str = 'recognize') -> List[np.ndarray]:
+        """Encode already-located faces in one batched call (no detection)"""
+        if not face_locations:
+            return []
+        
+        settings = self._profile(profile)
+        encode_started = time.perf_counter()
+        face_encodings = _load_face_recognition().face_encodings(
+            image_array,
+            face_locations,
+            num_jitters=settings['num_jitters'],
+            model=settings['landmark_model']
+        )
+        self._record_profile_latency(profile, 0.0, (time.perf_counter() - encode_started) * 1000.0)
+        return face_encodings
+    
+    def detect_and_extract_all_face_encodings(self, image_array: np.ndarray, profile: str = 'recognize') -> Tuple[List[Tuple[int, int, int, int]], List[np.ndarray], str]:
+        """
+        Detect every face in image and extract all encodings in one batched call
+        Faces that fail the quality gate are left out.
+        Returns: (face_locations, face_encodings, status_message)
+        """
+        try:
+            settings = self._profile(profile)
+            
+            detect_started = time.perf_counter()
+            face_locations = self.locate_faces(image_array, profile=profile)
+            detect_ms = (time.perf_counter() - detect_started) * 1000.0
+            
+            if len(face_locations) == 0:
+                return [], [], "NO_FACE_DETECTED"
+            
+            # Only faces that pass the quality gate are encoded
+            quality = [self._passes_quality_gate(image_array, location) for location in face_locations]
+            passed = [location for location, status in zip(face_locations, quality) if status == "OK"]
+            if not passed:
+                # Report why the largest face was rejected
+                sizes = [(bottom - top) * (right - left) for top, right, bottom, left in face_locations]
+                return [], [], quality[int(np.argmax(sizes))]
+            face_locations = passed
+            
+            encode_started = time.perf_counter()
+            face_encodings = _load_face_recognition().face_encodings(
+                image_array,
+                face_locations,
+                num_jitters=settings['num_jitters'],
+                model=settings['landmark_model']
+            )
+            self._record_profile_latency(profile, detect_ms, (time.perf_counter() - encode_started) * 1000.0)
+            
+            if len(face_encodings) != len(face_locations):
+                return [], [], "FACE_ENCODING_FAILED"
+            
+            return face_locations, face_encodings, "SUCCESS"
+            
+        except Exception as e:
+            raise Exception(f"Face detection error: {str(e)}")
+    
     def compare_faces(self, known_encodings: List[np.ndarray], face_encoding_to_check: np.ndarray) -> Tuple[Optional[int], float]:
         """
         Compare face encoding with known encodings
@@ -103,7 +466,7 @@ class FaceRecognitionEngine:
             return None, float('inf')
         
         # Calculate distances
-        distances = face_recognition.face_distance(
+        distances = _load_face_recognition().face_distance(
             known_encodings,
             face_encoding_to_check
         )
@@ -114,50 +477,223 @@ class FaceRecognitionEngine:
         
         return best_match_idx, best_distance
     
-    def recognize_face(self, image_base64: str, known_customers: List[Dict]) -> Tuple[Optional[int], float, str]:
+    def match_encodings(self, gallery: FaceGallery, probes: np.ndarray, branch_id: Optional[str] = None) -> List[Dict]:
+        """
+        Top-k search and accept decision for each probe, in one vectorized pass
+        Returns one dict per probe with 'index' (accepted gallery row or None),
+        'customer_id' and 'customer_name' (None unless accepted), 'distance',
+        'runner_up' and 'candidates' [(row, distance), ...]
+        """
+        indices, distances = gallery.top_k(probes, max(2, self.match_top_k))
+        threshold = self.threshold_for(branch_id)
+        
+        matches = []
+        for row_indices, row_distances in zip(indices, distances):
+            best = float(row_distances[0])
+            runner_up = float(row_distances[1]) if len(row_distances) > 1 else None
+            accepted = self._accept_match(best, runner_up, threshold, branch_id)
+            
+            customer_id, customer_name = gallery.customer_at(int(row_indices[0])) if accepted else (None, None)
+            matches.append({
+                'index': int(row_indices[0]) if accepted else None,
+                'customer_id': customer_id,
+                'customer_name': customer_name,
+                'distance': best,
+                'runner_up': runner_up,
+                'candidates': [(int(index), float(distance)) for index, distance in zip(row_indices, row_distances)]
+            })
+        
+        return matches
+    
+    def _accept_match(self, best: float, runner_up: Optional[float], threshold: float, branch_id: Optional[str]) -> bool:
+        """Threshold and runner-up margin decision for one probe, logged for calibration"""
+        within_threshold = best <= threshold
+        clear_margin = runner_up is None or (runner_up - best) >= self.match_margin
+        accepted = within_threshold and clear_margin
+        
+        if within_threshold and not clear_margin:
+            print(f"⚠ Ambiguous match rejected (best {best:.3f}, runner-up {runner_up:.3f})")
+        
+        if self.match_log is not None:
+            self.match_log.record(branch_id, best, runner_up, accepted)
+        
+        return accepted
+    
+    def match_candidates(self, candidates: List[List[Tuple[int, float, Optional[str]]]], branch_id: Optional[str] = None) -> List[Dict]:
+        """
+        Accept decision over already merged top-k candidates, one list per
+        probe of (customer_id, distance, name) nearest first, as gathered
+        from remote shards. Returns the same dicts as match_encodings, with
+        'index' always None since there is no local gallery row.
+        """
+        threshold = self.threshold_for(branch_id)
+        
+        matches = []
+        for probe_candidates in candidates:
+            if not probe_candidates:
+                matches.append({
+                    'index': None, 'customer_id': None, 'customer_name': None,
+                    'distance': float('inf'), 'runner_up': None, 'candidates': []
+                })
+                continue
+            
+            best_id, best, best_name = probe_candidates[0]
+            runner_up = probe_candidates[1][1] if len(probe_candidates) > 1 else None
+            accepted = self._accept_match(best, runner_up, threshold, branch_id)
+            
+            matches.append({
+                'index': None,
+                'customer_id': best_id if accepted else None,
+                'customer_name': best_name if accepted else None,
+                'distance': best,
+                'runner_up': runner_up,
+                'candidates': [(customer_id, distance) for customer_id, distance, _ in probe_candidates]
+            })
+        
+        return matches
+    
+    def search_gallery(self, gallery: Union[FaceGallery, ShardedGallery], probes: np.ndarray, branch_id: Optional[str] = None) -> List[Dict]:
+        """
+        Match probes against a gallery (see match_encodings)
+        For a ShardedGallery the branch's local shard is searched first and
+        only the probes it misses are searched in the global gallery. A
+        RemoteGallery is searched by its shard nodes and only the decision
+        is made here.
+        """
+        probes = np.atleast_2d(probes)
+        if isinstance(gallery, RemoteGallery):
+            return self.match_candidates(gallery.search_candidates(probes, max(2, self.match_top_k)), branch_id)
+        
+        if not isinstance(gallery, ShardedGallery):
+            return self.match_encodings(gallery, probes, branch_id)
+        
+        shard = gallery.shard_for(branch_id)
+        if shard is None:
+            gallery.stats.record('no_local_shard', len(probes))
+            matches = self.match_encodings(gallery.global_gallery, probes, branch_id)
+            hits = sum(1 for match in matches if match['customer_id'] is not None)
+            gallery.stats.record('global_hits', hits)
+            gallery.stats.record('misses', len(matches) - hits)
+            return matches
+        
+        matches = self.match_encodings(shard, probes, branch_id)
+        missed = [i for i, match in enumerate(matches) if match['customer_id'] is None]
+        gallery.stats.record('local_hits', len(matches) - len(missed))
+        
+        if missed and len(gallery.global_gallery) > len(shard):
+            fallback = self.match_encodings(gallery.global_gallery, probes[missed], branch_id)
+            for i, match in zip(missed, fallback):
+                matches[i] = match
+            hits = sum(1 for match in fallback if match['customer_id'] is not None)
+            gallery.stats.record('global_hits', hits)
+            gallery.stats.record('misses', len(fallback) - hits)
+        else:
+            gallery.stats.record('misses', len(missed))
+        
+        return matches
+    
+    def recognize_face(self, image_base64: str, known_customers: Union[FaceGallery, ShardedGallery, List[Dict]], face_box=None, face_crop: bool = False, branch_id: Optional[str] = None, timings: Optional[Dict[str, float]] = None) -> Tuple[Optional[int], float, str]:
         """
         Recognize face from base64 image
         Args:
             image_base64: Base64 encoded image string
-            known_customers: List of customer dicts with 'customer_id' and 'face_encoding'
+            known_customers: FaceGallery, ShardedGallery or list of customer dicts with 'customer_id' and 'face_encoding'
+            face_box: Optional client face box hint (see detect_and_extract_face_encoding)
+            face_crop: True if the image is a client-side face crop
+            branch_id: Branch the image comes from, selects the match threshold
+            timings: Optional dict that receives per-stage latencies in ms
+                ('decode_ms', 'detect_ms', 'quality_ms', 'encode_ms', 'match_ms')
         Returns:
             (customer_id, distance, status_message)
         """
+        if timings is None:
+            timings = {}
         try:
             # Decode image
+            decode_started = time.perf_counter()
             image_array = self.decode_image_from_base64(image_base64)
+            timings['decode_ms'] = (time.perf_counter() - decode_started) * 1000.0
             
             # Extract face encoding
-            face_encoding, status = self.detect_and_extract_face_encoding(image_array)
+            face_encoding, status = self.detect_and_extract_face_encoding(image_array, face_box, face_crop, timings=timings)
             
             if face_encoding is None:
                 return None, float('inf'), status
             
             # Prepare known encodings
-            known_encodings = []
-            customer_ids = []
-            
-            for customer in known_customers:
-                # Convert list to numpy array if needed
-                encoding = customer['face_encoding']
-                if isinstance(encoding, list):
-                    encoding = np.array(encoding)
-                known_encodings.append(encoding)
-                customer_ids.append(customer['customer_id'])
+            gallery = self._as_gallery(known_customers)
+            if len(gallery) == 0:
+                return None, float('inf'), "NOT_RECOGNIZED"
             
             # Compare faces
-            best_match_idx, distance = self.compare_faces(known_encodings, face_encoding)
+            match_started = time.perf_counter()
+            match = self.search_gallery(gallery, face_encoding, branch_id)[0]
+            timings['match_ms'] = (time.perf_counter() - match_started) * 1000.0
             
-            if best_match_idx is not None and distance <= self.tolerance:
-                customer_id = customer_ids[best_match_idx]
-                return customer_id, distance, "RECOGNIZED"
+            if match['customer_id'] is not None:
+                return match['customer_id'], match['distance'], "RECOGNIZED"
             else:
-                return None, distance, "NOT_RECOGNIZED"
+                return None, match['distance'], "NOT_RECOGNIZED"
                 
         except Exception as e:
             raise Exception(f"Recognition error: {str(e)}")
+    
+    def recognize_faces(self, image_base64: str, known_customers: Union[FaceGallery, ShardedGallery, List[Dict]], branch_id: Optional[str] = None) -> Tuple[List[Dict], str]:
+        """
+        Recognize every face in a base64 image
+        Args:
+            image_base64: Base64 encoded image string
+            known_customers: FaceGallery, ShardedGallery or list of customer dicts
+            branch_id: Branch the image comes from, selects the match threshold
+        Returns:
+            (faces, status_message) where each face is a dict with
+            'face_box', 'customer_id', 'customer_name' and 'distance'
+        """
+        try:
+            image_array = self.decode_image_from_base64(image_base64)
+            
+            face_locations, face_encodings, status = self.detect_and_extract_all_face_encodings(image_array)
+            if status != "SUCCESS":
+                return [], status
+            
+            gallery = self._as_gallery(known_customers)
+            faces = [
+                {'face_box': list(location), 'customer_id': None, 'customer_name': None, 'distance': None}
+                for location in face_locations
+            ]
+            
+            if len(gallery) == 0:
+                return faces, "SUCCESS"
+            
+            # All probes against the whole gallery in one matrix operation
+            matches = self.search_gallery(gallery, np.vstack(face_encodings), branch_id)
+            
+            for face, match in zip(faces, matches):
+                face['distance'] = match['distance']
+                face['customer_id'], face['customer_name'] = match['customer_id'], match['customer_name']
+            
+            return faces, "SUCCESS"
+            
+        except Exception as e:
+            raise Exception(f"Recognition error: {str(e)}")
+    
+    def _as_gallery(self, known_customers: Union[FaceGallery, ShardedGallery, List[Dict]]) -> Union[FaceGallery, ShardedGallery]:
+        """Accept either a prebuilt gallery or a list of customer dicts"""
+        if isinstance(known_customers, (FaceGallery, ShardedGallery, RemoteGallery)):
+            return known_customers
+        return FaceGallery(known_customers)
+
+
+_engine = None
+_engine_lock = threading.Lock()
 
 
-# Global instance
-face_engine = FaceRecognitionEngine()
+def get_face_engine() -> FaceRecognitionEngine:
+    """Shared engine, constructed on first use (models load on first inference or warm_up)"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = FaceRecognitionEngine()
+    return _engine
 
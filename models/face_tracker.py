@@ -0,0 +1,86 @@
+"""
+Face Tracker
+Cheap frame-to-frame face box tracking with normalized template matching
+"""
+
+import cv2
+import numpy as np
+from typing import Tuple
+
+Box = Tuple[int, int, int, int]  # (top, right, bottom, left)
+
+MIN_TEMPLATE_SIZE = 4
+
+
+def box_iou(box_a: Box, box_b: Box) -> float:
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    top = max(box_a[0], box_b[0])
+    right = min(box_a[1], box_b[1])
+    bottom = min(box_a[2], box_b[2])
+    left = max(box_a[3], box_b[3])
+
+    intersection = max(0, bottom - top) * max(0, right - left)
+    if intersection == 0:
+        return 0.0
+
+    area_a = (box_a[2] - box_a[0]) * (box_a[1] - box_a[3])
+    area_b = (box_b[2] - box_b[0]) * (box_b[1] - box_b[3])
+    return intersection / float(area_a + area_b - intersection)
+
+
+class FaceTracker:
+    """Follow one face box across grayscale frames"""
+
+    def __init__(self, frame_gray: np.ndarray, face_box: Box, search_margin: float = 0.5, refresh_confidence: float = 0.9):
+        # Fraction of the box size searched around the previous position
+        self.search_margin = search_margin
+        # Template is refreshed from the new position only on strong matches,
+        # so weak matches cannot make the tracker drift onto the background
+        self.refresh_confidence = refresh_confidence
+        self.reset(frame_gray, face_box)
+
+    def reset(self, frame_gray: np.ndarray, face_box: Box):
+        """Re-anchor the tracker on a freshly detected box"""
+        top, right, bottom, left = face_box
+        self.box = face_box
+        self.template = frame_gray[top:bottom, left:right].copy()
+        self.confidence = 1.0
+
+    def update(self, frame_gray: np.ndarray) -> Tuple[Box, float]:
+        """
+        Locate the face in a new frame near its previous position
+        Returns: (box, confidence) with confidence in [-1, 1]
+        """
+        template_height, template_width = self.template.shape[:2]
+        if template_height < MIN_TEMPLATE_SIZE or template_width < MIN_TEMPLATE_SIZE:
+            self.confidence = 0.0
+            return self.box, self.confidence
+
+        frame_height, frame_width = frame_gray.shape[:2]
+        top, right, bottom, left = self.box
+        margin_y = int(template_height * self.search_margin)
+        margin_x = int(template_width * self.search_margin)
+
+        search_top = max(0, top - margin_y)
+        search_left = max(0, left - margin_x)
+        search_bottom = min(frame_height, bottom + margin_y)
+        search_right = min(frame_width, right + margin_x)
+        window = frame_gray[search_top:search_bottom, search_left:search_right]
+
+        if window.shape[0] < template_height or window.shape[1] < template_width:
+            # Face moved off the edge of the frame
+            self.confidence = 0.0
+            return self.box, self.confidence
+
+        scores = cv2.matchTemplate(window, self.template, cv2.TM_CCOEFF_NORMED)
+        _, max_score, _, (offset_x, offset_y) = cv2.minMaxLoc(scores)
+
+        new_top = search_top + offset_y
+        new_left = search_left + offset_x
+        self.box = (new_top, new_left + template_width, new_top + template_height, new_left)
+        self.confidence = float(max_score)
+
+        if self.confidence >= self.refresh_confidence:
+            self.template = frame_gray[new_top:new_top + template_height, new_left:new_left + template_width].copy()
+
+        return self.box, self.confidence
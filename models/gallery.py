@@ -0,0 +1,501 @@
+"""
+Face Gallery
+Known customer encodings stacked into a matrix for vectorized matching,
+optionally partitioned into per-branch shards
+"""
+
+import abc
+import copy
+import os
+import threading
+import numpy as np
+from collections import defaultdict
+from typing import Any, Callable, List, Dict, Optional, Tuple
+
+ENCODING_SIZE = 128
+
+# GALLERY_SEARCH_MODE values; 'exact' scans float64 encodings
+SEARCH_MODES = ('exact', 'float16', 'int8')
+
+# Rows per block in the quantized first pass (bounds the float32 temporary)
+SCAN_BLOCK_ROWS = 65536
+
+
+class QuantizedIndex:
+    """
+    PCA-projected, scalar-quantized copy of a gallery for a fast first pass
+    The projection is trained on the gallery's own encodings. int8 codes use
+    one symmetric scale per projected dimension; float16 codes are the
+    projected values rounded to half precision.
+    """
+
+    def __init__(self, encodings: np.ndarray, mode: str, dims: int):
+        if mode not in ('float16', 'int8'):
+            raise ValueError(f"Unknown quantization mode: {mode}")
+        self.mode = mode
+        encodings = np.asarray(encodings, dtype=np.float32)
+        self.mean = encodings.mean(axis=0)
+        centered = encodings - self.mean
+
+        # PCA needs clearly more samples than kept dimensions to be stable
+        if 0 < dims < encodings.shape[1] and len(encodings) >= 2 * dims:
+            covariance = (centered.T @ centered) / len(encodings)
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+            order = np.argsort(eigenvalues)[::-1][:dims]
+            self.components = np.ascontiguousarray(eigenvectors[:, order], dtype=np.float32)
+            self.explained_variance = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+            projected = centered @ self.components
+        else:
+            self.components = None
+            self.explained_variance = 1.0
+            projected = centered
+
+        if mode == 'int8':
+            self.scales = np.maximum(np.abs(projected).max(axis=0), 1e-12).astype(np.float32) / 127.0
+            self.codes = np.clip(np.rint(projected / self.scales), -127, 127).astype(np.int8)
+            reconstructed = self.codes.astype(np.float32) * self.scales
+        else:
+            self.scales = None
+            self.codes = projected.astype(np.float16)
+            reconstructed = self.codes.astype(np.float32)
+        self.code_norms = np.einsum('ij,ij->i', reconstructed, reconstructed)
+
+    @property
+    def dims(self) -> int:
+        return self.codes.shape[1]
+
+    def project(self, probes: np.ndarray) -> np.ndarray:
+        projected = np.asarray(probes, dtype=np.float32) - self.mean
+        return projected @ self.components if self.components is not None else projected
+
+    def approximate_squared_distances(self, probes: np.ndarray) -> np.ndarray:
+        """Squared distances to every row in the quantized space, shape (num_probes, size)"""
+        projected = self.project(probes)
+        # (p * s) . c == p . (s * c): scale the probe once instead of every code
+        weighted = projected * self.scales if self.scales is not None else projected
+        probe_norms = np.einsum('ij,ij->i', projected, projected)
+
+        squared = np.empty((len(projected), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), SCAN_BLOCK_ROWS):
+            block = self.codes[start:start + SCAN_BLOCK_ROWS].astype(np.float32)
+            squared[:, start:start + len(block)] = weighted @ block.T
+        squared *= -2.0
+        squared += probe_norms[:, None]
+        squared += self.code_norms[None, :]
+        return squared
+
+    def nbytes(self) -> int:
+        total = self.codes.nbytes + self.code_norms.nbytes + self.mean.nbytes
+        if self.components is not None:
+            total += self.components.nbytes
+        if self.scales is not None:
+            total += self.scales.nbytes
+        return total
+
+
+class _RowBuffer:
+    """
+    Encoding rows shared by successive snapshots of one gallery
+    Rows below `used` belong to published snapshots and are never rewritten;
+    appends only fill the spare capacity above them.
+    """
+
+    def __init__(self, encodings: np.ndarray, customer_ids: List[int], names: List[Optional[str]], capacity: int):
+        size = len(encodings)
+        self.encodings = np.empty((max(capacity, size), ENCODING_SIZE), dtype=encodings.dtype)
+        self.encodings[:size] = encodings
+        self.squared_norms = np.empty(len(self.encodings), dtype=encodings.dtype)
+        self.squared_norms[:size] = np.einsum('ij,ij->i', encodings, encodings)
+        self.customer_ids = list(customer_ids)
+        self.names = list(names)
+        self.rows = {customer_id: row for row, customer_id in enumerate(self.customer_ids)}
+        self.used = size
+        self.lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return len(self.encodings)
+
+    def nbytes(self) -> int:
+        return self.encodings.nbytes + self.squared_norms.nbytes
+
+
+class FaceGallery:
+    """
+    Immutable snapshot of known face encodings with their customer ids
+    A snapshot sees the first `size` rows of a row buffer, so readers never
+    lock. with_customer() returns a new snapshot one row longer: the row is
+    written into the buffer's spare capacity (past every row an existing
+    snapshot can see), and only a full buffer is copied, with 50% growth so
+    appends stay amortized O(1). without_customer() tombstones a row (it is
+    never matched) and compacted() drops tombstoned rows. customer_ids and
+    names may be longer than the snapshot; only rows below `size` belong to it.
+    """
+
+    def __init__(self, customers: List[Dict], search_mode: Optional[str] = None):
+        customer_ids = [customer['customer_id'] for customer in customers]
+        names = [customer.get('name') for customer in customers]
+
+        if customers:
+            encodings = np.vstack([
+                np.asarray(customer['face_encoding'], dtype=np.float64)
+                for customer in customers
+            ])
+        else:
+            encodings = np.empty((0, ENCODING_SIZE), dtype=np.float64)
+
+        # Compressed search: quantized first pass, float32 re-rank of the best candidates
+        self.search_mode = (search_mode or os.getenv('GALLERY_SEARCH_MODE', 'exact')).lower()
+        if self.search_mode not in SEARCH_MODES:
+            raise ValueError(f"GALLERY_SEARCH_MODE must be one of {', '.join(SEARCH_MODES)}")
+        self.rerank_candidates = int(os.getenv('GALLERY_RERANK_CANDIDATES', 32))
+        self.quantize_min_size = int(os.getenv('GALLERY_QUANTIZE_MIN_SIZE', 1000))
+        self.pca_dims = int(os.getenv('GALLERY_PCA_DIMS', 64))
+        if self.search_mode != 'exact':
+            # The float64 matrix is only kept as float32 for re-ranking
+            encodings = encodings.astype(np.float32)
+
+        self.index = None
+        self.indexed_size = 0
+        self._set_tombstones(frozenset())
+        self._publish(_RowBuffer(encodings, customer_ids, names, len(encodings)), len(encodings))
+        self._build_index()
+
+    def _derive(self, buffer: _RowBuffer, size: int) -> 'FaceGallery':
+        """New snapshot with this one's settings, index and tombstones over a buffer"""
+        snapshot = object.__new__(FaceGallery)
+        snapshot.search_mode = self.search_mode
+        snapshot.rerank_candidates = self.rerank_candidates
+        snapshot.quantize_min_size = self.quantize_min_size
+        snapshot.pca_dims = self.pca_dims
+        snapshot.index = self.index
+        snapshot.indexed_size = self.indexed_size
+        snapshot._set_tombstones(self._tombstones)
+        snapshot._publish(buffer, size)
+        return snapshot
+
+    def _set_tombstones(self, rows: frozenset):
+        self._tombstones = rows
+        self._tombstone_rows = np.fromiter(sorted(rows), dtype=np.intp, count=len(rows))
+
+    def _publish(self, buffer: _RowBuffer, size: int):
+        """Point this snapshot at the first `size` rows of a buffer"""
+        self._buffer = buffer
+        self.size = size
+        self.customer_ids = buffer.customer_ids
+        self.names = buffer.names
+        self.encodings = buffer.encodings[:size]
+        # Squared norms are reused by every distance computation
+        self._squared_norms = buffer.squared_norms[:size]
+
+    def _build_index(self):
+        """(Re)train the quantized index over every row of this snapshot"""
+        if self.search_mode != 'exact' and self.size >= self.quantize_min_size:
+            self.index = QuantizedIndex(self.encodings, self.search_mode, self.pca_dims)
+            self.indexed_size = self.size
+
+    def __len__(self) -> int:
+        """Live customers (tombstoned rows excluded)"""
+        return self.size - len(self._tombstones)
+
+    def __contains__(self, customer_id: int) -> bool:
+        row = self._buffer.rows.get(customer_id)
+        return row is not None and row < self.size and row not in self._tombstones
+
+    @property
+    def tombstones(self) -> int:
+        return len(self._tombstones)
+
+    def with_customer(self, customer: Dict) -> 'FaceGallery':
+        """
+        New snapshot that also contains the customer; this one is unchanged
+        Rows appended after the quantized index was trained are searched
+        exactly; the index is retrained once they exceed 1/16 of it.
+        """
+        if customer['customer_id'] in self:
+            return self
+        encoding = np.asarray(customer['face_encoding'], dtype=self.encodings.dtype)
+        buffer = self._buffer
+
+        with buffer.lock:
+            if buffer.used != self.size or buffer.used == buffer.capacity:
+                # Full, or an older snapshot whose next row is already taken: copy with room to grow
+                buffer = _RowBuffer(
+                    self.encodings,
+                    self.customer_ids[:self.size],
+                    self.names[:self.size],
+                    self.size + max(self.size // 2, 64)
+                )
+            row = buffer.used
+            buffer.encodings[row] = encoding
+            buffer.squared_norms[row] = encoding @ encoding
+            buffer.customer_ids.append(customer['customer_id'])
+            buffer.names.append(customer.get('name'))
+            buffer.rows[customer['customer_id']] = row
+            buffer.used = row + 1
+
+        snapshot = self._derive(buffer, row + 1)
+        if snapshot.index is None or snapshot.size - snapshot.indexed_size > snapshot.indexed_size // 16:
+            snapshot._build_index()
+        return snapshot
+
+    def without_customer(self, customer_id: int) -> 'FaceGallery':
+        """New snapshot in which the customer's row is a tombstone; shares this one's buffer"""
+        if customer_id not in self:
+            return self
+        snapshot = self._derive(self._buffer, self.size)
+        snapshot._set_tombstones(self._tombstones | {self._buffer.rows[customer_id]})
+        return snapshot
+
+    def compacted(self) -> 'FaceGallery':
+        """New snapshot without tombstoned rows (matrix copied, quantized index retrained)"""
+        if not self._tombstones:
+            return self
+        live = np.setdiff1d(np.arange(self.size), self._tombstone_rows)
+        buffer = _RowBuffer(
+            self.encodings[live],
+            [self.customer_ids[row] for row in live],
+            [self.names[row] for row in live],
+            len(live)
+        )
+        snapshot = self._derive(buffer, len(live))
+        snapshot._set_tombstones(frozenset())
+        snapshot.index, snapshot.indexed_size = None, 0
+        snapshot._build_index()
+        return snapshot
+
+    def distances(self, probes: np.ndarray) -> np.ndarray:
+        """
+        Euclidean distances between probes and every gallery encoding
+        Returns: matrix of shape (num_probes, gallery_size)
+        """
+        probes = np.atleast_2d(np.asarray(probes, dtype=np.float64))
+        probe_norms = np.einsum('ij,ij->i', probes, probes)
+
+        # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, computed as one matrix product
+        squared = probe_norms[:, None] + self._squared_norms[None, :] - 2.0 * (probes @ self.encodings.T)
+        np.maximum(squared, 0.0, out=squared)
+        # Tombstoned rows never match
+        squared[:, self._tombstone_rows] = np.inf
+        return np.sqrt(squared, out=squared)
+
+    def best_matches(self, probes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the closest gallery entry for each probe
+        Returns: (best_indices, best_distances), one entry per probe
+        """
+        distances = self.distances(probes)
+        best_indices = np.argmin(distances, axis=1)
+        best_distances = distances[np.arange(len(best_indices)), best_indices]
+        return best_indices, best_distances
+
+    def top_k(self, probes: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k closest gallery entries for each probe, nearest first
+        Returns: (indices, distances), each of shape (num_probes, min(k, gallery_size))
+        """
+        if self.index is not None and max(k, self.rerank_candidates) < self.indexed_size:
+            return self._quantized_top_k(probes, k)
+
+        distances = self.distances(probes)
+        k = min(k, len(self))
+
+        if k < distances.shape[1]:
+            # Partial selection is O(n) per probe; only the k winners are sorted
+            candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(distances.shape[1]), distances.shape).copy()
+
+        candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+        order = np.argsort(candidate_distances, axis=1)
+        return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_distances, order, axis=1)
+
+    def _quantized_top_k(self, probes: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Shortlist by quantized distance, then exact float32 distances for the shortlist only"""
+        probes = np.atleast_2d(np.asarray(probes, dtype=np.float32))
+        k = min(k, len(self))
+        shortlist_size = max(k, self.rerank_candidates)
+        approximate = self.index.approximate_squared_distances(probes)
+        approximate[:, self._tombstone_rows[self._tombstone_rows < self.indexed_size]] = np.inf
+        shortlist = np.argpartition(approximate, shortlist_size - 1, axis=1)[:, :shortlist_size]
+        if self.size > self.indexed_size:
+            # Rows appended since the index was trained are always re-ranked
+            tail = np.arange(self.indexed_size, self.size)
+            shortlist = np.hstack([shortlist, np.broadcast_to(tail, (len(probes), len(tail)))])
+
+        differences = self.encodings[shortlist] - probes[:, None, :]
+        exact = np.sqrt(np.einsum('pkd,pkd->pk', differences, differences))
+        exact[np.isin(shortlist, self._tombstone_rows)] = np.inf
+        order = np.argsort(exact, axis=1)[:, :k]
+        return (
+            np.take_along_axis(shortlist, order, axis=1),
+            np.take_along_axis(exact, order, axis=1).astype(np.float64)
+        )
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """Bytes held for search: encoding buffer (float64, or float32 re-rank copy) plus the quantized index"""
+        usage = {
+            'search_mode': self.search_mode if self.index is not None else 'exact',
+            'size': len(self),
+            'tombstones': len(self._tombstones),
+            'capacity': self._buffer.capacity,
+            'encoding_bytes': int(self._buffer.nbytes()),
+            'index_bytes': int(self.index.nbytes()) if self.index is not None else 0,
+        }
+        if self.index is not None:
+            usage['index_dims'] = self.index.dims
+            usage['pca_explained_variance'] = round(self.index.explained_variance, 4)
+        usage['total_bytes'] = usage['encoding_bytes'] + usage['index_bytes']
+        return usage
+
+    def customer_at(self, index: int) -> Tuple[int, Optional[str]]:
+        """Get (customer_id, name) for a gallery row"""
+        return self.customer_ids[index], self.names[index]
+
+
+class ShardHitStats:
+    """Counts where sharded searches were resolved"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'local_hits': 0, 'global_hits': 0, 'misses': 0, 'no_local_shard': 0}
+
+    def record(self, outcome: str, count: int = 1):
+        with self._lock:
+            self._counts[outcome] += count
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            counts = dict(self._counts)
+        searches = counts['local_hits'] + counts['global_hits'] + counts['misses']
+        counts['local_hit_rate'] = round(counts['local_hits'] / searches, 4) if searches else 0.0
+        return counts
+
+
+class ShardedGallery:
+    """
+    Gallery partitioned by customer home branch
+    Searches go to the requesting branch's shard first and fall back to the
+    global gallery only on a miss. The global gallery can be loaded lazily,
+    so a branch server may keep only its own hot shard in memory.
+    """
+
+    def __init__(
+        self,
+        customers: List[Dict],
+        global_loader: Optional[Callable[[], FaceGallery]] = None,
+        stats: Optional[ShardHitStats] = None
+    ):
+        by_branch = defaultdict(list)
+        for customer in customers:
+            by_branch[customer.get('home_branch_id') or 'UNKNOWN'].append(customer)
+        self.shards = {branch_id: FaceGallery(members) for branch_id, members in by_branch.items()}
+
+        self._global = None if global_loader else FaceGallery(customers)
+        self._global_loader = global_loader
+        self._global_lock = threading.Lock()
+        self.stats = stats or ShardHitStats()
+
+    def __len__(self) -> int:
+        local_size = sum(len(shard) for shard in self.shards.values())
+        if self._global is None and local_size == 0:
+            # Nothing local: the global gallery decides whether anyone is known
+            return len(self.global_gallery)
+        if self._global is not None:
+            return len(self._global)
+        return local_size
+
+    def with_customer(self, customer: Dict) -> 'ShardedGallery':
+        """
+        New snapshot that also contains the customer; this one is unchanged
+        Only the customer's home shard and the global gallery (if loaded)
+        get a new snapshot; the other shards are shared.
+        """
+        branch_id = customer.get('home_branch_id') or 'UNKNOWN'
+        shard = self.shards.get(branch_id)
+
+        snapshot = copy.copy(self)
+        snapshot.shards = dict(self.shards)
+        snapshot.shards[branch_id] = shard.with_customer(customer) if shard is not None else FaceGallery([customer])
+        snapshot._global = self._global.with_customer(customer) if self._global is not None else None
+        snapshot._global_lock = threading.Lock()
+        return snapshot
+
+    def without_customer(self, customer_id: int) -> 'ShardedGallery':
+        """New snapshot in which the customer is tombstoned in every gallery holding them"""
+        galleries = list(self.shards.values()) + ([self._global] if self._global is not None else [])
+        if not any(customer_id in gallery for gallery in galleries):
+            return self
+
+        snapshot = copy.copy(self)
+        snapshot.shards = {branch_id: shard.without_customer(customer_id) for branch_id, shard in self.shards.items()}
+        snapshot._global = self._global.without_customer(customer_id) if self._global is not None else None
+        snapshot._global_lock = threading.Lock()
+        return snapshot
+
+    def compacted(self) -> 'ShardedGallery':
+        """New snapshot with tombstoned rows dropped from every shard and the global gallery"""
+        snapshot = copy.copy(self)
+        snapshot.shards = {
+            branch_id: shard.compacted()
+            for branch_id, shard in self.shards.items()
+            if len(shard) > 0
+        }
+        snapshot._global = self._global.compacted() if self._global is not None else None
+        snapshot._global_lock = threading.Lock()
+        return snapshot
+
+    def tombstone_ratio(self) -> float:
+        """Share of stored rows that are tombstones (dead rows still scanned by searches)"""
+        galleries = list(self.shards.values()) + ([self._global] if self._global is not None else [])
+        rows = sum(gallery.size for gallery in galleries)
+        return sum(gallery.tombstones for gallery in galleries) / rows if rows else 0.0
+
+    def shard_for(self, branch_id: Optional[str]) -> Optional[FaceGallery]:
+        """Local shard of a branch, or None if it has no customers"""
+        shard = self.shards.get(branch_id)
+        return shard if shard is not None and len(shard) > 0 else None
+
+    @property
+    def global_gallery(self) -> FaceGallery:
+        """Full gallery, loaded on first fallback if a loader was given"""
+        if self._global is None:
+            with self._global_lock:
+                if self._global is None:
+                    self._global = self._global_loader()
+        return self._global
+
+    def shard_sizes(self) -> Dict[str, int]:
+        return {branch_id: len(shard) for branch_id, shard in self.shards.items()}
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """Search memory summed over the shards and the global gallery (if loaded)"""
+        galleries = list(self.shards.values()) + ([self._global] if self._global is not None else [])
+        usages = [gallery.memory_usage() for gallery in galleries]
+        return {
+            'search_modes': sorted({usage['search_mode'] for usage in usages}),
+            'capacity': sum(usage['capacity'] for usage in usages),
+            'tombstones': sum(usage['tombstones'] for usage in usages),
+            'encoding_bytes': sum(usage['encoding_bytes'] for usage in usages),
+            'index_bytes': sum(usage['index_bytes'] for usage in usages),
+            'total_bytes': sum(usage['total_bytes'] for usage in usages),
+        }
+
+
+class RemoteGallery(abc.ABC):
+    """
+    Gallery held by other processes
+    Subclasses return merged top-k candidates per probe instead of exposing
+    encodings, so the match decision still runs in the face engine.
+    """
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        """Customers across all processes"""
+
+    @abc.abstractmethod
+    def search_candidates(self, probes: np.ndarray, k: int) -> List[List[Tuple[int, float, Optional[str]]]]:
+        """
+        The k nearest customers for each probe
+        Returns: one list per probe of (customer_id, distance, name), nearest first
+        """
@@ -0,0 +1,86 @@
+"""
+Match Distance Log
+Append-only JSONL record of match distances, used to calibrate per-branch thresholds
+"""
+
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+
+def match_log_files(path: str) -> List[str]:
+    """The log and its rotated files (path.1, path.2, ...) that exist, oldest first"""
+    directory = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path) + '.'
+    rotated = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit():
+                rotated.append((int(suffix), os.path.join(directory, name)))
+    files = [rotated_path for _, rotated_path in sorted(rotated, reverse=True)]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+class MatchDistanceLog:
+    """
+    Thread-safe JSONL writer for (branch, best, runner-up) distances
+    Once the log reaches max_bytes it is renamed to path.1 (older files
+    shift to path.2, ...) and a new one is started; only max_files rotated
+    files are kept, so the log never holds more than about
+    (max_files + 1) * max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, max_files: int = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Line buffered: each record reaches the OS as soon as it is written
+        self._file = open(self.path, 'a', buffering=1, encoding='utf-8')
+
+    def _rotate(self):
+        """Close the full log and shift it into the rotated files; caller holds the lock"""
+        self._file.close()
+        self._file = None
+        for index in range(self.max_files, 0, -1):
+            source = self.path if index == 1 else f"{self.path}.{index - 1}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index}")
+        if self.max_files < 1:
+            os.remove(self.path)
+
+    def record(self, branch_id: Optional[str], best_distance: float, runner_up_distance: Optional[float], accepted: bool):
+        """Append one match decision"""
+        line = json.dumps({
+            'ts': round(time.time(), 3),
+            'branch_id': branch_id or 'UNKNOWN',
+            'best': round(float(best_distance), 4),
+            'runner_up': None if runner_up_distance is None else round(float(runner_up_distance), 4),
+            'accepted': accepted
+        })
+        try:
+            with self._lock:
+                if self._file is None:
+                    self._open()
+                self._file.write(line + '\n')
+                if self._file.tell() >= self.max_bytes:
+                    self._rotate()
+        except OSError as e:
+            print(f"⚠ Could not write match log {self.path}: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,81 @@
+"""
+Image Preprocessing
+Decode client images into upright, contiguous uint8 RGB arrays, and build the
+small rotated copies searched by the rotation fallback
+"""
+
+import io
+import cv2
+import numpy as np
+from PIL import Image
+
+EXIF_ORIENTATION = 0x0112
+
+# EXIF orientation -> strided view showing the stored pixels upright; the same
+# transposes as PIL.ImageOps.exif_transpose, without building a new image
+ORIENTATION_VIEWS = {
+    2: lambda pixels: pixels[:, ::-1],
+    3: lambda pixels: pixels[::-1, ::-1],
+    4: lambda pixels: pixels[::-1],
+    5: lambda pixels: pixels.transpose(1, 0, 2),
+    6: lambda pixels: np.rot90(pixels, -1),
+    7: lambda pixels: pixels[::-1, ::-1].transpose(1, 0, 2),
+    8: lambda pixels: np.rot90(pixels, 1),
+}
+
+# np.rot90 quarter turns tried when nothing is found upright: phone held
+# sideways either way first, then upside down
+FALLBACK_TURNS = (1, 3, 2)
+
+
+def exif_orientation(image: Image.Image) -> int:
+    """EXIF orientation tag (1-8) of a PIL image, 1 when absent or unreadable"""
+    try:
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        return 1
+    return orientation if orientation in ORIENTATION_VIEWS else 1
+
+
+def _rgb_pixels(image: Image.Image) -> np.ndarray:
+    """(H, W, 3) uint8 view of the pixels; only uncommon modes go through PIL's convert"""
+    if image.mode in ('RGB', 'RGBA', 'RGBX'):
+        return np.asarray(image)[..., :3]
+    if image.mode == 'L':
+        gray = np.asarray(image)
+        return np.broadcast_to(gray[..., None], gray.shape + (3,))
+    # Palette, CMYK, 16-bit, ...
+    return np.asarray(image.convert('RGB'))
+
+
+def to_rgb_array(image: Image.Image) -> np.ndarray:
+    """
+    Upright, C-contiguous, writable uint8 RGB array of a PIL image
+    Orientation, alpha dropping and gray expansion are all strided views, so
+    they are applied by the one copy that makes the result contiguous.
+    """
+    pixels = _rgb_pixels(image)
+    orientation = exif_orientation(image)
+    if orientation != 1:
+        pixels = ORIENTATION_VIEWS[orientation](pixels)
+    return np.require(pixels, dtype=np.uint8, requirements=['C', 'W'])
+
+
+def decode_image(image_data: bytes) -> np.ndarray:
+    """Decode encoded image bytes (JPEG, PNG, ...) to an upright RGB array"""
+    return to_rgb_array(Image.open(io.BytesIO(image_data)))
+
+
+def downscaled(image_array: np.ndarray, max_side: int) -> np.ndarray:
+    """The image with its longer side reduced to max_side (area interpolation); unchanged if already smaller"""
+    height, width = image_array.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1.0:
+        return image_array
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image_array, size, interpolation=cv2.INTER_AREA)
+
+
+def rotated(image_array: np.ndarray, turns: int) -> np.ndarray:
+    """Contiguous copy rotated by turns counter-clockwise quarter turns"""
+    return np.ascontiguousarray(np.rot90(image_array, turns))
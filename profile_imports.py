@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Script to report import-time cost of the project's entry modules
+
+Each target is imported in a fresh interpreter with `-X importtime`, so
+results are not skewed by modules already loaded. The report lists the
+slowest modules by cumulative time. With --budget-ms the script exits
+non-zero when a target exceeds its budget, so it can run in CI to catch
+startup regressions (e.g. a heavy library imported at module level again).
+"""
+
+import sys
+import os
+import json
+import argparse
+import subprocess
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Modules whose import cost matters: tools and clients must stay light,
+# server modules must not load the face models at import time
+DEFAULT_TARGETS = [
+    'client.client',
+    'database.models',
+    'models.face_recognition',
+    'server.request_handler',
+    'server.server',
+    'server.http_server',
+]
+
+# Modules that must never be imported just by importing a target
+FORBIDDEN_AT_IMPORT = ['face_recognition', 'dlib']
+
+
+def profile_target(module):
+    """
+    Import a module in a fresh interpreter
+    Returns: (list of (module, self_us, cumulative_us), error message or None)
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True
+    )
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            entries.append((name.strip(), int(self_us), int(cumulative_us)))
+        except ValueError:
+            continue
+
+    error = None
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed'
+    return entries, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-module import time report")
+    parser.add_argument('targets', nargs='*', default=DEFAULT_TARGETS,
+                        help="Modules to profile (default: project entry modules)")
+    parser.add_argument('--top', type=int, default=15,
+                        help="Slowest modules listed per target (default: 15)")
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help="Fail if any target takes longer than this to import")
+    parser.add_argument('--json', dest='json_path', default=None,
+                        help="Also write the full report to this JSON file")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Import Time Profile")
+    print("=" * 60)
+
+    report = {}
+    failures = []
+    for target in args.targets:
+        entries, error = profile_target(target)
+        by_name = {name: cumulative for name, _, cumulative in entries}
+        total_ms = by_name.get(target, 0) / 1000.0
+
+        print(f"\n📦 {target}: {total_ms:.1f} ms")
+        if error:
+            print(f"  ✗ {error}")
+            failures.append(f"{target}: {error}")
+
+        for name, self_us, cumulative_us in sorted(entries, key=lambda entry: entry[2], reverse=True)[:args.top]:
+            print(f"  {cumulative_us / 1000.0:>9.1f} ms  (self {self_us / 1000.0:>7.1f})  {name}")
+
+        forbidden = [name for name in by_name if name.split('.')[0] in FORBIDDEN_AT_IMPORT]
+        if forbidden:
+            print(f"  ✗ Heavy modules imported eagerly: {', '.join(sorted(set(forbidden)))}")
+            failures.append(f"{target}: imports {', '.join(sorted(set(forbidden)))}")
+
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            print(f"  ✗ Over budget ({args.budget_ms:.0f} ms)")
+            failures.append(f"{target}: {total_ms:.1f} ms > {args.budget_ms:.0f} ms")
+
+        report[target] = {
+            'total_ms': round(total_ms, 2),
+            'error': error,
+            'modules': [
+                {'module': name, 'self_ms': round(self_us / 1000.0, 3), 'cumulative_ms': round(cumulative_us / 1000.0, 3)}
+                for name, self_us, cumulative_us in entries
+            ]
+        }
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✓ Report written to {args.json_path}")
+
+    if failures:
+        print(f"\n✗ {len(failures)} problem(s):")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+
+    print("\n✓ All targets within limits")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Script to replay captured production requests against a server
+
+Reads the capture files written when CAPTURE_SAMPLE_RATE > 0 (see
+utils/capture.py) and reissues every request over its original transport
+(TCP frame or HTTP POST), at the captured pace or faster (--speed 4 plays
+the traffic four times as fast, --speed 0 as fast as --concurrency allows).
+
+Each replayed outcome (status, error code, recognized customer ids) is
+compared with the answer the server gave when the traffic was captured, or,
+with --baseline, with an earlier replay saved by --output. Replaying the same
+capture against two builds gives outcome differences and latency percentiles
+on identical traffic.
+
+REGISTER requests create customers and are skipped unless --include-writes
+is given.
+"""
+
+import sys
+import os
+import glob
+import json
+import time
+import socket
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils.capture import CAPTURE_FILE_PATTERN, iter_capture_records, outcome_of
+from utils.message_handler import MessageHandler, ENCODING_JSON
+
+load_dotenv()
+
+WRITE_REQUEST_TYPES = {'REGISTER'}
+
+# Not forwarded on replay: connection-specific, or asking for a compressed
+# body urllib would not decode
+SKIPPED_HEADERS = {'host', 'content-length', 'connection', 'transfer-encoding', 'accept-encoding'}
+
+PERCENTILES = (50, 90, 99)
+
+
+def load_records(paths, request_types, include_writes, limit):
+    """Captured requests in arrival order, numbered so replays of the same capture line up"""
+    records = []
+    for record in iter_capture_records(paths):
+        if request_types and record['request_type'] not in request_types:
+            continue
+        if record['request_type'] in WRITE_REQUEST_TYPES and not include_writes:
+            continue
+        records.append(record)
+    records.sort(key=lambda record: record['ts'])
+    if limit:
+        records = records[:limit]
+    for index, record in enumerate(records):
+        record['index'] = index
+    return records
+
+
+def _recv_exact(sock, length):
+    chunks = []
+    while length > 0:
+        chunk = sock.recv(min(length, 64 * 1024))
+        if not chunk:
+            raise ConnectionError("Connection closed while receiving response")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_tcp(record, host, port, timeout):
+    """Send the captured frame and return the decoded response"""
+    encoding = record.get('encoding', ENCODING_JSON)
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall(MessageHandler.frame_header(len(record['body']), encoding) + record['body'])
+        length, response_encoding = MessageHandler.parse_frame_header(_recv_exact(sock, 4))
+        return MessageHandler.parse_request(_recv_exact(sock, length), response_encoding), None
+
+
+def send_http(record, base_url, timeout):
+    """POST the captured body and return (decoded response, HTTP status)"""
+    headers = {
+        name: value for name, value in record.get('headers', {}).items()
+        if name.lower() not in SKIPPED_HEADERS
+    }
+    request = urllib.request.Request(
+        base_url.rstrip('/') + record['endpoint'],
+        data=record['body'],
+        headers=headers,
+        method=record.get('method', 'POST')
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read()), response.status
+    except urllib.error.HTTPError as e:
+        # 400/503 answers still carry a JSON body with the error code
+        return json.loads(e.read() or b'{}'), e.code
+
+
+def replay_one(record, args, started, due):
+    """Issue one request; returns its result record"""
+    lag_ms = (time.perf_counter() - started - due) * 1000.0
+    request_started = time.perf_counter()
+    try:
+        if record['transport'] == 'tcp':
+            response, http_status = send_tcp(record, args.host, args.port, args.timeout)
+        else:
+            response, http_status = send_http(record, args.http_url, args.timeout)
+        outcome = outcome_of(response)
+        if http_status is not None:
+            outcome['http_status'] = http_status
+    except (OSError, ValueError) as e:
+        outcome = {'status': 'transport_error', 'error_code': type(e).__name__}
+    return {
+        'index': record['index'],
+        'request_type': record['request_type'],
+        'transport': record['transport'],
+        'outcome': outcome,
+        'latency_ms': round((time.perf_counter() - request_started) * 1000.0, 3),
+        'lag_ms': round(max(0.0, lag_ms), 3),
+    }
+
+
+def replay(records, args):
+    """Reissue the records on their captured schedule (scaled by --speed)"""
+    results = [None] * len(records)
+    first_ts = records[0]['ts']
+    progress = {'done': 0}
+    progress_lock = threading.Lock()
+    started = time.perf_counter()
+
+    def run(record, due):
+        results[record['index']] = replay_one(record, args, started, due)
+        with progress_lock:
+            progress['done'] += 1
+            if progress['done'] % 100 == 0:
+                print(f"  → {progress['done']}/{len(records)} replayed")
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for record in records:
+            due = (record['ts'] - first_ts) / args.speed if args.speed > 0 else 0.0
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(run, record, due)
+    return results, time.perf_counter() - started
+
+
+def load_baseline(path):
+    """Results of an earlier replay, by capture index"""
+    baseline = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            baseline[result['index']] = result
+    return baseline
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {f'p{p}': None for p in PERCENTILES + (100,)}
+    values = np.percentile(np.asarray(latencies, dtype=np.float64), PERCENTILES + (100,))
+    return {f'p{p}': round(float(value), 2) for p, value in zip(PERCENTILES + (100,), values)}
+
+
+def _latency_triple(stats):
+    if stats['p50'] is None:
+        return '-'
+    return '/'.join(str(stats[f'p{p}']) for p in PERCENTILES)
+
+
+def compare(records, results, baseline):
+    """Outcome agreement and latency percentiles per request type"""
+    summary = {}
+    by_type = defaultdict(list)
+    for record, result in zip(records, results):
+        by_type[record['request_type']].append((record, result))
+
+    for request_type, pairs in sorted(by_type.items()):
+        mismatches = []
+        reference_latencies = []
+        for record, result in pairs:
+            if baseline is not None:
+                reference = baseline.get(record['index'])
+                if reference is None:
+                    continue
+                expected, reference_latency = reference['outcome'], reference['latency_ms']
+            else:
+                expected, reference_latency = record['outcome'], record['latency_ms']
+            reference_latencies.append(reference_latency)
+            if result['outcome'] != expected:
+                mismatches.append({'index': record['index'], 'expected': expected, 'replayed': result['outcome']})
+
+        compared = len(reference_latencies)
+        summary[request_type] = {
+            'requests': len(pairs),
+            'compared': compared,
+            'agreement': round(1 - len(mismatches) / compared, 4) if compared else None,
+            'error_codes': dict(Counter(result['outcome'].get('error_code') for _, result in pairs if result['outcome'].get('error_code'))),
+            'reference_latency_ms': percentiles(reference_latencies),
+            'replay_latency_ms': percentiles([result['latency_ms'] for _, result in pairs]),
+            'mismatches': mismatches[:20],
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured requests and compare outcomes and latency")
+    parser.add_argument('captures', nargs='*',
+                        help="Capture files (default: all in CAPTURE_DIR)")
+    parser.add_argument('--host', default='localhost',
+                        help="TCP server host (default: localhost)")
+    parser.add_argument('--port', type=int, default=int(os.getenv('SERVER_PORT', 8888)),
+                        help="TCP server port")
+    parser.add_argument('--http-url', default=f"http://localhost:{os.getenv('HTTP_PORT', 8889)}",
+                        help="Base URL of the HTTP server")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay rate relative to the capture; 0 = no pacing (default: 1.0)")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="Maximum requests in flight (default: 16)")
+    parser.add_argument('--types', default='',
+                        help="Comma-separated request types to replay (default: all captured)")
+    parser.add_argument('--include-writes', action='store_true',
+                        help="Also replay REGISTER (creates customers)")
+    parser.add_argument('--limit', type=int, default=0,
+                        help="Replay only the first N captured requests")
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help="Per-request timeout in seconds (default: 30)")
+    parser.add_argument('--baseline', default=None,
+                        help="Compare with an earlier replay's --output instead of the captured outcomes")
+    parser.add_argument('--output', default=None,
+                        help="Write per-request results (JSONL) for use as a later --baseline")
+    parser.add_argument('--json', dest='json_path', default=None,
+                        help="Also write the summary to this JSON file")
+    args = parser.parse_args()
+
+    paths = args.captures or sorted(glob.glob(os.path.join(os.getenv('CAPTURE_DIR', 'captures'), CAPTURE_FILE_PATTERN)))
+    request_types = {request_type.strip() for request_type in args.types.split(',') if request_type.strip()}
+
+    print("=" * 60)
+    print("Traffic Replay")
+    print("=" * 60)
+
+    records = load_records(paths, request_types, args.include_writes, args.limit)
+    if not records:
+        print(f"\n✗ No captured requests to replay in {len(paths)} file(s)")
+        sys.exit(1)
+
+    captured_seconds = records[-1]['ts'] - records[0]['ts']
+    pace = f"{args.speed}x" if args.speed > 0 else "unpaced"
+    print(f"\n📊 {len(records)} requests from {len(paths)} file(s), spanning {captured_seconds:.1f}s of traffic ({pace})")
+
+    baseline = load_baseline(args.baseline) if args.baseline else None
+
+    results, elapsed = replay(records, args)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+        print(f"\n✓ Per-request results written to {args.output}")
+
+    summary = compare(records, results, baseline)
+    lags = [result['lag_ms'] for result in results]
+    reference = f"baseline {args.baseline}" if baseline is not None else "captured server responses"
+
+    print(f"\nReplayed in {elapsed:.1f}s ({len(records) / max(elapsed, 1e-9):.1f} req/s), "
+          f"schedule lag p99 {percentiles(lags)['p99']} ms")
+    print(f"Outcomes compared with {reference}")
+    print(f"\n{'Type':<16} {'Count':>6} {'Agree':>7}   {'Ref p50/p90/p99 ms':>22}   {'Replay p50/p90/p99 ms':>22}")
+    for request_type, stats in summary.items():
+        agreement = f"{stats['agreement']:.4f}" if stats['agreement'] is not None else '-'
+        print(f"{request_type:<16} {stats['requests']:>6} {agreement:>7}   "
+              f"{_latency_triple(stats['reference_latency_ms']):>22}   "
+              f"{_latency_triple(stats['replay_latency_ms']):>22}")
+        if stats['error_codes']:
+            print(f"   error codes: {stats['error_codes']}")
+        for mismatch in stats['mismatches'][:5]:
+            print(f"   ⚠ #{mismatch['index']}: expected {mismatch['expected']}, got {mismatch['replayed']}")
+
+    if baseline is None:
+        print("\nCaptured latencies are measured inside the server; replay latencies include the network.")
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({'requests': len(records), 'elapsed_s': round(elapsed, 3), 'reference': reference,
+                       'schedule_lag_ms': percentiles(lags), 'types': summary}, f, indent=2)
+        print(f"\n✓ Summary written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
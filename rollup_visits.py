@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Script to roll raw visit events up into hourly per-branch aggregates
+
+For every (branch, hour) it stores request count, recognition rate, rejected
+captures and latency percentiles in visit_rollups, so dashboards and capacity
+planning read a few hundred small documents instead of scanning visits.
+Safe to re-run: each rollup document is replaced in place. Run it from cron,
+e.g. a few minutes past every hour.
+"""
+
+import sys
+import os
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import ReplaceOne
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database.connection import db_connection
+from database.models import VisitModel
+
+load_dotenv()
+
+# Stage latencies averaged into each rollup
+STAGES = ['decode_ms', 'detect_ms', 'quality_ms', 'encode_ms', 'match_ms', 'lookup_ms']
+
+
+def hour_floor(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def summarize(branch_id, hour, visits):
+    """Aggregate one branch-hour of visit documents"""
+    outcomes = {}
+    for visit in visits:
+        outcomes[visit['outcome']] = outcomes.get(visit['outcome'], 0) + 1
+
+    requests = len(visits)
+    recognized = outcomes.get('RECOGNIZED', 0)
+    # Matched against the gallery at all (not rejected before encoding or failed)
+    matched = recognized + outcomes.get('NOT_RECOGNIZED', 0)
+    totals = np.array([visit.get('latency_ms', {}).get('total_ms', 0.0) for visit in visits], dtype=np.float64)
+
+    stage_means = {}
+    for stage in STAGES:
+        values = [visit['latency_ms'][stage] for visit in visits if stage in visit.get('latency_ms', {})]
+        if values:
+            stage_means[stage] = round(float(np.mean(values)), 2)
+
+    return {
+        'branch_id': branch_id,
+        'hour': hour,
+        'requests': requests,
+        'recognized': recognized,
+        'not_recognized': outcomes.get('NOT_RECOGNIZED', 0),
+        'rejected': requests - matched,
+        'recognition_rate': round(recognized / matched, 4) if matched else 0.0,
+        'outcomes': outcomes,
+        'avg_latency_ms': round(float(totals.mean()), 2),
+        'p50_latency_ms': round(float(np.percentile(totals, 50)), 2),
+        'p95_latency_ms': round(float(np.percentile(totals, 95)), 2),
+        'max_latency_ms': round(float(totals.max()), 2),
+        'avg_stage_ms': stage_means,
+        'rolled_up_at': datetime.now()
+    }
+
+
+def rollup_hour(hour):
+    """Recompute the rollups of every branch for one hour; returns the number written"""
+    cursor = VisitModel.get_collection().find(
+        {'visited_at': {'$gte': hour, '$lt': hour + timedelta(hours=1)}},
+        {'_id': 0, 'branch_id': 1, 'outcome': 1, 'latency_ms': 1}
+    )
+
+    by_branch = {}
+    for visit in cursor:
+        by_branch.setdefault(visit.get('branch_id', 'UNKNOWN'), []).append(visit)
+
+    operations = [
+        ReplaceOne({'branch_id': branch_id, 'hour': hour}, summarize(branch_id, hour, visits), upsert=True)
+        for branch_id, visits in by_branch.items()
+    ]
+    if operations:
+        VisitModel.get_rollup_collection().bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Roll visit events up into hourly per-branch aggregates")
+    parser.add_argument('--hours', type=int, default=None,
+                        help="Recompute this many past hours (default: since the last rollup, at least 2)")
+    parser.add_argument('--include-current', action='store_true',
+                        help="Also roll up the current, still incomplete hour")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Visit Rollup")
+    print("=" * 60)
+
+    try:
+        db_connection.connect()
+    except Exception as e:
+        print(f"\n✗ Failed to connect to database: {e}")
+        sys.exit(1)
+
+    current_hour = hour_floor(datetime.now())
+    end = current_hour + timedelta(hours=1) if args.include_current else current_hour
+
+    if args.hours is not None:
+        start = current_hour - timedelta(hours=args.hours)
+    else:
+        last = VisitModel.get_rollup_collection().find_one({}, {'hour': 1}, sort=[('hour', -1)])
+        # Redo the last rolled hour too: late write-behind flushes may have landed in it
+        start = last['hour'] if last else None
+        if start is None:
+            first = VisitModel.get_collection().find_one({}, {'visited_at': 1}, sort=[('visited_at', 1)])
+            start = hour_floor(first['visited_at']) if first else current_hour
+        start = min(start, current_hour - timedelta(hours=2))
+
+    hour = start
+    written = 0
+    while hour < end:
+        count = rollup_hour(hour)
+        if count:
+            print(f"✓ {hour:%Y-%m-%d %H:00}  {count} branches")
+        written += count
+        hour += timedelta(hours=1)
+
+    print(f"\n✓ Wrote {written} rollup documents")
+    db_connection.close()
+
+
+if __name__ == "__main__":
+    main()
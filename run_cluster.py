@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Script to run a local distributed cluster on one machine
+Starts N gallery shard nodes on consecutive ports and a coordinator that
+fans recognition searches out to them. Ctrl+C stops every process.
+"""
+
+import sys
+import os
+import time
+import argparse
+import subprocess
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RUN_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_server.py')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run gallery shard nodes and a coordinator on localhost")
+    parser.add_argument('--shards', type=int, default=3, help="Number of shard nodes (default: 3)")
+    parser.add_argument('--shard-base-port', type=int, default=9100,
+                        help="Port of shard 0; shard i listens on base + i (default: 9100)")
+    parser.add_argument('--port', type=int, default=int(os.getenv('SERVER_PORT', 8888)),
+                        help="Coordinator TCP port")
+    parser.add_argument('--http-port', type=int, default=int(os.getenv('HTTP_PORT', 8889)),
+                        help="Coordinator HTTP API port")
+    args = parser.parse_args()
+
+    processes = []
+    shard_nodes = []
+    try:
+        for index in range(args.shards):
+            port = args.shard_base_port + index
+            shard_nodes.append(f"127.0.0.1:{port}")
+            processes.append(subprocess.Popen([
+                sys.executable, RUN_SERVER, '--mode', 'shard',
+                '--shard-index', str(index), '--shard-count', str(args.shards), '--port', str(port)
+            ]))
+
+        # Give the shard nodes time to load their slices before the first search
+        time.sleep(2)
+
+        processes.append(subprocess.Popen([
+            sys.executable, RUN_SERVER, '--mode', 'coordinator',
+            '--shard-nodes', ','.join(shard_nodes),
+            '--port', str(args.port), '--http-port', str(args.http_port)
+        ]))
+
+        print(f"\n✓ Cluster running: {args.shards} shards ({','.join(shard_nodes)}), coordinator on {args.port}")
+
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+        print("\n✗ A cluster process exited, stopping the cluster")
+
+    except KeyboardInterrupt:
+        print("\n⚠ Cluster interrupted by user")
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,16 @@
 """
 Main entry point for the Face Recognition Server
 Starts both TCP Socket Server and HTTP API Server
+
+Modes:
+    standalone   - one process holds the whole gallery (default)
+    coordinator  - encodes probes and fans searches out to shard nodes (SHARD_NODES)
+    shard        - holds one slice of the gallery and answers coordinator searches
 """
 
 import sys
 import os
+import argparse
 import threading
 from dotenv import load_dotenv
 
@@ -13,44 +19,100 @@ from dotenv import load_dotenv
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from server.server import SocketServer
+from server.app_context import get_app_context
 from server.http_server import create_http_server
+from server.shard_node import ShardNode, ShardNodeServer
 from database.connection import db_connection
+from database.write_behind import write_behind
+from database.edge_cache import get_edge_cache
 
 load_dotenv()
 
-def start_http_server():
+def start_http_server(http_port, context):
     """Start HTTP API server in a separate thread"""
-    http_app = create_http_server()
-    http_port = int(os.getenv('HTTP_PORT', 8889))
+    http_app = create_http_server(context)
     http_host = os.getenv('HTTP_HOST', '0.0.0.0')
     http_app.run(host=http_host, port=http_port, debug=False, use_reloader=False)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Face Recognition Server")
+    parser.add_argument('--mode', choices=['standalone', 'coordinator', 'shard'],
+                        default='coordinator' if os.getenv('SHARD_NODES') else 'standalone',
+                        help="Process role (default: coordinator if SHARD_NODES is set, else standalone)")
+    parser.add_argument('--port', type=int, default=None,
+                        help="TCP port (default: SERVER_PORT)")
+    parser.add_argument('--http-port', type=int, default=int(os.getenv('HTTP_PORT', 8889)),
+                        help="HTTP API port, not used by shard nodes")
+    parser.add_argument('--shard-nodes', default=os.getenv('SHARD_NODES', ''),
+                        help="Coordinator mode: shard node addresses 'host:port,host:port' in shard index order")
+    parser.add_argument('--shard-index', type=int, default=int(os.getenv('SHARD_INDEX', 0)),
+                        help="Shard mode: slice owned by this node (customer_id %% shard-count)")
+    parser.add_argument('--shard-count', type=int, default=int(os.getenv('SHARD_COUNT', 1)),
+                        help="Shard mode: total number of shard nodes")
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
+
     print("=" * 60)
-    print("Face Recognition Server - CS401V Lab Assignment 2")
+    print(f"Face Recognition Server - CS401V Lab Assignment 2 ({args.mode})")
     print("=" * 60)
+
+    # Edge mode serves from the local replica, so it can start while the central database is unreachable
+    edge_cache = get_edge_cache() if args.mode == 'standalone' else None
     
     # Initialize database connection
     try:
         db_connection.connect()
     except Exception as e:
         print(f"✗ Failed to connect to database: {e}")
-        print("Please make sure MongoDB is running")
-        sys.exit(1)
-    
-    # Start HTTP API server in a separate thread
-    http_thread = threading.Thread(target=start_http_server, daemon=True)
-    http_thread.start()
-    print("✓ HTTP API Server started (port 8889)")
-    
-    # Create and start TCP Socket server (main thread)
-    server = SocketServer()
-    
+        if edge_cache is None:
+            print("Please make sure MongoDB is running")
+            sys.exit(1)
+        print("⚠ Edge mode: serving from the local replica until the central database is reachable")
+
+    if args.mode == 'shard':
+        # Shard nodes only answer coordinator searches
+        server = ShardNodeServer(ShardNode(args.shard_index, args.shard_count), port=args.port)
+    else:
+        if args.mode == 'coordinator':
+            if not args.shard_nodes:
+                print("✗ Coordinator mode needs --shard-nodes or SHARD_NODES")
+                sys.exit(1)
+            os.environ['SHARD_NODES'] = args.shard_nodes
+            print(f"✓ Coordinating gallery shards: {args.shard_nodes}")
+        else:
+            os.environ.pop('SHARD_NODES', None)
+
+        # Replay writes spooled before the last shutdown and start the batch writer
+        write_behind.start()
+        
+        if edge_cache is not None:
+            print(f"✓ Edge mode: local replica {edge_cache.path} ({edge_cache.get_stats()['customers']} customers)")
+            edge_cache.start()
+
+        # Engine, gallery cache and handlers shared by the TCP and HTTP servers
+        context = get_app_context()
+
+        # Load the face models and run a dummy inference before accepting traffic
+        if os.getenv('FACE_WARM_UP', 'true').lower() in ('1', 'true', 'yes'):
+            context.engine.warm_up()
+
+        # Start HTTP API server in a separate thread
+        http_thread = threading.Thread(target=start_http_server, args=(args.http_port, context), daemon=True)
+        http_thread.start()
+        print(f"✓ HTTP API Server started (port {args.http_port})")
+
+        # Create TCP Socket server (main thread)
+        server = SocketServer(port=args.port, context=context)
+
     try:
         server.start()
     except KeyboardInterrupt:
         print("\n⚠ Server interrupted by user")
     finally:
         server.stop()
+        if edge_cache is not None:
+            edge_cache.close()
+        write_behind.close()
         db_connection.close()
-
@@ -0,0 +1,202 @@
+"""
+Admission Control Module
+Bounded per-type queues with priority and deadline-aware load shedding,
+shared by the TCP and HTTP front-ends
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Request types that go through admission control, mapped to their class.
+# Batch items and stream frames are admitted one at a time as RECOGNIZE
+# (BatchRecognizer._recognize_item, ClientThread._handle_stream).
+REQUEST_CLASSES = {
+    'RECOGNIZE': 'RECOGNIZE',
+    'RECOGNIZE_MULTI': 'RECOGNIZE',
+    'REGISTER': 'REGISTER',
+}
+
+# Lower value is served first when a slot frees up
+CLASS_PRIORITY = {
+    'RECOGNIZE': 0,
+    'REGISTER': 1,
+}
+
+
+class AdmissionRejected(Exception):
+    """Request shed by admission control; the client may retry later"""
+
+    def __init__(self, reason: str, retry_after_ms: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after_ms = retry_after_ms
+
+
+class _Waiter:
+    """A queued request waiting for an execution slot"""
+
+    __slots__ = ('enqueued_at', 'deadline', 'granted', 'abandoned')
+
+    def __init__(self, enqueued_at: float, deadline: float):
+        self.enqueued_at = enqueued_at
+        self.deadline = deadline
+        self.granted = False
+        self.abandoned = False
+
+
+class AdmissionController:
+    """Limit concurrent work and shed load before it times out at the client"""
+
+    def __init__(self):
+        self.max_concurrent = int(os.getenv('ADMISSION_MAX_CONCURRENT', os.cpu_count() or 4))
+        self.queue_limits = {
+            'RECOGNIZE': int(os.getenv('ADMISSION_QUEUE_RECOGNIZE', 32)),
+            'REGISTER': int(os.getenv('ADMISSION_QUEUE_REGISTER', 8)),
+        }
+        # Longest a request may wait for a slot before it is dropped unprocessed
+        self.deadlines_ms = {
+            'RECOGNIZE': int(os.getenv('ADMISSION_DEADLINE_RECOGNIZE_MS', 5000)),
+            'REGISTER': int(os.getenv('ADMISSION_DEADLINE_REGISTER_MS', 10000)),
+        }
+
+        self._condition = threading.Condition()
+        self._active = 0
+        self._queues = {request_class: deque() for request_class in CLASS_PRIORITY}
+        self._stats = {
+            request_class: {
+                'admitted': 0,
+                'shed_queue_full': 0,
+                'shed_deadline': 0,
+                'max_queue_depth': 0,
+                'total_wait_ms': 0.0,
+                'avg_service_ms': 0.0,
+            }
+            for request_class in CLASS_PRIORITY
+        }
+
+    @contextmanager
+    def admit(self, request_type: str, deadline_ms: Optional[float] = None):
+        """
+        Hold an execution slot for the duration of the block
+        Args:
+            request_type: Protocol request type; unmanaged types pass straight through
+            deadline_ms: Optional client budget, capped by the configured deadline
+        Raises:
+            AdmissionRejected if the queue is full or the deadline passes while waiting
+        """
+        request_class = REQUEST_CLASSES.get(request_type)
+        if request_class is None:
+            yield
+            return
+
+        self._acquire(request_class, deadline_ms)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(request_class, (time.monotonic() - started) * 1000.0)
+
+    def _retry_after_ms(self, request_class: str) -> int:
+        """Rough time until a slot frees up for this class, for client backoff"""
+        queued = sum(len(self._queues[other]) for other in CLASS_PRIORITY
+                     if CLASS_PRIORITY[other] <= CLASS_PRIORITY[request_class])
+        service_ms = self._stats[request_class]['avg_service_ms'] or 500.0
+        estimate = service_ms * (queued + 1) / max(1, self.max_concurrent)
+        return int(min(max(estimate, 100.0), 5000.0))
+
+    def _acquire(self, request_class: str, deadline_ms: Optional[float]):
+        now = time.monotonic()
+        wait_ms = self.deadlines_ms[request_class]
+        if deadline_ms is not None:
+            wait_ms = min(wait_ms, max(0.0, float(deadline_ms)))
+        stats = self._stats[request_class]
+
+        with self._condition:
+            # Fast path: free slot and nobody of equal or higher priority waiting
+            if self._active < self.max_concurrent and not self._has_waiters_at_or_above(request_class):
+                self._active += 1
+                stats['admitted'] += 1
+                return
+
+            queue = self._queues[request_class]
+            if len(queue) >= self.queue_limits[request_class]:
+                stats['shed_queue_full'] += 1
+                raise AdmissionRejected('queue full', self._retry_after_ms(request_class))
+
+            waiter = _Waiter(now, now + wait_ms / 1000.0)
+            queue.append(waiter)
+            stats['max_queue_depth'] = max(stats['max_queue_depth'], len(queue))
+
+            while not waiter.granted:
+                remaining = waiter.deadline - time.monotonic()
+                if remaining <= 0:
+                    waiter.abandoned = True
+                    try:
+                        queue.remove(waiter)
+                    except ValueError:
+                        pass
+                    stats['shed_deadline'] += 1
+                    raise AdmissionRejected('deadline exceeded while queued', self._retry_after_ms(request_class))
+                self._condition.wait(remaining)
+
+            stats['admitted'] += 1
+            stats['total_wait_ms'] += (time.monotonic() - waiter.enqueued_at) * 1000.0
+
+    def _release(self, request_class: str, service_ms: float):
+        with self._condition:
+            self._active -= 1
+            # Exponentially weighted service time, used for retry hints
+            stats = self._stats[request_class]
+            stats['avg_service_ms'] = service_ms if stats['avg_service_ms'] == 0 else \
+                0.8 * stats['avg_service_ms'] + 0.2 * service_ms
+            self._grant_next()
+
+    def _has_waiters_at_or_above(self, request_class: str) -> bool:
+        priority = CLASS_PRIORITY[request_class]
+        return any(self._queues[other] for other in CLASS_PRIORITY if CLASS_PRIORITY[other] <= priority)
+
+    def _grant_next(self):
+        """Hand free slots to the highest-priority waiters whose deadline has not passed"""
+        now = time.monotonic()
+        for request_class in sorted(CLASS_PRIORITY, key=CLASS_PRIORITY.get):
+            queue = self._queues[request_class]
+            while queue and self._active < self.max_concurrent:
+                waiter = queue.popleft()
+                if waiter.abandoned or waiter.deadline <= now:
+                    # Already too old to be useful; its thread sheds it on wake-up
+                    continue
+                waiter.granted = True
+                self._active += 1
+        self._condition.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Snapshot of queue depths and shedding counters"""
+        with self._condition:
+            classes = {}
+            for request_class, stats in self._stats.items():
+                snapshot = dict(stats)
+                snapshot['queue_depth'] = len(self._queues[request_class])
+                snapshot['queue_limit'] = self.queue_limits[request_class]
+                snapshot['deadline_ms'] = self.deadlines_ms[request_class]
+                queued_admitted = stats['admitted']
+                snapshot['avg_wait_ms'] = round(stats['total_wait_ms'] / queued_admitted, 2) if queued_admitted else 0.0
+                snapshot['avg_service_ms'] = round(stats['avg_service_ms'], 2)
+                del snapshot['total_wait_ms']
+                classes[request_class] = snapshot
+
+            return {
+                'active': self._active,
+                'max_concurrent': self.max_concurrent,
+                'classes': classes
+            }
+
+
+# Global instance shared by the socket and HTTP servers
+admission_controller = AdmissionController()
@@ -0,0 +1,52 @@
+"""
+Application Context
+One set of long-lived objects shared by the TCP and HTTP front-ends
+"""
+
+import threading
+from typing import Optional
+from models.face_recognition import FaceRecognitionEngine, get_face_engine
+from database.connection import db_connection
+from database.write_behind import write_behind
+from server.request_handler import RequestHandler
+from utils.message_handler import MessageHandler
+
+
+class AppContext:
+    """
+    Face engine, request handler (gallery cache) and message handler of the process
+    Built once at startup and injected into SocketServer and the Flask app,
+    so every connection and HTTP request reuses the same gallery cache and
+    engine instead of rebuilding them. The request handler, and through it
+    batch and stream recognition, runs on this engine. All members are safe to share between
+    request threads: the gallery cache is guarded by the handler's lock, the
+    engine and message handler keep no per-request state, and the database
+    models go through the thread-safe MongoDB client.
+    """
+
+    def __init__(
+        self,
+        engine: Optional[FaceRecognitionEngine] = None,
+        request_handler: Optional[RequestHandler] = None,
+        message_handler: Optional[MessageHandler] = None
+    ):
+        self.engine = engine or get_face_engine()
+        self.request_handler = request_handler or RequestHandler(self.engine)
+        self.message_handler = message_handler or MessageHandler()
+        self.db_connection = db_connection
+        self.write_behind = write_behind
+        self.edge_cache = self.request_handler.edge_cache
+
+
+_app_context = None
+_app_context_lock = threading.Lock()
+
+
+def get_app_context() -> AppContext:
+    """Process-wide application context, constructed on first use"""
+    global _app_context
+    if _app_context is None:
+        with _app_context_lock:
+            if _app_context is None:
+                _app_context = AppContext()
+    return _app_context
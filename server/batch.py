@@ -0,0 +1,112 @@
+"""
+Batch Recognition Module
+Runs many RECOGNIZE items through a bounded worker pool against one gallery snapshot
+"""
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterable, Iterator
+from dotenv import load_dotenv
+from utils.message_handler import MessageHandler
+from server.admission import admission_controller, AdmissionRejected
+
+load_dotenv()
+
+
+class BatchRecognizer:
+    """Stream results for a batch of images with flat memory use"""
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, request_handler, message_handler: MessageHandler = None):
+        self.request_handler = request_handler
+        self.message_handler = message_handler or MessageHandler()
+        self.max_workers = int(os.getenv('BATCH_MAX_WORKERS', 4))
+        # Images submitted but not yet returned; bounds memory per batch
+        self.max_in_flight = int(os.getenv('BATCH_MAX_IN_FLIGHT', self.max_workers * 2))
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Worker pool shared by all batches so concurrent batches stay bounded"""
+        with BatchRecognizer._executor_lock:
+            if BatchRecognizer._executor is None:
+                BatchRecognizer._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='batch-recognize'
+                )
+            return BatchRecognizer._executor
+
+    def _recognize_item(self, index: int, item: Dict[str, Any], branch_id: str, gallery) -> Dict[str, Any]:
+        """Recognize one batch item and build its result record"""
+        message = dict(item)
+        message['request_type'] = 'RECOGNIZE'
+        message.setdefault('branch_id', branch_id)
+
+        is_valid, error_msg = self.message_handler.validate_request(message)
+        if is_valid:
+            # Each item takes a RECOGNIZE slot, so batches cannot bypass load shedding
+            try:
+                with admission_controller.admit('RECOGNIZE', message.get('deadline_ms')):
+                    status, response_data = self.request_handler.handle_recognize_request(message, gallery=gallery)
+            except AdmissionRejected as e:
+                status, response_data = 'error', {
+                    'error_code': 'BUSY',
+                    'error_message': f'Server busy ({e.reason}). Please retry.',
+                    'retry_after_ms': e.retry_after_ms
+                }
+        else:
+            status, response_data = 'error', {
+                'error_code': 'INVALID_REQUEST',
+                'error_message': error_msg
+            }
+
+        result = self.message_handler.build_response(
+            status=status,
+            request_id=message.get('request_id'),
+            return_dict=True,
+            **response_data
+        )
+        result['index'] = index
+        return result
+
+    def process(self, items: Iterable[Dict[str, Any]], branch_id: str = 'UNKNOWN') -> Iterator[Dict[str, Any]]:
+        """
+        Recognize items lazily and yield results in input order
+        Items are consumed only as pool capacity frees up, so a streamed
+        input is never fully materialized. The final record is a summary.
+        """
+        executor = self._get_executor()
+        gallery = self.request_handler.get_gallery_snapshot()
+
+        pending = deque()
+        processed = 0
+        recognized = 0
+
+        def collect():
+            nonlocal processed, recognized
+            result = pending.popleft().result()
+            processed += 1
+            if result.get('recognized'):
+                recognized += 1
+            return result
+
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                item = {}
+            pending.append(executor.submit(self._recognize_item, index, item, branch_id, gallery))
+
+            if len(pending) >= self.max_in_flight:
+                yield collect()
+
+        while pending:
+            yield collect()
+
+        yield {
+            'status': 'success',
+            'batch_complete': True,
+            'processed': processed,
+            'recognized_count': recognized,
+            'gallery_size': len(gallery)
+        }
@@ -0,0 +1,255 @@
+"""
+Recognition Coordinator
+Scatters probe encodings to gallery shard nodes and merges their top-k
+results, so the gallery can be spread over several processes or machines
+"""
+
+import heapq
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+from models.gallery import RemoteGallery
+from server.shard_node import send_frame, recv_frame
+from utils.message_handler import MessageHandler
+
+load_dotenv()
+
+MAX_SHARD_RESPONSE_BYTES = 64 * 1024 * 1024
+
+
+class ShardUnavailable(Exception):
+    """Not enough shard nodes answered to give a trustworthy result"""
+
+
+class ShardClient:
+    """Pooled persistent connections to one shard node, with per-node statistics"""
+
+    def __init__(self, shard_index: int, address: Tuple[str, int], timeout_s: float):
+        self.shard_index = shard_index
+        self.address = address
+        self.timeout_s = timeout_s
+        self.message_handler = MessageHandler()
+        self._idle = []
+        self._lock = threading.Lock()
+        self.size = None
+        self.stats = {'requests': 0, 'errors': 0, 'timeouts': 0, 'avg_latency_ms': 0.0}
+
+    def _checkout(self) -> Tuple[socket.socket, bool]:
+        """An idle pooled connection or a new one; the flag is True for pooled connections"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        sock = socket.create_connection(self.address, timeout=self.timeout_s)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, False
+
+    def _exchange(self, message: Dict[str, Any], timeout_s: float) -> Tuple[socket.socket, Dict[str, Any]]:
+        """Send one request and read its response on a pooled or new connection"""
+        while True:
+            sock, pooled = self._checkout()
+            try:
+                sock.settimeout(timeout_s)
+                send_frame(sock, self.message_handler.encode_message(message))
+                data = recv_frame(sock, MAX_SHARD_RESPONSE_BYTES)
+                if data is None:
+                    raise ConnectionError("shard closed the connection")
+                return sock, self.message_handler.parse_request(data)
+            except socket.timeout:
+                # The late response would desynchronize the connection: drop it
+                sock.close()
+                raise
+            except OSError:
+                sock.close()
+                # A pooled connection may have been closed by a restarted shard; retry on a new one
+                if not pooled:
+                    raise
+
+    def _checkin(self, sock: socket.socket):
+        with self._lock:
+            self._idle.append(sock)
+
+    def request(self, message: Dict[str, Any], timeout_s: Optional[float] = None) -> Dict[str, Any]:
+        """Send one request and wait for its response, within the shard timeout"""
+        started = time.monotonic()
+        try:
+            sock, response = self._exchange(message, timeout_s or self.timeout_s)
+        except socket.timeout:
+            self._record(started, 'timeouts')
+            raise
+        except Exception:
+            self._record(started, 'errors')
+            raise
+
+        self._checkin(sock)
+        self._record(started)
+        if response.get('status') != 'success':
+            raise RuntimeError(response.get('error_message', 'shard error'))
+        if 'shard_size' in response:
+            self.size = response['shard_size']
+        return response
+
+    def _record(self, started: float, failure: Optional[str] = None):
+        latency_ms = (time.monotonic() - started) * 1000.0
+        with self._lock:
+            self.stats['requests'] += 1
+            if failure:
+                self.stats[failure] += 1
+            previous = self.stats['avg_latency_ms']
+            self.stats['avg_latency_ms'] = latency_ms if previous == 0 else 0.8 * previous + 0.2 * latency_ms
+
+    def close(self):
+        with self._lock:
+            for sock in self._idle:
+                sock.close()
+            self._idle = []
+
+
+class ShardCoordinator(RemoteGallery):
+    """
+    Gallery spread over shard nodes; node i owns customer_id % len(nodes) == i
+    Every search goes to all shards in parallel. Shards that miss the
+    per-shard timeout are left out of the merge unless SHARD_REQUIRE_ALL is set.
+    """
+
+    def __init__(self, nodes: List[Tuple[str, int]]):
+        self.timeout_s = float(os.getenv('SHARD_TIMEOUT_MS', 500)) / 1000.0
+        self.require_all = os.getenv('SHARD_REQUIRE_ALL', 'false').lower() in ('1', 'true', 'yes')
+        self.size_ttl = float(os.getenv('GALLERY_CACHE_TTL', 60))
+        self.shards = [ShardClient(index, address, self.timeout_s) for index, address in enumerate(nodes)]
+        self._executor = ThreadPoolExecutor(max_workers=max(4, 4 * len(nodes)), thread_name_prefix='shard-scatter')
+        self._sizes_timestamp = None
+        self._stats_lock = threading.Lock()
+        self.stats = {'searches': 0, 'partial_searches': 0, 'failed_searches': 0}
+
+    @staticmethod
+    def parse_nodes(spec: str) -> List[Tuple[str, int]]:
+        """Parse 'host:port,host:port' into addresses, in shard index order"""
+        nodes = []
+        for entry in spec.split(','):
+            entry = entry.strip()
+            if entry:
+                host, _, port = entry.rpartition(':')
+                nodes.append((host or 'localhost', int(port)))
+        return nodes
+
+    def _scatter(self, message: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+        """Send a request to every shard; returns the responses that arrived in time by shard index"""
+        futures = {self._executor.submit(shard.request, message): shard for shard in self.shards}
+        done, not_done = wait(futures, timeout=self.timeout_s + 0.05)
+
+        responses = {}
+        for future in done:
+            shard = futures[future]
+            try:
+                responses[shard.shard_index] = future.result()
+            except Exception as e:
+                print(f"⚠ Shard {shard.shard_index} {shard.address[0]}:{shard.address[1]} failed: {e}")
+        for future in not_done:
+            shard = futures[future]
+            print(f"⚠ Shard {shard.shard_index} {shard.address[0]}:{shard.address[1]} timed out")
+        return responses
+
+    def __len__(self) -> int:
+        now = time.monotonic()
+        if self._sizes_timestamp is None or now - self._sizes_timestamp >= self.size_ttl:
+            responses = self._scatter({'request_type': 'SHARD_INFO'})
+            if not responses:
+                raise ShardUnavailable("No gallery shard node is reachable")
+            for index, response in responses.items():
+                if response.get('shard_count') != len(self.shards) or response.get('shard_index') != index:
+                    print(f"⚠ Shard node {index} reports {response.get('shard_index')}/{response.get('shard_count')}, "
+                          f"expected {index}/{len(self.shards)}")
+            self._sizes_timestamp = now
+        return sum(shard.size or 0 for shard in self.shards)
+
+    def search_candidates(self, probes: np.ndarray, k: int) -> List[List[Tuple[int, float, Optional[str]]]]:
+        """Top-k per probe across all shards; each shard returns its own top-k and they are merged here"""
+        probes = np.atleast_2d(np.asarray(probes, dtype=np.float64))
+        responses = self._scatter({
+            'request_type': 'SHARD_SEARCH',
+            'encodings': probes.tolist(),
+            'k': k
+        })
+
+        with self._stats_lock:
+            self.stats['searches'] += 1
+            if not responses or (self.require_all and len(responses) < len(self.shards)):
+                self.stats['failed_searches'] += 1
+                raise ShardUnavailable(f"Only {len(responses)} of {len(self.shards)} gallery shards answered")
+            if len(responses) < len(self.shards):
+                self.stats['partial_searches'] += 1
+
+        merged = []
+        for probe_index in range(len(probes)):
+            candidates = (
+                (customer_id, float(distance), name)
+                for response in responses.values()
+                for customer_id, distance, name in response['results'][probe_index]
+            )
+            merged.append(heapq.nsmallest(k, candidates, key=lambda candidate: candidate[1]))
+        return merged
+
+    def owner_of(self, customer_id: int) -> 'ShardClient':
+        return self.shards[customer_id % len(self.shards)]
+
+    def notify_registered(self, customer: Dict[str, Any]):
+        """Add a new customer to its owning shard so it is searchable immediately"""
+        self._notify_owner(customer['customer_id'], {
+            'request_type': 'SHARD_ADD',
+            'customer': {
+                'customer_id': customer['customer_id'],
+                'name': customer.get('name'),
+                'face_encoding': [float(value) for value in customer['face_encoding']]
+            }
+        }, 'register')
+
+    def notify_deleted(self, customer_id: int):
+        """Remove an erased customer from its owning shard so it stops matching"""
+        self._notify_owner(customer_id, {'request_type': 'SHARD_REMOVE', 'customer_id': customer_id}, 'delete')
+
+    def _notify_owner(self, customer_id: int, message: Dict[str, Any], reason: str):
+        """One-customer update of the owning shard; on failure the shard catches up at its next reload"""
+        shard = self.owner_of(customer_id)
+        try:
+            shard.request(message)
+            self._sizes_timestamp = None
+        except Exception as e:
+            print(f"⚠ Could not update shard {shard.shard_index} after {reason}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['timeout_ms'] = int(self.timeout_s * 1000)
+        stats['shards'] = [
+            dict(
+                shard.stats,
+                shard_index=shard.shard_index,
+                address=f"{shard.address[0]}:{shard.address[1]}",
+                size=shard.size,
+                avg_latency_ms=round(shard.stats['avg_latency_ms'], 2)
+            )
+            for shard in self.shards
+        ]
+        return stats
+
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+
+def get_shard_coordinator() -> Optional[ShardCoordinator]:
+    """Coordinator for SHARD_NODES, or None when this process holds the gallery itself"""
+    global _coordinator
+    spec = os.getenv('SHARD_NODES', '').strip()
+    if not spec:
+        return None
+    if _coordinator is None:
+        with _coordinator_lock:
+            if _coordinator is None:
+                _coordinator = ShardCoordinator(ShardCoordinator.parse_nodes(spec))
+    return _coordinator
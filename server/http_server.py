@@ -4,20 +4,64 @@ Provides REST API endpoints for RECOGNIZE and REGISTER requests
 Compatible with Expo Go (uses fetch API instead of TCP socket)
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import base64
+import json
 import os
+import time
+from typing import Optional
 from dotenv import load_dotenv
-from server.request_handler import RequestHandler
+from server.app_context import AppContext, get_app_context
+from server.batch import BatchRecognizer
+from server.admission import admission_controller, AdmissionRejected
 from utils.message_handler import MessageHandler
+from utils.compression import negotiate_encoding, compress, compress_stream
+from utils.capture import request_capture, outcome_of
 
 load_dotenv()
 
+
+class CompactJSONProvider(DefaultJSONProvider):
+    """jsonify() through the same compact (orjson when installed) serializer as the TCP protocol"""
+    
+    def dumps(self, obj, **kwargs):
+        if kwargs.get('indent'):
+            return super().dumps(obj, **kwargs)
+        return MessageHandler.encode_message(obj).decode('utf-8')
+
+
+# Request size limits (bytes). Batch uploads stream images, so they get their own cap.
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', 16 * 1024 * 1024))
+MAX_BATCH_REQUEST_BYTES = int(os.getenv('MAX_BATCH_REQUEST_BYTES', 512 * 1024 * 1024))
+BATCH_PATH = '/api/recognize/batch'
+
+
+class SizeLimitedRequest(Request):
+    """Request whose body limit depends on the route"""
+    
+    @property
+    def max_content_length(self):
+        # Werkzeug applies this to the body stream itself, so chunked uploads
+        # without a Content-Length stop at the same limit
+        return MAX_BATCH_REQUEST_BYTES if self.path == BATCH_PATH else MAX_REQUEST_BYTES
+
+
 app = Flask(__name__)
+app.request_class = SizeLimitedRequest
+app.json = CompactJSONProvider(app)
 CORS(app)  # Enable CORS for mobile app
 
-request_handler = RequestHandler()
-message_handler = MessageHandler()
+# Response compression negotiated from Accept-Encoding (zstd if installed, else gzip)
+HTTP_COMPRESSION = os.getenv('HTTP_COMPRESSION', 'true').lower() in ('1', 'true', 'yes')
+HTTP_COMPRESS_MIN_BYTES = int(os.getenv('HTTP_COMPRESS_MIN_BYTES', 1024))
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson'}
+
+# Bound to the shared application context by create_http_server()
+context = None
+request_handler = None
+message_handler = None
 
 
 @app.route('/', methods=['GET'])
@@ -28,17 +72,87 @@ def root():
         'version': '1.0.0',
         'endpoints': {
             'recognize': '/api/recognize (POST)',
+            'recognize_multi': '/api/recognize/multi (POST)',
+            'recognize_batch': '/api/recognize/batch (POST, NDJSON response)',
             'register': '/api/register (POST)',
+            'stats': '/api/stats (GET)',
+            'order_history': '/api/customers/<customer_id>/orders (GET)',
+            'delete_customer': '/api/customers/<customer_id> (DELETE, admin)',
+            'visit_rollups': '/api/visits/rollups (GET)',
+            'profile': '/api/admin/profile (GET, admin)',
+            'profile_requests': '/api/admin/profile/requests (GET, admin)',
             'health': '/api/health (GET)'
         }
     }), 200
 
 
-@app.route('/api/recognize', methods=['POST'])
-def recognize():
-    """Handle RECOGNIZE request via HTTP"""
+@app.before_request
+def enforce_request_size():
+    """Reject oversized bodies from Content-Length before anything is read"""
+    limit = request.max_content_length
+    if request.content_length is not None and request.content_length > limit:
+        return _payload_too_large(limit)
+    return None
+
+
+@app.after_request
+def compress_response(response):
+    """Compress JSON and NDJSON bodies with the best encoding the client accepts"""
+    if not HTTP_COMPRESSION or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None or 'Content-Encoding' in response.headers or response.status_code in (204, 304):
+        return response
+    
+    if response.is_streamed:
+        # Batch results: compress line by line so they still arrive as produced
+        response.response = compress_stream(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < HTTP_COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(compress(data, encoding))
+    
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    """Body exceeded the route's limit while streaming"""
+    return _payload_too_large(request.max_content_length)
+
+
+def _payload_too_large(limit: int):
+    return jsonify({
+        'status': 'error',
+        'error_code': 'PAYLOAD_TOO_LARGE',
+        'error_message': f'Request body exceeds the {limit} byte limit'
+    }), 413
+
+
+def _body_over_limit() -> bool:
+    """True if a body sent without Content-Length was cut off at the route's limit"""
+    if request.content_length is not None or not getattr(request.stream, 'is_exhausted', False):
+        return False
+    # Werkzeug stops reading at the limit; anything left unread means the body was larger
+    return bool(request.environ['wsgi.input'].read(1))
+
+
+def _handle_json_request(handle, endpoint: str, request_type: str):
+    """
+    Validate a JSON request body, run the handler and build the HTTP response
+    The route fixes request_type: admission control and capture use it, and a
+    body naming another type is rejected.
+    """
+    received_at, started = time.time(), time.perf_counter()
     try:
-        # Get JSON data from request
+        # Get JSON data from request (the body is read at most up to the limit)
+        request.get_data(cache=True)
+        if _body_over_limit():
+            return _payload_too_large(request.max_content_length)
         data = request.get_json()
         
         if not data:
@@ -57,23 +171,58 @@ def recognize():
                 'error_message': error_msg
             }), 400
         
-        # Handle request
-        status, response_data = request_handler.handle_recognize_request(data)
+        if data['request_type'] != request_type:
+            return jsonify({
+                'status': 'error',
+                'error_code': 'INVALID_REQUEST',
+                'error_message': f"{endpoint} only accepts request_type {request_type}"
+            }), 400
+        
+        # Handle request (shed with BUSY when overloaded)
+        headers = {}
+        try:
+            with admission_controller.admit(request_type, data.get('deadline_ms')):
+                status, response_data = handle(data)
+        except AdmissionRejected as e:
+            print(f"⚠ Shed {request_type} on {endpoint}: {e.reason}")
+            response = message_handler.build_response(
+                status='error',
+                request_id=data.get('request_id', 'unknown'),
+                error_code='BUSY',
+                error_message=f'Server busy ({e.reason}). Please retry.',
+                retry_after_ms=e.retry_after_ms,
+                return_dict=True
+            )
+            # Retry-After is in whole seconds
+            http_status = 503
+            headers['Retry-After'] = str(max(1, round(e.retry_after_ms / 1000)))
+        else:
+            # Build response
+            response = message_handler.build_response(
+                status=status,
+                request_id=data.get('request_id', 'unknown'),
+                return_dict=True,  # Return dict for HTTP API
+                **response_data
+            )
+            
+            # Return appropriate HTTP status code
+            http_status = 200 if status == 'success' else 400
         
-        # Build response
-        response = message_handler.build_response(
-            status=status,
-            request_id=data.get('request_id', 'unknown'),
-            return_dict=True,  # Return dict for HTTP API
-            **response_data
-        )
+        if request_capture.sample(request_type):
+            # get_json() cached the raw body, so this does not read it again
+            request_capture.record(
+                'http', request_type, request.get_data(), received_at,
+                (time.perf_counter() - started) * 1000.0,
+                dict(outcome_of(response), http_status=http_status),
+                endpoint=request.path,
+                method=request.method,
+                headers=dict(request.headers)
+            )
         
-        # Return appropriate HTTP status code
-        http_status = 200 if status == 'success' else 400
-        return jsonify(response), http_status
+        return jsonify(response), http_status, headers
         
     except Exception as e:
-        print(f"✗ Error in /api/recognize: {str(e)}")
+        print(f"✗ Error in {endpoint}: {str(e)}")
         return jsonify({
             'status': 'error',
             'error_code': 'SERVER_ERROR',
@@ -81,46 +230,64 @@ def recognize():
         }), 500
 
 
-@app.route('/api/register', methods=['POST'])
-def register():
-    """Handle REGISTER request via HTTP"""
+@app.route('/api/recognize', methods=['POST'])
+def recognize():
+    """Handle RECOGNIZE request via HTTP"""
+    return _handle_json_request(request_handler.handle_recognize_request, '/api/recognize', 'RECOGNIZE')
+
+
+@app.route('/api/recognize/multi', methods=['POST'])
+def recognize_multi():
+    """Handle RECOGNIZE_MULTI request via HTTP (all faces in one image)"""
+    return _handle_json_request(request_handler.handle_recognize_multi_request, '/api/recognize/multi', 'RECOGNIZE_MULTI')
+
+
+def _iter_ndjson_items(stream):
+    """Yield one batch item per NDJSON line without buffering the whole body"""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Reported per item as INVALID_REQUEST by the batch recognizer
+            yield {}
+
+
+@app.route('/api/recognize/batch', methods=['POST'])
+def recognize_batch():
+    """
+    Handle batch RECOGNIZE via HTTP
+    Accepts a JSON body {"images": [...]} or an NDJSON body (one image object
+    per line) and streams one NDJSON result line per image, then a summary.
+    """
     try:
-        # Get JSON data from request
-        data = request.get_json()
+        branch_id = request.args.get('branch_id', 'UNKNOWN')
         
-        if not data:
-            return jsonify({
-                'status': 'error',
-                'error_code': 'INVALID_REQUEST',
-                'error_message': 'Request body must be JSON'
-            }), 400
+        if request.mimetype == 'application/x-ndjson':
+            items = _iter_ndjson_items(request.stream)
+        else:
+            data = request.get_json(silent=True)
+            if not data or not isinstance(data.get('images'), list):
+                return jsonify({
+                    'status': 'error',
+                    'error_code': 'INVALID_REQUEST',
+                    'error_message': "Request body must be JSON with an 'images' list or NDJSON"
+                }), 400
+            branch_id = data.get('branch_id', branch_id)
+            items = data['images']
         
-        # Validate request
-        is_valid, error_msg = message_handler.validate_request(data)
-        if not is_valid:
-            return jsonify({
-                'status': 'error',
-                'error_code': 'INVALID_REQUEST',
-                'error_message': error_msg
-            }), 400
-        
-        # Handle request
-        status, response_data = request_handler.handle_register_request(data)
+        batch = BatchRecognizer(request_handler, message_handler)
         
-        # Build response
-        response = message_handler.build_response(
-            status=status,
-            request_id=data.get('request_id', 'unknown'),
-            return_dict=True,  # Return dict for HTTP API
-            **response_data
-        )
+        def generate():
+            for result in batch.process(items, branch_id=branch_id):
+                yield message_handler.encode_message(result) + b'\n'
         
-        # Return appropriate HTTP status code
-        http_status = 200 if status == 'success' else 400
-        return jsonify(response), http_status
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
         
     except Exception as e:
-        print(f"✗ Error in /api/register: {str(e)}")
+        print(f"✗ Error in /api/recognize/batch: {str(e)}")
         return jsonify({
             'status': 'error',
             'error_code': 'SERVER_ERROR',
@@ -128,17 +295,133 @@ def register():
         }), 500
 
 
+@app.route('/api/register', methods=['POST'])
+def register():
+    """Handle REGISTER request via HTTP"""
+    return _handle_json_request(request_handler.handle_register_request, '/api/register', 'REGISTER')
+
+
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    """Server load and queue statistics"""
+    status, response_data = request_handler.handle_stats_request({})
+    return jsonify(message_handler.build_response(status=status, return_dict=True, **response_data)), 200
+
+
+@app.route('/api/customers/<int:customer_id>/orders', methods=['GET'])
+def order_history(customer_id):
+    """One page of a customer's orders (?limit=20&cursor=...&since=...&fields=order_details,order_date)"""
+    status, response_data = request_handler.handle_order_history_request({
+        'customer_id': customer_id,
+        'limit': request.args.get('limit'),
+        'cursor': request.args.get('cursor'),
+        'since': request.args.get('since'),
+        'fields': request.args.get('fields')
+    })
+    if status == 'success':
+        http_status = 200
+    else:
+        http_status = {'INVALID_REQUEST': 400, 'CUSTOMER_NOT_FOUND': 404}.get(response_data.get('error_code'), 500)
+    return jsonify(message_handler.build_response(status=status, return_dict=True, **response_data)), http_status
+
+
+@app.route('/api/customers/<int(signed=True):customer_id>', methods=['DELETE'])
+def delete_customer(customer_id):
+    """Erase a customer: profile, face encoding and orders (X-Admin-Token header required)"""
+    status, response_data = request_handler.handle_delete_customer_request({
+        'customer_id': customer_id,
+        'admin_token': request.headers.get('X-Admin-Token')
+    })
+    if status == 'success':
+        http_status = 200
+    else:
+        http_status = {'FORBIDDEN': 403, 'INVALID_REQUEST': 400, 'CUSTOMER_NOT_FOUND': 404}.get(response_data.get('error_code'), 500)
+    return jsonify(message_handler.build_response(status=status, return_dict=True, **response_data)), http_status
+
+
+@app.route('/api/visits/rollups', methods=['GET'])
+def visit_rollups():
+    """Hourly per-branch visit aggregates (?branch_id=...&hours=24)"""
+    status, response_data = request_handler.handle_visit_rollups_request({
+        'branch_id': request.args.get('branch_id'),
+        'hours': request.args.get('hours', 24)
+    })
+    http_status = 200 if status == 'success' else 400 if response_data.get('error_code') == 'INVALID_REQUEST' else 500
+    return jsonify(message_handler.build_response(status=status, return_dict=True, **response_data)), http_status
+
+
+def _profile(message: dict):
+    """Run a PROFILE request with the X-Admin-Token header; returns (status, data, error response or None)"""
+    message['admin_token'] = request.headers.get('X-Admin-Token')
+    status, response_data = request_handler.handle_profile_request(message)
+    if status == 'success':
+        return status, response_data, None
+    http_status = {'FORBIDDEN': 403, 'PROFILER_BUSY': 409, 'INVALID_REQUEST': 400}.get(response_data.get('error_code'), 500)
+    return status, response_data, (jsonify(message_handler.build_response(status=status, return_dict=True, **response_data)), http_status)
+
+
+@app.route('/api/admin/profile', methods=['GET'])
+def admin_profile():
+    """Sample every thread for a while (?seconds=10&interval_ms=10&include_idle=0&format=collapsed|json)"""
+    status, response_data, error = _profile({
+        'seconds': request.args.get('seconds', 10),
+        'interval_ms': request.args.get('interval_ms', 10),
+        'include_idle': request.args.get('include_idle', '0').lower() in ('1', 'true', 'yes')
+    })
+    if error is not None:
+        return error
+    if request.args.get('format', 'collapsed') == 'json':
+        return jsonify(message_handler.build_response(status=status, return_dict=True, **response_data)), 200
+    return Response(response_data['profile']['collapsed'], mimetype='text/plain')
+
+
+@app.route('/api/admin/profile/requests', methods=['GET'])
+def admin_profile_requests():
+    """cProfile of sampled RECOGNIZE requests (?format=text|pstats|json&limit=40&reset=0)"""
+    status, response_data, error = _profile({
+        'target': 'requests',
+        'limit': request.args.get('limit', 40),
+        'reset': request.args.get('reset', '0').lower() in ('1', 'true', 'yes')
+    })
+    if error is not None:
+        return error
+    profile = response_data['profile']
+    output_format = request.args.get('format', 'text')
+    if output_format == 'json':
+        return jsonify(message_handler.build_response(status=status, return_dict=True, **response_data)), 200
+    if output_format == 'pstats':
+        if profile['pstats'] is None:
+            return jsonify({
+                'status': 'error',
+                'error_code': 'NO_PROFILE_DATA',
+                'error_message': 'No RECOGNIZE request has been profiled yet (PROFILE_SAMPLE_RATE)'
+            }), 404
+        return Response(base64.b64decode(profile['pstats']), mimetype='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=recognize.pstats'})
+    text = profile['text'] or f"No RECOGNIZE request profiled yet (sample rate {profile['sample_rate']})\n"
+    return Response(text, mimetype='text/plain')
+
+
 @app.route('/api/health', methods=['GET'])
 def health():
     """Health check endpoint"""
     return jsonify({
         'status': 'ok',
-        'message': 'Server is running'
+        'message': 'Server is running',
+        'ready': context.engine.warmed_up
     }), 200
 
 
-def create_http_server():
-    """Create and return Flask app instance"""
+def create_http_server(app_context: Optional[AppContext] = None):
+    """
+    Bind the Flask app to the application context and return it
+    The TCP server gets the same context, so both transports share one
+    gallery cache and engine.
+    """
+    global context, request_handler, message_handler
+    context = app_context or get_app_context()
+    request_handler = context.request_handler
+    message_handler = context.message_handler
     return app
 
 
@@ -147,12 +430,25 @@ if __name__ == "__main__":
     http_port = int(os.getenv('HTTP_PORT', 8889))
     http_host = os.getenv('HTTP_HOST', '0.0.0.0')
     
+    create_http_server()
+    
+    # Load the face models before accepting requests
+    context.engine.warm_up()
+    
     print(f"=" * 60)
     print(f"🌐 HTTP API Server Starting")
     print(f"📍 Listening on {http_host}:{http_port}")
     print(f"💡 Endpoints:")
     print(f"   - POST /api/recognize")
+    print(f"   - POST /api/recognize/multi")
+    print(f"   - POST /api/recognize/batch")
     print(f"   - POST /api/register")
+    print(f"   - GET  /api/stats")
+    print(f"   - GET  /api/customers/<id>/orders")
+    print(f"   - DELETE /api/customers/<id>")
+    print(f"   - GET  /api/visits/rollups")
+    print(f"   - GET  /api/admin/profile")
+    print(f"   - GET  /api/admin/profile/requests")
     print(f"   - GET  /api/health")
     print(f"=" * 60)
     
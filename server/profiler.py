@@ -0,0 +1,167 @@
+"""
+Profiling Hooks
+On-demand sampling profiler over all threads (collapsed stacks) and an
+optional cProfile of a sampled fraction of RECOGNIZE requests (pstats)
+"""
+
+import cProfile
+import hmac
+import io
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Leaf functions of threads that are blocked rather than using CPU
+IDLE_FUNCTIONS = {
+    'wait', 'accept', 'select', 'poll', 'sleep', 'recv', 'recv_into', 'readinto',
+    '_recv_exact_into', '_wait_for_tstate_lock', 'get', 'serve_forever', 'handle_request',
+}
+
+
+class ProfilerBusy(Exception):
+    """A sampling profile is already running"""
+
+
+def admin_authorized(token: Optional[str]) -> bool:
+    """True if the token matches ADMIN_TOKEN; admin commands are off while ADMIN_TOKEN is unset"""
+    expected = os.getenv('ADMIN_TOKEN', '')
+    return bool(expected) and token is not None and hmac.compare_digest(str(token), expected)
+
+
+class SamplingProfiler:
+    """Time-boxed stack sampler over every thread of the process"""
+
+    def __init__(self):
+        self.max_seconds = float(os.getenv('PROFILE_MAX_SECONDS', 60))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        """Stack as 'outer;...;leaf' with module:function:line frames"""
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            frames.append(f"{module}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
+
+    def profile(self, seconds: float = 10.0, interval_ms: float = 10.0, include_idle: bool = False) -> Dict[str, Any]:
+        """
+        Sample all other threads' stacks for a while
+        Returns: {'samples', 'seconds', 'interval_ms', 'threads', 'stacks': {collapsed stack: count}}
+        Raises: ProfilerBusy if another profile is running
+        """
+        seconds = min(max(float(seconds), 0.1), self.max_seconds)
+        interval = max(float(interval_ms), 1.0) / 1000.0
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+
+        try:
+            names = {}
+            stacks = Counter()
+            samples = 0
+            own_id = threading.get_ident()
+            deadline = time.monotonic() + seconds
+
+            while time.monotonic() < deadline:
+                for thread in threading.enumerate():
+                    names[thread.ident] = thread.name
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    if not include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                        continue
+                    thread_name = names.get(thread_id, str(thread_id))
+                    stacks[f"{thread_name};{self._collapse(frame)}"] += 1
+                samples += 1
+                time.sleep(interval)
+
+            return {
+                'samples': samples,
+                'seconds': seconds,
+                'interval_ms': interval * 1000.0,
+                'threads': len({stack.split(';', 1)[0] for stack in stacks}),
+                'stacks': dict(stacks.most_common())
+            }
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def to_collapsed(profile: Dict[str, Any]) -> str:
+        """Collapsed-stack text (one 'stack count' line each), as read by flamegraph.pl and speedscope"""
+        return ''.join(f"{stack} {count}\n" for stack, count in profile['stacks'].items())
+
+
+class RequestProfiler:
+    """
+    cProfile of a random PROFILE_SAMPLE_RATE fraction of RECOGNIZE requests,
+    aggregated into one pstats report
+    When the rate is 0 (default) start() is a single comparison.
+    """
+
+    def __init__(self):
+        self.sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+        self._lock = threading.Lock()
+        self._stats = None
+        self.profiled = 0
+        self.skipped = 0
+
+    def start(self) -> Optional[cProfile.Profile]:
+        """Begin profiling this request if it is sampled; returns the profile or None"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active (one at a time per interpreter on newer Pythons)
+            self.skipped += 1
+            return None
+        return profile
+
+    def finish(self, profile: cProfile.Profile):
+        profile.disable()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.profiled += 1
+
+    def report(self, limit: int = 40, reset: bool = False) -> Dict[str, Any]:
+        """
+        Aggregated profile of the sampled requests
+        Returns: {'profiled', 'sample_rate', 'skipped', 'text' (top functions by
+                  cumulative time), 'pstats' (bytes in the dump_stats file format:
+                  save them to a file and open with pstats.Stats or snakeviz)}
+        """
+        with self._lock:
+            stats, profiled = self._stats, self.profiled
+            if reset:
+                self._stats, self.profiled = None, 0
+
+        report = {'profiled': profiled, 'sample_rate': self.sample_rate, 'skipped': self.skipped, 'text': '', 'pstats': None}
+        if stats is None:
+            return report
+
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats('cumulative').print_stats(limit)
+        report['text'] = output.getvalue()
+        report['pstats'] = marshal.dumps(stats.stats)
+        return report
+
+
+# Global instances shared by both transports
+sampling_profiler = SamplingProfiler()
+request_profiler = RequestProfiler()
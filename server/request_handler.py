@@ -3,24 +3,81 @@ Request Handler Module
 Handles different types of requests (RECOGNIZE, REGISTER)
 """
 
-from typing import Dict, Any, Tuple
-from models.face_recognition import face_engine
-from database.models import CustomerModel, OrderModel
+import base64
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Tuple, Optional, Union
+from models.face_recognition import FaceRecognitionEngine, get_face_engine
+from models.gallery import FaceGallery, ShardedGallery, ShardHitStats, RemoteGallery
+from database.models import CustomerModel, OrderModel, VisitModel, ORDER_PAGE_DEFAULT
+from database.connection import db_connection
+from database.write_behind import write_behind
+from database.edge_cache import get_edge_cache
+from server.admission import admission_controller
+from server.coordinator import get_shard_coordinator
+from server.profiler import sampling_profiler, request_profiler, admin_authorized, ProfilerBusy, SamplingProfiler
+from utils.capture import request_capture
 import numpy as np
 
+# Face engine statuses that end a request, with the message shown to the user
+FACE_ERRORS = {
+    'NO_FACE_DETECTED': 'No face detected in the image. Please try again.',
+    'FACE_ENCODING_FAILED': 'Failed to extract face encoding. Please try again.',
+    'FACE_TOO_SMALL': 'Face is too small in the image. Please move closer to the camera.',
+    'FACE_TOO_BLURRY': 'Image is too blurry. Please hold still and try again.',
+    'POOR_LIGHTING': 'Image is too dark or too bright. Please adjust the lighting and try again.',
+    'FACE_NOT_FRONTAL': 'Face is turned away. Please look straight at the camera.',
+}
+
+# Longest look-back (hours) served by VISIT_ROLLUPS
+MAX_ROLLUP_HOURS = 24 * 31
+
 
 class RequestHandler:
     """Handle different types of requests"""
     
-    def __init__(self):
-        # Cache for customer encodings (for performance)
-        self._customers_cache = None
-        self._cache_timestamp = None
+    def __init__(self, engine: Optional[FaceRecognitionEngine] = None):
+        # Face engine used by every handler (the AppContext's engine)
+        self.engine = engine or get_face_engine()
+        
+        # Cached sharded gallery, published as one (gallery, built_at, edge_version)
+        # tuple so readers take it without locking; rebuilds and appends
+        # serialize on the cache lock and swap in a new tuple
+        self._gallery_entry = None
+        self._cache_lock = threading.Lock()
+        self.cache_ttl = float(os.getenv('GALLERY_CACHE_TTL', 60))
+        # Set by REGISTER: the next rebuild reads the primary so a lagging
+        # secondary cannot hide the customer that was just created
+        self._fresh_read = False
+        
+        # Erased customers are tombstoned in the cached gallery; once tombstones
+        # exceed this share of its rows a background thread compacts it
+        self.compact_ratio = float(os.getenv('GALLERY_COMPACT_RATIO', 0.1))
+        self._compaction_thread = None
+        # Updated under _cache_lock by the compaction thread and erase requests
+        self._compaction_stats = {'compactions': 0, 'last_compaction_ms': None, 'erased': 0}
+        
+        # Branch served by this process. With GALLERY_LOCAL_ONLY only its shard
+        # is loaded up front; the global gallery is loaded on the first miss.
+        self.local_branch_id = os.getenv('GALLERY_BRANCH_ID', '')
+        self.local_only = os.getenv('GALLERY_LOCAL_ONLY', 'false').lower() in ('1', 'true', 'yes')
+        self._shard_stats = ShardHitStats()
+        
+        # Record every RECOGNIZE outcome in the visits collection (write-behind)
+        self.record_visits = os.getenv('RECORD_VISITS', 'true').lower() in ('1', 'true', 'yes')
+        
+        # EDGE_MODE: gallery, customer and latest order reads come from the
+        # local replica; the cached gallery is rebuilt when its version moves
+        self.edge_cache = get_edge_cache()
     
-    def _get_customers_cache(self):
-        """Get cached customers list, reload if needed"""
-        # For now, always reload (can optimize later with cache invalidation)
-        customers = CustomerModel.get_all_customers_with_encodings()
+    def _get_customers_cache(self, home_branch_id: Optional[str] = None, fresh: bool = False):
+        """Load customers with encodings from the database (or the edge replica)"""
+        if self.edge_cache is not None:
+            return self.edge_cache.load_customers(home_branch_id)
+        
+        customers = CustomerModel.get_all_customers_with_encodings(home_branch_id, fresh=fresh)
         
         # Convert encodings to numpy arrays
         for customer in customers:
@@ -29,58 +86,224 @@ class RequestHandler:
         
         return customers
     
-    def handle_recognize_request(self, message: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    def _is_current(self, entry) -> bool:
+        """Whether a cached gallery entry may still be served"""
+        if self.edge_cache is not None:
+            # Local reads are cheap; rebuild exactly when the replica changed
+            return entry[2] == self.edge_cache.version
+        return time.monotonic() - entry[1] < self.cache_ttl
+    
+    def get_gallery_snapshot(self) -> Union[ShardedGallery, RemoteGallery]:
+        """
+        Cached branch-sharded gallery, rebuilt after GALLERY_CACHE_TTL
+        Lock-free for readers: the snapshot is immutable. When it expires one
+        thread rebuilds it while the others keep serving the old snapshot.
+        In coordinator mode (SHARD_NODES set) the gallery lives on the shard
+        nodes and the coordinator is returned instead.
+        """
+        coordinator = get_shard_coordinator()
+        if coordinator is not None:
+            return coordinator
+        
+        entry = self._gallery_entry
+        if entry is not None and self._is_current(entry):
+            return entry[0]
+        
+        # Only the very first load makes readers wait
+        if not self._cache_lock.acquire(blocking=entry is None):
+            return entry[0]
+        try:
+            entry = self._gallery_entry
+            if entry is not None and self._is_current(entry):
+                return entry[0]
+            
+            edge_version = self.edge_cache.version if self.edge_cache is not None else None
+            fresh, self._fresh_read = self._fresh_read, False
+            if self.local_only and self.local_branch_id:
+                gallery = ShardedGallery(
+                    self._get_customers_cache(self.local_branch_id, fresh=fresh),
+                    global_loader=lambda: FaceGallery(self._get_customers_cache(fresh=fresh)),
+                    stats=self._shard_stats
+                )
+            else:
+                gallery = ShardedGallery(self._get_customers_cache(fresh=fresh), stats=self._shard_stats)
+            
+            self._gallery_entry = (gallery, time.monotonic(), edge_version)
+            return gallery
+        finally:
+            self._cache_lock.release()
+    
+    def add_to_gallery(self, customer: Dict[str, Any]):
+        """
+        Make a just-registered customer searchable without reloading the gallery
+        The row is appended copy-on-write and a new snapshot is published;
+        requests holding the previous snapshot are unaffected. Taken under the
+        cache lock, so an append cannot be lost to a rebuild in progress.
+        """
+        with self._cache_lock:
+            # The next full reload reads the primary so a lagging secondary
+            # cannot drop the customer again
+            self._fresh_read = True
+            entry = self._gallery_entry
+            if entry is not None:
+                self._gallery_entry = (entry[0].with_customer(customer), entry[1], entry[2])
+    
+    def remove_from_gallery(self, customer_id: int):
+        """
+        Tombstone an erased customer in the cached gallery; it stops matching at once
+        Compaction runs in the background when tombstones pass GALLERY_COMPACT_RATIO.
+        """
+        with self._cache_lock:
+            # A rebuild started before the delete could still read the customer from a secondary
+            self._fresh_read = True
+            entry = self._gallery_entry
+            if entry is None:
+                return
+            gallery = entry[0].without_customer(customer_id)
+            self._gallery_entry = (gallery, entry[1], entry[2])
+        
+        if gallery.tombstone_ratio() > self.compact_ratio:
+            self._start_compaction()
+    
+    def _start_compaction(self):
+        with self._cache_lock:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(target=self._compact_gallery, name='gallery-compaction', daemon=True)
+            self._compaction_thread.start()
+    
+    def _compact_gallery(self):
+        """
+        Replace the cached gallery with a copy without tombstoned rows
+        The copy is built outside the lock while requests keep using the
+        current snapshot; it is published only if no REGISTER or erase changed
+        the gallery meanwhile (after three tries it is built under the lock).
+        """
+        started = time.perf_counter()
+        try:
+            for _ in range(3):
+                entry = self._gallery_entry
+                if entry is None:
+                    return
+                compacted = entry[0].compacted()
+                with self._cache_lock:
+                    if self._gallery_entry is entry:
+                        self._gallery_entry = (compacted, entry[1], entry[2])
+                        break
+            else:
+                with self._cache_lock:
+                    entry = self._gallery_entry
+                    if entry is None:
+                        return
+                    self._gallery_entry = (entry[0].compacted(), entry[1], entry[2])
+        except Exception as e:
+            print(f"✗ Gallery compaction failed: {e}")
+            return
+        
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        with self._cache_lock:
+            self._compaction_stats['compactions'] += 1
+            self._compaction_stats['last_compaction_ms'] = round(elapsed_ms, 1)
+        print(f"✓ Gallery compacted in {elapsed_ms:.0f} ms")
+    
+    @staticmethod
+    def _face_error(status: str) -> Tuple[str, Dict[str, Any]]:
+        """Build the error response for a failed face engine status"""
+        return 'error', {
+            'error_code': status if status in FACE_ERRORS else 'FACE_ENCODING_FAILED',
+            'error_message': FACE_ERRORS.get(status, FACE_ERRORS['FACE_ENCODING_FAILED'])
+        }
+    
+    def _get_customer(self, customer_id: int) -> Optional[Dict[str, Any]]:
+        if self.edge_cache is not None:
+            return self.edge_cache.get_customer(customer_id)
+        return CustomerModel.get_customer_by_id(customer_id)
+    
+    def _get_latest_order(self, customer_id: int) -> Optional[Dict[str, Any]]:
+        if self.edge_cache is not None:
+            return self.edge_cache.get_latest_order(customer_id)
+        return OrderModel.get_latest_order(customer_id)
+    
+    def _get_latest_orders(self, customer_ids) -> Dict[int, Dict[str, Any]]:
+        if self.edge_cache is not None:
+            return self.edge_cache.get_latest_orders(customer_ids)
+        return OrderModel.get_latest_orders(customer_ids)
+    
+    @staticmethod
+    def format_order(order):
+        """Convert an order document to its response representation"""
+        if not order:
+            return None
+        return {
+            'order_details': order['order_details'],
+            'order_date': order['order_date'].isoformat(),
+            'branch_id': order['branch_id']
+        }
+    
+    def handle_recognize_request(self, message: Dict[str, Any], gallery: Optional[FaceGallery] = None) -> Tuple[str, Dict[str, Any]]:
         """
         Handle RECOGNIZE request
+        Every outcome is recorded as a visit event with its stage latencies.
+        Args:
+            gallery: Optional prebuilt gallery snapshot (used by batch requests)
         Returns: (status, response_data)
         """
+        started = time.perf_counter()
+        visit = {'outcome': 'PROCESSING_ERROR', 'customer_id': None, 'distance': None, 'latency_ms': {}}
+        # None unless this request was sampled (PROFILE_SAMPLE_RATE)
+        profile = request_profiler.start()
+        try:
+            return self._recognize(message, gallery, visit)
+        finally:
+            if profile is not None:
+                request_profiler.finish(profile)
+            visit['latency_ms']['total_ms'] = (time.perf_counter() - started) * 1000.0
+            self._record_visit(message.get('branch_id', 'UNKNOWN'), visit)
+    
+    def _recognize(self, message: Dict[str, Any], gallery: Optional[FaceGallery], visit: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """RECOGNIZE processing; fills the visit record with the outcome"""
         try:
             image_data = message['image_data']
             branch_id = message.get('branch_id', 'UNKNOWN')
             
             # Get all customers with encodings
-            customers = self._get_customers_cache()
+            customers = gallery if gallery is not None else self.get_gallery_snapshot()
             
             if len(customers) == 0:
                 # No customers in database
+                visit['outcome'] = 'NOT_RECOGNIZED'
                 return 'success', {
                     'recognized': False,
                     'message': 'No customers in database'
                 }
             
             # Recognize face
-            customer_id, distance, status = face_engine.recognize_face(
+            customer_id, distance, status = self.engine.recognize_face(
                 image_data,
-                customers
+                customers,
+                face_box=message.get('face_box'),
+                face_crop=bool(message.get('face_crop', False)),
+                branch_id=branch_id,
+                timings=visit['latency_ms']
             )
+            visit['outcome'] = status
+            visit['distance'] = distance if np.isfinite(distance) else None
             
-            if status == "NO_FACE_DETECTED":
-                return 'error', {
-                    'error_code': 'NO_FACE_DETECTED',
-                    'error_message': 'No face detected in the image. Please try again.'
-                }
-            
-            elif status == "FACE_ENCODING_FAILED":
-                return 'error', {
-                    'error_code': 'FACE_ENCODING_FAILED',
-                    'error_message': 'Failed to extract face encoding. Please try again.'
-                }
+            if status in FACE_ERRORS:
+                return self._face_error(status)
             
             elif status == "RECOGNIZED":
+                visit['customer_id'] = customer_id
+                lookup_started = time.perf_counter()
+                
                 # Get customer info
-                customer = CustomerModel.get_customer_by_id(customer_id)
+                customer = self._get_customer(customer_id)
                 customer_name = customer['name'] if customer else None
                 
                 # Get latest order
-                latest_order = OrderModel.get_latest_order(customer_id)
-                
-                order_data = None
-                if latest_order:
-                    order_data = {
-                        'order_details': latest_order['order_details'],
-                        'order_date': latest_order['order_date'].isoformat(),
-                        'branch_id': latest_order['branch_id']
-                    }
+                latest_order = self._get_latest_order(customer_id)
+                order_data = self.format_order(latest_order)
+                visit['latency_ms']['lookup_ms'] = (time.perf_counter() - lookup_started) * 1000.0
                 
                 return 'success', {
                     'recognized': True,
@@ -97,6 +320,80 @@ class RequestHandler:
                 
         except Exception as e:
             print(f"✗ Error in handle_recognize_request: {str(e)}")
+            visit['outcome'] = 'PROCESSING_ERROR'
+            return 'error', {
+                'error_code': 'PROCESSING_ERROR',
+                'error_message': f'Error processing request: {str(e)}'
+            }
+    
+    def _record_visit(self, branch_id: str, visit: Dict[str, Any]):
+        """Queue a visit event; never fails the request"""
+        if not self.record_visits:
+            return
+        try:
+            VisitModel.record_visit(
+                branch_id,
+                visit['outcome'],
+                customer_id=visit['customer_id'],
+                distance=visit['distance'],
+                latency_ms=visit['latency_ms']
+            )
+        except Exception as e:
+            print(f"⚠ Could not record visit: {str(e)}")
+    
+    def handle_recognize_multi_request(self, message: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Handle RECOGNIZE_MULTI request (every face in the image)
+        Each face is recorded as a visit event; a request that finds no face
+        or fails is recorded as one visit with that outcome.
+        Returns: (status, response_data)
+        """
+        started = time.perf_counter()
+        visits = []
+        try:
+            return self._recognize_multi(message, visits)
+        finally:
+            total_ms = (time.perf_counter() - started) * 1000.0
+            if not visits:
+                visits.append({'outcome': 'PROCESSING_ERROR', 'customer_id': None, 'distance': None})
+            for visit in visits:
+                visit['latency_ms'] = {'total_ms': total_ms}
+                self._record_visit(message.get('branch_id', 'UNKNOWN'), visit)
+    
+    def _recognize_multi(self, message: Dict[str, Any], visits: List[Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
+        """RECOGNIZE_MULTI processing; appends one visit record per face"""
+        try:
+            image_data = message['image_data']
+            
+            # One gallery snapshot for all probes
+            gallery = self.get_gallery_snapshot()
+            
+            faces, status = self.engine.recognize_faces(image_data, gallery, message.get('branch_id', 'UNKNOWN'))
+            
+            if status in FACE_ERRORS:
+                visits.append({'outcome': status, 'customer_id': None, 'distance': None})
+                return self._face_error(status)
+            
+            # Latest orders for all recognized customers in one query
+            recognized_ids = list({face['customer_id'] for face in faces if face['customer_id'] is not None})
+            latest_orders = self._get_latest_orders(recognized_ids)
+            
+            for face in faces:
+                face['recognized'] = face['customer_id'] is not None
+                face['latest_order'] = self.format_order(latest_orders.get(face['customer_id']))
+                visits.append({
+                    'outcome': 'RECOGNIZED' if face['recognized'] else 'NOT_RECOGNIZED',
+                    'customer_id': face['customer_id'],
+                    'distance': face['distance'] if face['distance'] is not None and np.isfinite(face['distance']) else None
+                })
+            
+            return 'success', {
+                'recognized': any(face['recognized'] for face in faces),
+                'faces': faces
+            }
+            
+        except Exception as e:
+            print(f"✗ Error in handle_recognize_multi_request: {str(e)}")
             return 'error', {
                 'error_code': 'PROCESSING_ERROR',
                 'error_message': f'Error processing request: {str(e)}'
@@ -114,33 +411,40 @@ class RequestHandler:
             branch_id = message.get('branch_id', 'UNKNOWN')
             
             # Decode image and extract face encoding
-            image_array = face_engine.decode_image_from_base64(image_data)
-            face_encoding, status = face_engine.detect_and_extract_face_encoding(image_array)
+            image_array = self.engine.decode_image_from_base64(image_data)
+            face_encoding, status = self.engine.detect_and_extract_face_encoding(
+                image_array,
+                face_box=message.get('face_box'),
+                face_crop=bool(message.get('face_crop', False)),
+                profile='register'
+            )
             
             if face_encoding is None:
-                if status == "NO_FACE_DETECTED":
-                    return 'error', {
-                        'error_code': 'NO_FACE_DETECTED',
-                        'error_message': 'No face detected in the image. Please try again.'
-                    }
-                else:
-                    return 'error', {
-                        'error_code': 'FACE_ENCODING_FAILED',
-                        'error_message': 'Failed to extract face encoding. Please try again.'
-                    }
+                return self._face_error(status)
+            
+            if self.edge_cache is not None:
+                # Recognizable at this branch right away; the outbox syncs it to MongoDB
+                customer_id = self.edge_cache.queue_registration(customer_name, face_encoding, order_details, branch_id)
+                return 'success', {
+                    'message': 'Customer registered (pending sync with the central database)',
+                    'customer_id': customer_id
+                }
             
             # Convert numpy array to list for MongoDB storage
             face_encoding_list = face_encoding.tolist()
             
             # Create customer
-            customer = CustomerModel.create_customer(customer_name, face_encoding_list)
+            customer = CustomerModel.create_customer(customer_name, face_encoding_list, home_branch_id=branch_id)
             customer_id = customer['customer_id']
             
-            # Create order
-            order = OrderModel.create_order(customer_id, order_details, branch_id)
+            # The order is not needed for the response: write it behind
+            OrderModel.create_order_deferred(customer_id, order_details, branch_id)
             
-            # Invalidate cache
-            self._customers_cache = None
+            # Searchable right away; the cached gallery is not reloaded
+            self.add_to_gallery(customer)
+            coordinator = get_shard_coordinator()
+            if coordinator is not None:
+                coordinator.notify_registered(customer)
             
             return 'success', {
                 'message': 'Customer registered successfully',
@@ -153,4 +457,229 @@ class RequestHandler:
                 'error_code': 'PROCESSING_ERROR',
                 'error_message': f'Error processing request: {str(e)}'
             }
-
+    
+    def handle_order_history_request(self, message: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Handle ORDER_HISTORY request (one page of a customer's orders, newest first)
+        Fields: 'customer_id', optional 'limit', 'cursor' (next_cursor of the
+        previous page), 'since' (cursor of an order already seen; only newer
+        orders are returned) and 'fields' (list or comma-separated string)
+        Returns: (status, response_data)
+        """
+        try:
+            customer_id = int(message['customer_id'])
+            fields = message.get('fields')
+            if isinstance(fields, str):
+                fields = [field.strip() for field in fields.split(',') if field.strip()]
+            
+            if CustomerModel.get_customer_by_id(customer_id) is None:
+                return 'error', {
+                    'error_code': 'CUSTOMER_NOT_FOUND',
+                    'error_message': f'Customer {customer_id} not found'
+                }
+            
+            orders, next_cursor = OrderModel.get_orders_page(
+                customer_id,
+                limit=message.get('limit') or ORDER_PAGE_DEFAULT,
+                cursor=message.get('cursor'),
+                since=message.get('since'),
+                fields=fields
+            )
+            
+            for order in orders:
+                if 'order_date' in order:
+                    order['order_date'] = order['order_date'].isoformat()
+            
+            return 'success', {
+                'customer_id': customer_id,
+                'orders': orders,
+                'next_cursor': next_cursor
+            }
+            
+        except (TypeError, ValueError) as e:
+            return 'error', {
+                'error_code': 'INVALID_REQUEST',
+                'error_message': str(e)
+            }
+        except Exception as e:
+            print(f"✗ Error in handle_order_history_request: {str(e)}")
+            return 'error', {
+                'error_code': 'PROCESSING_ERROR',
+                'error_message': f'Error processing request: {str(e)}'
+            }
+    
+    def handle_visit_rollups_request(self, message: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Handle VISIT_ROLLUPS request (hourly per-branch visit aggregates)
+        Optional fields: 'branch_id', 'hours' (look-back window, default 24)
+        Returns: (status, response_data)
+        """
+        try:
+            hours = min(max(int(message.get('hours', 24)), 1), MAX_ROLLUP_HOURS)
+            since = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours)
+            rollups = VisitModel.get_rollups(message.get('branch_id'), since, limit=MAX_ROLLUP_HOURS)
+            
+            for rollup in rollups:
+                rollup['hour'] = rollup['hour'].isoformat()
+                rollup.pop('rolled_up_at', None)
+            
+            return 'success', {'rollups': rollups}
+            
+        except (TypeError, ValueError) as e:
+            return 'error', {
+                'error_code': 'INVALID_REQUEST',
+                'error_message': f"Invalid 'hours': {str(e)}"
+            }
+        except Exception as e:
+            print(f"✗ Error in handle_visit_rollups_request: {str(e)}")
+            return 'error', {
+                'error_code': 'PROCESSING_ERROR',
+                'error_message': f'Error processing request: {str(e)}'
+            }
+    
+    def handle_profile_request(self, message: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Handle PROFILE request (admin only, needs 'admin_token' == ADMIN_TOKEN)
+        'target': 'sampling' (default) samples every thread's stack for
+        'seconds' at 'interval_ms' and returns collapsed stacks; 'requests'
+        returns the aggregated cProfile of sampled RECOGNIZE calls as text and
+        base64 pstats ('reset': true starts a new aggregate)
+        Returns: (status, response_data)
+        """
+        if not admin_authorized(message.get('admin_token')):
+            return 'error', {
+                'error_code': 'FORBIDDEN',
+                'error_message': 'A valid admin token is required (ADMIN_TOKEN)'
+            }
+        
+        try:
+            if message.get('target', 'sampling') == 'requests':
+                report = request_profiler.report(limit=int(message.get('limit', 40)), reset=bool(message.get('reset', False)))
+                if report['pstats'] is not None:
+                    report['pstats'] = base64.b64encode(report['pstats']).decode('ascii')
+                return 'success', {'profile': report}
+            
+            profile = sampling_profiler.profile(
+                seconds=float(message.get('seconds', 10)),
+                interval_ms=float(message.get('interval_ms', 10)),
+                include_idle=bool(message.get('include_idle', False))
+            )
+            profile['collapsed'] = SamplingProfiler.to_collapsed(profile)
+            del profile['stacks']
+            return 'success', {'profile': profile}
+            
+        except ProfilerBusy as e:
+            return 'error', {
+                'error_code': 'PROFILER_BUSY',
+                'error_message': str(e)
+            }
+        except (TypeError, ValueError) as e:
+            return 'error', {
+                'error_code': 'INVALID_REQUEST',
+                'error_message': str(e)
+            }
+    
+    def handle_delete_customer_request(self, message: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Handle DELETE_CUSTOMER request (erase; admin only, needs 'admin_token')
+        Deletes the customer with their face encoding and orders, detaches
+        their visit events, tombstones them in the live gallery and drops
+        them from the edge replica. Other branches learn about the erase from
+        the tombstone on their next sync.
+        Returns: (status, response_data)
+        """
+        if not admin_authorized(message.get('admin_token')):
+            return 'error', {
+                'error_code': 'FORBIDDEN',
+                'error_message': 'A valid admin token is required (ADMIN_TOKEN)'
+            }
+        
+        try:
+            customer_id = int(message['customer_id'])
+        except (TypeError, ValueError):
+            return 'error', {
+                'error_code': 'INVALID_REQUEST',
+                'error_message': "'customer_id' must be an integer"
+            }
+        
+        try:
+            if customer_id < 0:
+                # Provisional id of a registration that has not reached MongoDB yet
+                if self.edge_cache is None or not self.edge_cache.delete_customer(customer_id):
+                    return 'error', {
+                        'error_code': 'CUSTOMER_NOT_FOUND',
+                        'error_message': f'Customer {customer_id} not found (synced registrations have a new id)'
+                    }
+                erased = {'customers': 1, 'orders': 0, 'visits_anonymized': 0}
+            else:
+                if not CustomerModel.delete_customer(customer_id):
+                    return 'error', {
+                        'error_code': 'CUSTOMER_NOT_FOUND',
+                        'error_message': f'Customer {customer_id} not found'
+                    }
+                erased = {
+                    'customers': 1,
+                    'orders': OrderModel.delete_orders_for_customer(customer_id),
+                    'visits_anonymized': VisitModel.anonymize_customer(customer_id)
+                }
+                if self.edge_cache is not None:
+                    self.edge_cache.delete_customer(customer_id)
+            
+            self.remove_from_gallery(customer_id)
+            coordinator = get_shard_coordinator()
+            if coordinator is not None:
+                coordinator.notify_deleted(customer_id)
+            with self._cache_lock:
+                self._compaction_stats['erased'] += 1
+            
+            return 'success', {
+                'message': 'Customer erased',
+                'customer_id': customer_id,
+                'erased': erased
+            }
+            
+        except Exception as e:
+            print(f"✗ Error in handle_delete_customer_request: {str(e)}")
+            return 'error', {
+                'error_code': 'PROCESSING_ERROR',
+                'error_message': f'Error processing request: {str(e)}'
+            }
+    
+    def _gallery_stats(self) -> Dict[str, Any]:
+        """Shard sizes of the cached gallery and where searches were resolved"""
+        coordinator = get_shard_coordinator()
+        if coordinator is not None:
+            return {'coordinator': coordinator.get_stats()}
+        
+        entry = self._gallery_entry
+        gallery = entry[0] if entry is not None else None
+        return {
+            'cached': gallery is not None,
+            'local_branch_id': self.local_branch_id or None,
+            'shards': gallery.shard_sizes() if gallery is not None else {},
+            'memory': gallery.memory_usage() if gallery is not None else None,
+            'shard_hits': self._shard_stats.snapshot(),
+            'tombstones': dict(
+                self._compaction_stats,
+                ratio=round(gallery.tombstone_ratio(), 4) if gallery is not None else 0.0,
+                compact_ratio=self.compact_ratio,
+                compacting=self._compaction_thread is not None and self._compaction_thread.is_alive()
+            )
+        }
+    
+    def handle_stats_request(self, message: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Handle STATS request (server load and queue statistics)
+        Returns: (status, response_data)
+        """
+        return 'success', {
+            'stats': {
+                'admission': admission_controller.get_stats(),
+                'encoding_profiles': self.engine.get_profile_stats(),
+                'database_pool': db_connection.get_pool_stats(),
+                'write_behind': write_behind.get_stats(),
+                'gallery': self._gallery_stats(),
+                'edge_cache': self.edge_cache.get_stats() if self.edge_cache is not None else None,
+                'capture': request_capture.get_stats()
+            }
+        }
@@ -5,23 +5,41 @@ Handles multiple client connections concurrently
 
 import socket
 import threading
+import time
 import os
+from typing import Any, Dict, Optional
 from dotenv import load_dotenv
-from utils.message_handler import MessageHandler
-from server.request_handler import RequestHandler
+from utils.message_handler import ENCODING_JSON
+from server.app_context import AppContext, get_app_context
+from server.batch import BatchRecognizer
+from server.stream_session import RecognitionSession
+from server.admission import admission_controller, AdmissionRejected
+from utils.capture import request_capture, outcome_of
 
 load_dotenv()
 
+RECV_CHUNK_SIZE = 64 * 1024
+
 
 class ClientThread(threading.Thread):
     """Thread to handle individual client connection"""
     
-    def __init__(self, client_socket: socket.socket, client_address: tuple):
+    def __init__(self, client_socket: socket.socket, client_address: tuple, context: Optional[AppContext] = None):
         threading.Thread.__init__(self)
         self.client_socket = client_socket
         self.client_address = client_address
-        self.message_handler = MessageHandler()
-        self.request_handler = RequestHandler()
+        # Handlers (and their gallery cache) are shared by every connection
+        context = context or get_app_context()
+        self.message_handler = context.message_handler
+        self.request_handler = context.request_handler
+        # Largest request accepted; bigger ones are rejected before the body is
+        # read, so one connection never holds more than this in memory
+        self.max_request_bytes = int(os.getenv('MAX_REQUEST_BYTES', 16 * 1024 * 1024))
+        # Encoding of the last frame received; responses use the encoding of the first one
+        self.frame_encoding = ENCODING_JSON
+        self.response_encoding = None
+        # Set when a streamed batch or session ends without its zero-length frame
+        self.stream_interrupted = False
     
     def run(self):
         """Handle client request"""
@@ -33,10 +51,11 @@ class ClientThread(threading.Thread):
             
             if data is None:
                 return
+            received_at, started = time.time(), time.perf_counter()
             
             # Parse request
             try:
-                message = self.message_handler.parse_request(data)
+                message = self._parse_data(data)
             except ValueError as e:
                 self._send_error("INVALID_REQUEST", str(e))
                 return
@@ -51,30 +70,63 @@ class ClientThread(threading.Thread):
             request_type = message['request_type']
             request_id = message.get('request_id', 'unknown')
             
-            if request_type == 'RECOGNIZE':
-                status, response_data = self.request_handler.handle_recognize_request(message)
-            elif request_type == 'REGISTER':
-                status, response_data = self.request_handler.handle_register_request(message)
-            else:
+            if request_type == 'RECOGNIZE_BATCH':
+                self._handle_batch(message)
+                return
+            
+            if request_type == 'RECOGNIZE_STREAM':
+                self._handle_stream(message)
+                return
+            
+            handlers = {
+                'RECOGNIZE': self.request_handler.handle_recognize_request,
+                'RECOGNIZE_MULTI': self.request_handler.handle_recognize_multi_request,
+                'REGISTER': self.request_handler.handle_register_request,
+                'STATS': self.request_handler.handle_stats_request,
+                'VISIT_ROLLUPS': self.request_handler.handle_visit_rollups_request,
+                'ORDER_HISTORY': self.request_handler.handle_order_history_request,
+                'PROFILE': self.request_handler.handle_profile_request,
+                'DELETE_CUSTOMER': self.request_handler.handle_delete_customer_request,
+            }
+            if request_type not in handlers:
                 self._send_error("UNKNOWN_REQUEST_TYPE", f"Unknown request type: {request_type}")
                 return
             
+            # Sampled for replay; serialized before the handler sees the message
+            captured_body = None
+            if request_capture.sample(request_type):
+                captured_body = self.message_handler.encode_message(message, self.frame_encoding)
+            
+            try:
+                with admission_controller.admit(request_type, message.get('deadline_ms')):
+                    status, response_data = handlers[request_type](message)
+            except AdmissionRejected as e:
+                print(f"⚠ Shed {request_type} from {self.client_address}: {e.reason}")
+                status, response_data = 'error', {
+                    'error_code': 'BUSY',
+                    'error_message': f'Server busy ({e.reason}). Please retry.',
+                    'retry_after_ms': e.retry_after_ms
+                }
+            
             # Build and send response
             response = self.message_handler.build_response(
                 status=status,
                 request_id=request_id,
+                encoding=self._wire_encoding(),
                 **response_data
             )
             
-            # Send response length first (4 bytes)
-            response_length = len(response)
-            length_bytes = response_length.to_bytes(4, byteorder='big')
-            self.client_socket.sendall(length_bytes)
-            
-            # Send response data
-            self.client_socket.sendall(response)
+            self._send_frame(response)
             print(f"✓ Response sent to {self.client_address}")
             
+            if captured_body is not None:
+                request_capture.record(
+                    'tcp', request_type, captured_body, received_at,
+                    (time.perf_counter() - started) * 1000.0,
+                    outcome_of(dict(response_data, status=status)),
+                    encoding=self.frame_encoding
+                )
+            
         except Exception as e:
             print(f"✗ Error handling client {self.client_address}: {str(e)}")
             try:
@@ -85,35 +137,58 @@ class ClientThread(threading.Thread):
             self.client_socket.close()
             print(f"← Client disconnected: {self.client_address}")
     
-    def _receive_data(self) -> bytes:
-        """Receive all data from client"""
+    def _recv_exact_into(self, view: memoryview) -> bool:
+        """Fill the buffer view from the socket; False if the peer closed early"""
+        received = 0
+        total = len(view)
+        while received < total:
+            count = self.client_socket.recv_into(view[received:], min(total - received, RECV_CHUNK_SIZE))
+            if count == 0:
+                return False
+            received += count
+        return True
+    
+    def _receive_data(self) -> Optional[bytearray]:
+        """
+        Receive one length-prefixed message from client
+        Returns the payload, b'' for a zero-length frame, or None if the
+        message could not be received or was rejected as too large.
+        """
         try:
             # Set timeout for receiving
             self.client_socket.settimeout(30.0)
             
             # First, receive the length (4 bytes)
-            length_data = self.client_socket.recv(4)
-            if not length_data or len(length_data) != 4:
+            length_data = bytearray(4)
+            if not self._recv_exact_into(memoryview(length_data)):
                 return None
             
-            message_length = int.from_bytes(length_data, byteorder='big')
-            
-            # Receive the actual message data
-            chunks = []
-            received = 0
+            message_length, encoding = self.message_handler.parse_frame_header(length_data)
+            if message_length == 0:
+                # Zero-length frame marks the end of a stream
+                return b''
             
-            while received < message_length:
-                chunk_size = min(message_length - received, 4096)
-                chunk = self.client_socket.recv(chunk_size)
-                if not chunk:
-                    return None
-                chunks.append(chunk)
-                received += len(chunk)
+            if not self.message_handler.supports_encoding(encoding):
+                self._send_error("UNSUPPORTED_ENCODING", f"This server cannot decode {encoding} frames")
+                return None
+            self.frame_encoding = encoding
+            if self.response_encoding is None:
+                self.response_encoding = encoding
             
-            if not chunks:
+            # Reject before reading a single body byte
+            if message_length > self.max_request_bytes:
+                print(f"✗ Rejected {message_length} byte request from {self.client_address} (limit {self.max_request_bytes})")
+                self._send_error(
+                    "PAYLOAD_TOO_LARGE",
+                    f"Request of {message_length} bytes exceeds the {self.max_request_bytes} byte limit"
+                )
                 return None
             
-            return b''.join(chunks)
+            # Receive straight into one preallocated buffer
+            buffer = bytearray(message_length)
+            if not self._recv_exact_into(memoryview(buffer)):
+                return None
+            return buffer
             
         except socket.timeout:
             print(f"✗ Timeout receiving data from {self.client_address}")
@@ -122,22 +197,143 @@ class ClientThread(threading.Thread):
             print(f"✗ Error receiving data: {str(e)}")
             return None
     
+    def _parse_data(self, data) -> Dict[str, Any]:
+        """Parse received data in the frame's encoding"""
+        return self.message_handler.parse_request(data, self.frame_encoding)
+    
+    def _wire_encoding(self) -> str:
+        """Encoding the client used for its request (JSON until a frame arrives)"""
+        return self.response_encoding or ENCODING_JSON
+    
+    def _encode(self, message: Dict[str, Any]) -> bytes:
+        """Serialize a message in the client's wire encoding"""
+        return self.message_handler.encode_message(message, self._wire_encoding())
+    
+    def _send_frame(self, payload: bytes):
+        """Send one length-prefixed frame"""
+        # Send length first (4 bytes, high bit flags MessagePack), then the payload
+        self.client_socket.sendall(self.message_handler.frame_header(len(payload), self._wire_encoding()))
+        self.client_socket.sendall(payload)
+    
+    def _iter_stream_items(self):
+        """
+        Yield batch items sent as frames until a zero-length frame
+        A timeout, socket error or rejected frame also ends the items, but
+        sets stream_interrupted so the caller reports an error instead of
+        completing normally.
+        """
+        self.stream_interrupted = False
+        while True:
+            data = self._receive_data()
+            if data is None:
+                self.stream_interrupted = True
+                return
+            if not data:
+                return
+            try:
+                yield self._parse_data(data)
+            except ValueError:
+                # Reported per item as INVALID_REQUEST by the batch recognizer
+                yield {}
+    
+    def _handle_batch(self, message):
+        """
+        Handle RECOGNIZE_BATCH request
+        Images come either inline in 'images' or, with 'stream': true, as one
+        frame per image terminated by a zero-length frame. Each result is sent
+        back as its own frame as soon as it is ready, followed by a summary
+        frame with 'batch_complete': true.
+        """
+        if message.get('stream'):
+            items = self._iter_stream_items()
+        else:
+            items = message['images']
+        
+        batch = BatchRecognizer(self.request_handler, self.message_handler)
+        for result in batch.process(items, branch_id=message.get('branch_id', 'UNKNOWN')):
+            if result.get('batch_complete'):
+                if self.stream_interrupted:
+                    # Items received before the break still got their results
+                    self._send_error(
+                        "STREAM_INTERRUPTED",
+                        f"Batch stream ended without its end frame after {result['processed']} images"
+                    )
+                    print(f"✗ Batch stream from {self.client_address} interrupted after {result['processed']} images")
+                    return
+                result['request_id'] = message.get('request_id', 'unknown')
+            self._send_frame(self._encode(result))
+        
+        print(f"✓ Batch results sent to {self.client_address}")
+    
+    def _handle_stream(self, message):
+        """
+        Handle RECOGNIZE_STREAM session
+        After the opening frame, the client sends one frame per video frame
+        ({'image_data': ...}) and receives one result frame for each, holding
+        any recognition events. A zero-length frame ends the session and is
+        answered with a summary frame ('session_complete': true).
+        """
+        session = RecognitionSession(self.request_handler, branch_id=message.get('branch_id', 'UNKNOWN'))
+        self._send_frame(self.message_handler.build_response(
+            status='success',
+            request_id=message.get('request_id', 'unknown'),
+            message=f"Stream session {session.session_id} started",
+            encoding=self._wire_encoding()
+        ))
+        print(f"→ Stream session {session.session_id} started for {self.client_address}")
+        
+        for frame_message in self._iter_stream_items():
+            if 'image_data' not in frame_message:
+                self._send_error("INVALID_REQUEST", "Missing 'image_data' field in stream frame")
+                continue
+            if not self.message_handler.is_valid_deadline(frame_message.get('deadline_ms')):
+                self._send_error("INVALID_REQUEST", "'deadline_ms' must be a non-negative number of milliseconds")
+                continue
+            
+            try:
+                # Every frame runs detection/encoding, so it is admitted like a RECOGNIZE
+                with admission_controller.admit('RECOGNIZE', frame_message.get('deadline_ms')):
+                    result = session.handle_frame_message(frame_message)
+                result['status'] = 'success'
+            except AdmissionRejected as e:
+                result = {
+                    'status': 'error',
+                    'error_code': 'BUSY',
+                    'error_message': f'Server busy ({e.reason}). Please retry.',
+                    'retry_after_ms': e.retry_after_ms
+                }
+                if 'frame_id' in frame_message:
+                    result['frame_id'] = frame_message['frame_id']
+            except Exception as e:
+                result = {
+                    'status': 'error',
+                    'error_code': 'PROCESSING_ERROR',
+                    'error_message': f'Error processing frame: {str(e)}'
+                }
+            self._send_frame(self._encode(result))
+        
+        if self.stream_interrupted:
+            self._send_error("STREAM_INTERRUPTED", f"Stream session {session.session_id} ended without its end frame")
+            print(f"✗ Stream session {session.session_id} interrupted: {session.stats}")
+            return
+        
+        summary = session.summary()
+        summary['status'] = 'success'
+        summary['session_complete'] = True
+        self._send_frame(self._encode(summary))
+        print(f"✓ Stream session {session.session_id} ended: {session.stats}")
+    
     def _send_error(self, error_code: str, error_message: str):
         """Send error response"""
         try:
             response = self.message_handler.build_response(
                 status='error',
                 error_code=error_code,
-                error_message=error_message
+                error_message=error_message,
+                encoding=self._wire_encoding()
             )
             
-            # Send response length first (4 bytes)
-            response_length = len(response)
-            length_bytes = response_length.to_bytes(4, byteorder='big')
-            self.client_socket.sendall(length_bytes)
-            
-            # Send response data
-            self.client_socket.sendall(response)
+            self._send_frame(response)
         except:
             pass
 
@@ -145,9 +341,10 @@ class ClientThread(threading.Thread):
 class SocketServer:
     """Socket server with multi-threading support"""
     
-    def __init__(self):
-        self.host = os.getenv('SERVER_HOST', '0.0.0.0')
-        self.port = int(os.getenv('SERVER_PORT', 8888))
+    def __init__(self, host: Optional[str] = None, port: Optional[int] = None, context: Optional[AppContext] = None):
+        self.host = host or os.getenv('SERVER_HOST', '0.0.0.0')
+        self.port = port if port is not None else int(os.getenv('SERVER_PORT', 8888))
+        self.context = context or get_app_context()
         self.server_socket = None
         self.running = False
     
@@ -178,7 +375,7 @@ class SocketServer:
                     client_socket, client_address = self.server_socket.accept()
                     
                     # Create and start thread for each client
-                    client_thread = ClientThread(client_socket, client_address)
+                    client_thread = ClientThread(client_socket, client_address, self.context)
                     client_thread.daemon = True
                     client_thread.start()
                     
@@ -203,8 +400,13 @@ if __name__ == "__main__":
     # Import database connection to initialize
     from database.connection import db_connection
     
+    context = get_app_context()
+    
+    # Load the face models before accepting connections
+    context.engine.warm_up()
+    
     # Create and start server
-    server = SocketServer()
+    server = SocketServer(context=context)
     
     try:
         server.start()
@@ -0,0 +1,254 @@
+"""
+Gallery Shard Node
+Holds one slice of the customer gallery and answers top-k searches sent by
+a recognition coordinator (see server/coordinator.py)
+"""
+
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, Optional
+import numpy as np
+from dotenv import load_dotenv
+from models.gallery import ENCODING_SIZE, FaceGallery
+from database.models import CustomerModel
+from utils.message_handler import MessageHandler
+
+load_dotenv()
+
+
+def send_frame(sock: socket.socket, payload: bytes):
+    """Send one length-prefixed frame"""
+    sock.sendall(len(payload).to_bytes(4, byteorder='big') + payload)
+
+
+def recv_frame(sock: socket.socket, max_bytes: int) -> Optional[bytearray]:
+    """Receive one length-prefixed frame; None if the peer closed the connection"""
+    header = _recv_exact(sock, 4)
+    if header is None:
+        return None
+    length = int.from_bytes(header, byteorder='big')
+    if length > max_bytes:
+        raise ValueError(f"Frame of {length} bytes exceeds the {max_bytes} byte limit")
+    return _recv_exact(sock, length)
+
+
+def _recv_exact(sock: socket.socket, length: int) -> Optional[bytearray]:
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:], length - received)
+        if count == 0:
+            return None
+        received += count
+    return buffer
+
+
+class ShardNode:
+    """One slice of the gallery: customers with customer_id % shard_count == shard_index"""
+
+    def __init__(self, shard_index: int, shard_count: int):
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Shard index {shard_index} is outside 0..{shard_count - 1}")
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.cache_ttl = float(os.getenv('GALLERY_CACHE_TTL', 60))
+        self._gallery_entry = None  # (gallery, loaded at)
+        self._fresh_read = False
+        self._lock = threading.Lock()
+        self.searches = 0
+
+    def _is_current(self, entry) -> bool:
+        return entry[1] is not None and time.monotonic() - entry[1] < self.cache_ttl
+
+    def get_gallery(self) -> FaceGallery:
+        """
+        Cached gallery slice, reloaded after GALLERY_CACHE_TTL or a SHARD_RELOAD
+        Lock-free for searches: while one thread reloads the slice the others
+        keep searching the previous snapshot, so a slow MongoDB read cannot
+        push searches past the coordinator's timeout.
+        """
+        entry = self._gallery_entry
+        if entry is not None and self._is_current(entry):
+            return entry[0]
+
+        # Only the very first load makes searches wait
+        if not self._lock.acquire(blocking=entry is None):
+            return entry[0]
+        try:
+            entry = self._gallery_entry
+            if entry is not None and self._is_current(entry):
+                return entry[0]
+            fresh, self._fresh_read = self._fresh_read, False
+            customers = CustomerModel.get_customers_for_shard(self.shard_index, self.shard_count, fresh=fresh)
+            gallery = FaceGallery(customers)
+            self._gallery_entry = (gallery, time.monotonic())
+            return gallery
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """Expire the cached slice; it is reloaded from the primary while searches use the old one"""
+        with self._lock:
+            self._fresh_read = True
+            entry = self._gallery_entry
+            if entry is not None:
+                self._gallery_entry = (entry[0], None)
+
+    def owns(self, customer_id: int) -> bool:
+        return customer_id % self.shard_count == self.shard_index
+
+    def add_customer(self, customer: Dict[str, Any]):
+        """
+        Make a just-registered customer searchable without reloading the slice
+        Under the lock, so the row cannot be lost to a reload in progress.
+        """
+        with self._lock:
+            # The next reload reads the primary so a lagging secondary cannot drop the customer
+            self._fresh_read = True
+            entry = self._gallery_entry
+            if entry is not None:
+                self._gallery_entry = (entry[0].with_customer(customer), entry[1])
+
+    def remove_customer(self, customer_id: int):
+        """Tombstone an erased customer; the next reload drops the row"""
+        with self._lock:
+            self._fresh_read = True
+            entry = self._gallery_entry
+            if entry is not None:
+                self._gallery_entry = (entry[0].without_customer(customer_id), entry[1])
+
+    def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Handle one coordinator request
+        SHARD_SEARCH: {'encodings': [[128 floats], ...], 'k': int}
+            -> {'results': [[[customer_id, distance, name], ...], ...]}, nearest first
+        SHARD_INFO: shard index, count and size
+        SHARD_ADD: {'customer': {'customer_id', 'name', 'face_encoding'}} of a new registration
+        SHARD_REMOVE: {'customer_id': int} of an erased customer
+        SHARD_RELOAD: reload the slice from the primary (searches keep the old one meanwhile)
+        """
+        request_type = message.get('request_type')
+
+        if request_type == 'SHARD_SEARCH':
+            gallery = self.get_gallery()
+            probes = np.asarray(message.get('encodings') or [], dtype=np.float64)
+            k = max(1, int(message.get('k', 5)))
+            self.searches += 1
+
+            if len(gallery) == 0 or probes.size == 0:
+                results = [[] for _ in range(len(probes))]
+            else:
+                indices, distances = gallery.top_k(np.atleast_2d(probes), k)
+                results = [
+                    [[gallery.customer_ids[i], round(float(d), 6), gallery.names[i]] for i, d in zip(row_indices, row_distances)]
+                    for row_indices, row_distances in zip(indices, distances)
+                ]
+
+            return {'status': 'success', 'shard_index': self.shard_index, 'shard_size': len(gallery), 'results': results}
+
+        if request_type == 'SHARD_INFO':
+            return {
+                'status': 'success',
+                'shard_index': self.shard_index,
+                'shard_count': self.shard_count,
+                'shard_size': len(self.get_gallery()),
+                'memory': self.get_gallery().memory_usage(),
+                'searches': self.searches
+            }
+
+        if request_type == 'SHARD_ADD':
+            customer = message.get('customer') or {}
+            if not isinstance(customer.get('customer_id'), int) or len(customer.get('face_encoding') or []) != ENCODING_SIZE:
+                return {'status': 'error', 'error_code': 'INVALID_REQUEST', 'error_message': 'SHARD_ADD needs a customer_id and face_encoding'}
+            if not self.owns(customer['customer_id']):
+                return {'status': 'error', 'error_code': 'WRONG_SHARD', 'error_message': f"Customer {customer['customer_id']} is not in shard {self.shard_index}"}
+            self.add_customer(customer)
+            return {'status': 'success', 'shard_index': self.shard_index}
+
+        if request_type == 'SHARD_REMOVE':
+            self.remove_customer(int(message['customer_id']))
+            return {'status': 'success', 'shard_index': self.shard_index}
+
+        if request_type == 'SHARD_RELOAD':
+            self.invalidate()
+            return {'status': 'success', 'shard_index': self.shard_index}
+
+        return {
+            'status': 'error',
+            'error_code': 'UNKNOWN_REQUEST_TYPE',
+            'error_message': f'Unknown request type: {request_type}'
+        }
+
+
+class ShardNodeServer:
+    """TCP server for a shard node; coordinator connections are kept open for many requests"""
+
+    def __init__(self, node: ShardNode, host: Optional[str] = None, port: Optional[int] = None):
+        self.node = node
+        self.host = host or os.getenv('SERVER_HOST', '0.0.0.0')
+        self.port = port if port is not None else int(os.getenv('SERVER_PORT', 8888))
+        self.max_request_bytes = int(os.getenv('MAX_REQUEST_BYTES', 16 * 1024 * 1024))
+        self.message_handler = MessageHandler()
+        self.server_socket = None
+        self.running = False
+
+    def start(self):
+        """Start the shard node server"""
+        try:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(64)
+            self.running = True
+
+            print(f"=" * 60)
+            print(f"🚀 Gallery Shard Node {self.node.shard_index}/{self.node.shard_count} Started")
+            print(f"📍 Listening on {self.host}:{self.port}")
+            print(f"📊 {len(self.node.get_gallery())} customers in this shard")
+            print(f"=" * 60)
+
+            while self.running:
+                try:
+                    client_socket, client_address = self.server_socket.accept()
+                    thread = threading.Thread(target=self._serve, args=(client_socket, client_address), daemon=True)
+                    thread.start()
+                except Exception as e:
+                    if self.running:
+                        print(f"✗ Error accepting connection: {str(e)}")
+
+        except Exception as e:
+            print(f"✗ Shard node error: {str(e)}")
+        finally:
+            self.stop()
+
+    def _serve(self, client_socket: socket.socket, client_address: tuple):
+        """Answer frames on one coordinator connection until it is closed"""
+        print(f"→ Coordinator connected: {client_address}")
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while self.running:
+                data = recv_frame(client_socket, self.max_request_bytes)
+                if data is None:
+                    return
+                try:
+                    response = self.node.handle(self.message_handler.parse_request(data))
+                except Exception as e:
+                    print(f"✗ Shard request error: {str(e)}")
+                    response = {'status': 'error', 'error_code': 'SHARD_ERROR', 'error_message': str(e)}
+                send_frame(client_socket, self.message_handler.encode_message(response))
+        except Exception as e:
+            print(f"✗ Error serving coordinator {client_address}: {str(e)}")
+        finally:
+            client_socket.close()
+            print(f"← Coordinator disconnected: {client_address}")
+
+    def stop(self):
+        """Stop the shard node server"""
+        self.running = False
+        if self.server_socket:
+            self.server_socket.close()
+            self.server_socket = None
+            print("\n✓ Shard node stopped")
@@ -0,0 +1,236 @@
+"""
+Streaming Recognition Session
+Recognizes customers across a sequence of video frames: detect once, track the
+face box cheaply, and re-encode only when a track is new or loses confidence
+"""
+
+import os
+import time
+import uuid
+import cv2
+import numpy as np
+from typing import Dict, Any, List
+from dotenv import load_dotenv
+from models.face_tracker import FaceTracker, box_iou
+
+load_dotenv()
+
+
+class Track:
+    """One tracked face and the identity recognized for it"""
+
+    def __init__(self, track_id: int, tracker: FaceTracker, box):
+        self.track_id = track_id
+        self.tracker = tracker
+        self.box = box  # full-resolution (top, right, bottom, left)
+        self.confidence = 1.0
+        self.needs_encoding = True
+        self.customer_id = None
+        self.customer_name = None
+        self.distance = None
+        self.identified = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'track_id': self.track_id,
+            'face_box': list(self.box),
+            'confidence': round(self.confidence, 3),
+            'customer_id': self.customer_id
+        }
+
+
+class RecognitionSession:
+    """Per-connection state for RECOGNIZE_STREAM"""
+
+    def __init__(self, request_handler, branch_id: str = 'UNKNOWN'):
+        self.session_id = f"stream_{uuid.uuid4().hex[:8]}"
+        self.request_handler = request_handler
+        self.engine = request_handler.engine
+        self.branch_id = branch_id
+
+        # Width frames are downscaled to for tracking
+        self.track_width = int(os.getenv('STREAM_TRACK_WIDTH', 320))
+        # Full detection runs at least every N frames to pick up new arrivals
+        self.redetect_interval = int(os.getenv('STREAM_REDETECT_INTERVAL', 10))
+        # Tracks below this template-match score trigger re-detection and re-encoding
+        self.min_track_confidence = float(os.getenv('STREAM_MIN_TRACK_CONFIDENCE', 0.6))
+        self.match_iou = float(os.getenv('STREAM_MATCH_IOU', 0.3))
+
+        self.tracks: List[Track] = []
+        self._next_track_id = 1
+        self._frames_since_detection = 0
+        self.stats = {'frames': 0, 'detections': 0, 'encodings': 0, 'low_quality': 0, 'events': 0}
+
+    def _to_tracking_frame(self, image_array: np.ndarray):
+        """Grayscale, downscaled copy for template matching; returns (frame, scale)"""
+        height, width = image_array.shape[:2]
+        scale = min(1.0, self.track_width / float(width))
+        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+        if scale < 1.0:
+            gray = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        return gray, scale
+
+    @staticmethod
+    def _scale_box(box, scale: float):
+        return tuple(int(round(value * scale)) for value in box)
+
+    def _detect(self, image_array: np.ndarray, gray: np.ndarray, scale: float) -> List[Dict[str, Any]]:
+        """Full detection: re-anchor matching tracks, start new ones, drop lost ones"""
+        self.stats['detections'] += 1
+        self._frames_since_detection = 0
+        events = []
+
+        detections = self.engine.locate_faces(image_array)
+        unmatched = list(self.tracks)
+
+        for box in detections:
+            best_track, best_iou = None, self.match_iou
+            for track in unmatched:
+                iou = box_iou(track.box, box)
+                if iou >= best_iou:
+                    best_track, best_iou = track, iou
+
+            if best_track is not None:
+                unmatched.remove(best_track)
+                if best_track.confidence < self.min_track_confidence:
+                    # Track was drifting; confirm the identity again
+                    best_track.needs_encoding = True
+            else:
+                best_track = Track(self._next_track_id, None, box)
+                self._next_track_id += 1
+                self.tracks.append(best_track)
+
+            best_track.box = box
+            best_track.confidence = 1.0
+            best_track.tracker = FaceTracker(gray, self._scale_box(box, scale))
+
+        for track in unmatched:
+            if track.confidence >= self.min_track_confidence:
+                # Still tracking well; a single missed detection does not end a track
+                continue
+            self.tracks.remove(track)
+            events.append({'event': 'TRACK_LOST', 'track_id': track.track_id, 'customer_id': track.customer_id})
+
+        return events
+
+    def _encode_pending(self, image_array: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        Encode tracks that need it in one batch and emit identity events
+        A face that fails the RECOGNIZE quality gate in this frame (blurred,
+        badly lit, turned away) stays pending and is tried again on the next.
+        """
+        engine = self.engine
+        pending = [track for track in self.tracks if track.needs_encoding]
+        if engine.quality_gate:
+            passed = [track for track in pending if engine.assess_face_quality(image_array, track.box)[0] == "OK"]
+            self.stats['low_quality'] += len(pending) - len(passed)
+            pending = passed
+        if not pending:
+            return []
+
+        encodings = engine.encode_face_locations(image_array, [track.box for track in pending])
+        self.stats['encodings'] += len(encodings)
+        if len(encodings) != len(pending):
+            return []
+
+        # Current snapshot every frame: new registrations match and erased
+        # customers stop matching mid-session (reading it is lock-free)
+        gallery = self.request_handler.get_gallery_snapshot()
+        if len(gallery) > 0:
+            matches = engine.search_gallery(gallery, np.vstack(encodings), self.branch_id)
+        else:
+            matches = [{'customer_id': None, 'customer_name': None, 'distance': float('inf')}] * len(pending)
+
+        changed = []
+        for track, match in zip(pending, matches):
+            track.needs_encoding = False
+            distance = match['distance']
+            customer_id, customer_name = match['customer_id'], match['customer_name']
+
+            # One event per person: only when identity is first known or changes
+            if not track.identified or customer_id != track.customer_id:
+                track.customer_id, track.customer_name = customer_id, customer_name
+                track.distance = float(distance)
+                track.identified = True
+                changed.append(track)
+
+        recognized_ids = [track.customer_id for track in changed if track.customer_id is not None]
+        # Same lookup as RECOGNIZE: the SQLite replica in edge mode, MongoDB otherwise
+        latest_orders = self.request_handler._get_latest_orders(recognized_ids)
+
+        events = []
+        for track in changed:
+            event = {
+                'event': 'RECOGNIZED' if track.customer_id is not None else 'NOT_RECOGNIZED',
+                'track_id': track.track_id,
+                'face_box': list(track.box),
+                'distance': track.distance
+            }
+            if track.customer_id is not None:
+                event['customer_id'] = track.customer_id
+                event['customer_name'] = track.customer_name
+                event['latest_order'] = self.request_handler.format_order(latest_orders.get(track.customer_id))
+            events.append(event)
+
+        self.stats['events'] += len(events)
+        return events
+
+    def process_frame(self, image_array: np.ndarray) -> Dict[str, Any]:
+        """
+        Process one frame
+        Returns: dict with 'events' (new identities, lost tracks) and current 'tracks'
+        """
+        started = time.perf_counter()
+        self.stats['frames'] += 1
+        self._frames_since_detection += 1
+        gray, scale = self._to_tracking_frame(image_array)
+
+        # Cheap path: template-match every existing track
+        for track in self.tracks:
+            small_box, track.confidence = track.tracker.update(gray)
+            track.box = self._scale_box(small_box, 1.0 / scale)
+
+        events = []
+        needs_detection = (
+            not self.tracks
+            or self._frames_since_detection >= self.redetect_interval
+            or any(track.confidence < self.min_track_confidence for track in self.tracks)
+        )
+        if needs_detection:
+            events.extend(self._detect(image_array, gray, scale))
+
+        identities = self._encode_pending(image_array)
+        events.extend(identities)
+        self._record_visits(identities, (time.perf_counter() - started) * 1000.0)
+
+        return {
+            'frame_index': self.stats['frames'] - 1,
+            'events': events,
+            'tracks': [track.to_dict() for track in self.tracks]
+        }
+
+    def _record_visits(self, identities: List[Dict[str, Any]], frame_ms: float):
+        """One visit event per identity event, like RECOGNIZE records one per request"""
+        for event in identities:
+            distance = event['distance']
+            self.request_handler._record_visit(self.branch_id, {
+                'outcome': event['event'],
+                'customer_id': event.get('customer_id'),
+                'distance': distance if np.isfinite(distance) else None,
+                'latency_ms': {'total_ms': frame_ms}
+            })
+
+    def summary(self) -> Dict[str, Any]:
+        """Session statistics sent when the stream ends"""
+        result = dict(self.stats)
+        result['session_id'] = self.session_id
+        result['active_tracks'] = len(self.tracks)
+        return result
+
+    def handle_frame_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Decode a frame message and process it; returns the frame result"""
+        image_array = self.engine.decode_image_from_base64(message['image_data'])
+        result = self.process_frame(image_array)
+        if 'frame_id' in message:
+            result['frame_id'] = message['frame_id']
+        return result
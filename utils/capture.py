@@ -0,0 +1,242 @@
+"""
+Request Capture
+Sampled recording of raw TCP and HTTP requests into rotating gzip JSONL files,
+reissued against a server by replay_traffic.py
+"""
+
+import atexit
+import base64
+import glob
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CAPTURE_FILE_PATTERN = 'requests-*.jsonl.gz'
+
+# Credentials are never written to a capture file
+REDACTED_HEADERS = {'authorization', 'proxy-authorization', 'cookie', 'x-admin-token'}
+
+
+def outcome_of(response: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fields of a response that are compared between builds
+    Customer names and orders are left out, so captures hold no more
+    personal data than the request itself.
+    """
+    outcome = {'status': response.get('status')}
+    if response.get('error_code'):
+        outcome['error_code'] = response['error_code']
+    if 'recognized' in response:
+        outcome['recognized'] = response['recognized']
+    if response.get('customer_id') is not None:
+        outcome['customer_id'] = response['customer_id']
+    if response.get('faces') is not None:
+        outcome['face_customer_ids'] = sorted(
+            (face.get('customer_id') for face in response['faces']),
+            key=lambda customer_id: (customer_id is None, customer_id or 0)
+        )
+    return outcome
+
+
+class RequestCapture:
+    """
+    Records a random CAPTURE_SAMPLE_RATE fraction of single-frame requests
+    Request threads only sample and enqueue; a background writer appends
+    records to CAPTURE_DIR/requests-<start time>-<pid>-<n>.jsonl.gz, starts a new
+    file once one reaches CAPTURE_MAX_FILE_BYTES and keeps the newest
+    CAPTURE_MAX_FILES. When the rate is 0 (default) sample() is a single comparison.
+    """
+
+    def __init__(self):
+        self.sample_rate = float(os.getenv('CAPTURE_SAMPLE_RATE', 0))
+        self.directory = os.getenv('CAPTURE_DIR', 'captures')
+        self.request_types = {
+            request_type.strip()
+            for request_type in os.getenv('CAPTURE_REQUEST_TYPES', 'RECOGNIZE,RECOGNIZE_MULTI').split(',')
+            if request_type.strip()
+        }
+        self.max_file_bytes = int(os.getenv('CAPTURE_MAX_FILE_BYTES', 64 * 1024 * 1024))
+        self.max_files = int(os.getenv('CAPTURE_MAX_FILES', 10))
+        self._queue = queue.Queue(maxsize=int(os.getenv('CAPTURE_QUEUE_SIZE', 256)))
+        self._lock = threading.Lock()
+        self._thread = None
+        self._raw = None
+        self._file = None
+        self.path = None
+        self.stats = {'captured': 0, 'dropped': 0, 'written': 0, 'files': 0, 'errors': 0}
+
+    def sample(self, request_type: str) -> bool:
+        """True if this request should be captured"""
+        if self.sample_rate <= 0 or request_type not in self.request_types:
+            return False
+        return random.random() < self.sample_rate
+
+    def record(
+        self,
+        transport: str,
+        request_type: str,
+        body: bytes,
+        received_at: float,
+        latency_ms: float,
+        outcome: Dict[str, Any],
+        encoding: Optional[str] = None,
+        endpoint: Optional[str] = None,
+        method: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None
+    ):
+        """
+        Queue one captured request
+        Args:
+            transport: 'tcp' or 'http'
+            body: Raw request body (TCP frame payload or HTTP body)
+            received_at: Wall-clock time the request arrived (replay pacing)
+            latency_ms: Server time from arrival to response
+            outcome: outcome_of() the response
+            encoding: TCP frame encoding ('json' or 'msgpack')
+            endpoint, method, headers: HTTP request line and headers
+        """
+        record = {
+            'ts': round(received_at, 6),
+            'transport': transport,
+            'request_type': request_type,
+            'latency_ms': round(latency_ms, 3),
+            'outcome': outcome,
+            'body': bytes(body),
+        }
+        if encoding is not None:
+            record['encoding'] = encoding
+        if endpoint is not None:
+            record['endpoint'] = endpoint
+            record['method'] = method
+            record['headers'] = {
+                name: value for name, value in (headers or {}).items()
+                if name.lower() not in REDACTED_HEADERS
+            }
+
+        try:
+            self._queue.put_nowait(record)
+            self.stats['captured'] += 1
+        except queue.Full:
+            # The writer is behind; capture must never slow requests down
+            self.stats['dropped'] += 1
+            return
+        self._ensure_writer()
+
+    def _ensure_writer(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='request-capture', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            batch = [record]
+            while True:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self._write(batch)
+                    return
+                batch.append(record)
+            self._write(batch)
+
+    def _write(self, records: List[Dict[str, Any]]):
+        try:
+            if self._file is None:
+                self._open()
+            for record in records:
+                record['body'] = base64.b64encode(record['body']).decode('ascii')
+                self._file.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+            # Sync flush: everything written so far can be read while the file is open
+            self._file.flush()
+            self.stats['written'] += len(records)
+            if self._raw.tell() >= self.max_file_bytes:
+                self._close_file()
+        except (OSError, TypeError, ValueError) as e:
+            self.stats['errors'] += 1
+            print(f"⚠ Could not write request capture {self.path}: {e}")
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(self.directory, f"requests-{started}-{os.getpid()}-{self.stats['files']}.jsonl.gz")
+        self._raw = open(self.path, 'ab')
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=5)
+        self.stats['files'] += 1
+        self._prune()
+        print(f"✓ Capturing {self.sample_rate:.1%} of {sorted(self.request_types)} requests to {self.path}")
+
+    def _prune(self):
+        """Delete the oldest capture files beyond max_files"""
+        paths = sorted(glob.glob(os.path.join(self.directory, CAPTURE_FILE_PATTERN)), key=os.path.getmtime)
+        for path in paths[:max(0, len(paths) - self.max_files)]:
+            if path != self.path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._raw.close()
+            self._file = self._raw = None
+
+    def close(self):
+        """Flush queued records and close the current file"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout=10.0)
+        self._close_file()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(
+            self.stats,
+            sample_rate=self.sample_rate,
+            request_types=sorted(self.request_types),
+            path=self.path,
+            queued=self._queue.qsize()
+        )
+
+
+def iter_capture_records(paths: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """
+    Records of capture files with 'body' decoded back to bytes
+    A file whose writer did not shut down cleanly ends in a truncated gzip
+    stream; everything before the truncation is still returned.
+    """
+    for path in paths:
+        try:
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    record['body'] = base64.b64decode(record['body'])
+                    yield record
+        except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+            print(f"⚠ {path} is truncated, using the records before the damage: {e}")
+
+
+# Global instance shared by both transports
+request_capture = RequestCapture()
@@ -0,0 +1,69 @@
+"""
+Response Compression Utilities
+Content-Encoding negotiation and gzip/zstd compressors for HTTP responses
+"""
+
+import zlib
+from typing import Iterable, Iterator, Optional
+
+# Optional: zstd is preferred over gzip when the client accepts it
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+
+def available_encodings():
+    """Content encodings this process can produce, most preferred first"""
+    return (['zstd'] if zstandard is not None else []) + ['gzip']
+
+
+def negotiate_encoding(accept_encodings) -> Optional[str]:
+    """
+    Pick the response encoding from a parsed Accept-Encoding header
+    Args:
+        accept_encodings: Werkzeug Accept object (request.accept_encodings)
+    Returns: 'zstd', 'gzip' or None for identity
+    """
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress a whole response body"""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """
+    Compress a streamed body chunk by chunk
+    Each chunk is flushed as soon as it is compressed, so a client reading
+    NDJSON results still receives every line when it is produced.
+    """
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        flush_block, finish = zstandard.COMPRESSOBJ_FLUSH_BLOCK, zstandard.COMPRESSOBJ_FLUSH_FINISH
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        flush_block, finish = zlib.Z_SYNC_FLUSH, zlib.Z_FINISH
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush(flush_block)
+        yield compressor.flush(finish)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
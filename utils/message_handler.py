@@ -4,17 +4,48 @@ Handles request/response message parsing and building
 """
 
 import json
-from typing import Dict, Any, Optional, Tuple
+import math
+from typing import Dict, Any, Optional, Tuple, List
 from datetime import datetime
 
+# Optional fast JSON serializer; the standard library is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional compact binary encoding for the TCP protocol
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+
+# TCP frame header: 4-byte big-endian length whose high bit marks a MessagePack payload
+FRAME_MSGPACK_FLAG = 0x80000000
+FRAME_LENGTH_MASK = 0x7FFFFFFF
+
 
 class MessageHandler:
     """Handle message parsing and building"""
     
     @staticmethod
-    def parse_request(data: bytes) -> Dict[str, Any]:
-        """Parse incoming request message"""
+    def parse_request(data, encoding: str = ENCODING_JSON) -> Dict[str, Any]:
+        """Parse incoming request message (bytes or bytearray)"""
+        if encoding == ENCODING_MSGPACK:
+            try:
+                message = msgpack.unpackb(data, raw=False, strict_map_key=False)
+            except ValueError as e:
+                raise ValueError(f"Invalid MessagePack format: {str(e)}")
+            if not isinstance(message, dict):
+                raise ValueError("MessagePack request must be a map")
+            return message
+        
         try:
+            if orjson is not None:
+                return orjson.loads(data)
             message_str = data.decode('utf-8')
             message = json.loads(message_str)
             return message
@@ -31,19 +62,29 @@ class MessageHandler:
         customer_id: Optional[int] = None,
         customer_name: Optional[str] = None,
         latest_order: Optional[Dict[str, Any]] = None,
+        faces: Optional[List[Dict[str, Any]]] = None,
         message: Optional[str] = None,
         error_code: Optional[str] = None,
         error_message: Optional[str] = None,
-        return_dict: bool = False
+        retry_after_ms: Optional[int] = None,
+        stats: Optional[Dict[str, Any]] = None,
+        rollups: Optional[List[Dict[str, Any]]] = None,
+        orders: Optional[List[Dict[str, Any]]] = None,
+        next_cursor: Optional[str] = None,
+        profile: Optional[Dict[str, Any]] = None,
+        erased: Optional[Dict[str, int]] = None,
+        return_dict: bool = False,
+        encoding: str = ENCODING_JSON
     ):
         """Build response message
         
         Args:
             return_dict: If True, return dict instead of bytes (for HTTP API)
+            encoding: Wire encoding of the returned bytes (json or msgpack)
         """
         response = {
             'status': status,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': datetime.now().isoformat(timespec='milliseconds')
         }
         
         if request_id:
@@ -63,21 +104,74 @@ class MessageHandler:
                 if latest_order:
                     response['latest_order'] = latest_order
             
+            # Per-face results for RECOGNIZE_MULTI
+            if faces is not None:
+                response['faces'] = faces
+                response['face_count'] = len(faces)
+            
             if message:
                 response['message'] = message
+            
+            if stats is not None:
+                response['stats'] = stats
+            
+            if rollups is not None:
+                response['rollups'] = rollups
+            
+            # Order history page; next_cursor is null on the last page
+            if orders is not None:
+                response['orders'] = orders
+                response['next_cursor'] = next_cursor
+            
+            if profile is not None:
+                response['profile'] = profile
+            
+            # What DELETE_CUSTOMER removed
+            if erased is not None:
+                response['erased'] = erased
         
         elif status == 'error':
             if error_code:
                 response['error_code'] = error_code
             if error_message:
                 response['error_message'] = error_message
+            if retry_after_ms is not None:
+                response['retry_after_ms'] = retry_after_ms
         
         if return_dict:
             return response
         
-        response_json = json.dumps(response, default=str)
+        return MessageHandler.encode_message(response, encoding)
+    
+    @staticmethod
+    def encode_message(message: Dict[str, Any], encoding: str = ENCODING_JSON) -> bytes:
+        """Serialize a message dict for the wire (compact JSON or MessagePack)"""
+        if encoding == ENCODING_MSGPACK:
+            return msgpack.packb(message, default=str, use_bin_type=True)
+        if orjson is not None:
+            # Datetimes are passed to default=str like the standard library path
+            return orjson.dumps(message, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        response_json = json.dumps(message, default=str, separators=(',', ':'))
         return response_json.encode('utf-8')
     
+    @staticmethod
+    def supports_encoding(encoding: str) -> bool:
+        """Whether this process can read and write the given wire encoding"""
+        return encoding == ENCODING_JSON or (encoding == ENCODING_MSGPACK and msgpack is not None)
+    
+    @staticmethod
+    def frame_header(length: int, encoding: str = ENCODING_JSON) -> bytes:
+        """4-byte TCP frame header for a payload of the given length and encoding"""
+        flags = FRAME_MSGPACK_FLAG if encoding == ENCODING_MSGPACK and length > 0 else 0
+        return (length | flags).to_bytes(4, byteorder='big')
+    
+    @staticmethod
+    def parse_frame_header(header: bytes) -> Tuple[int, str]:
+        """Split a TCP frame header into (payload length, encoding)"""
+        value = int.from_bytes(header, byteorder='big')
+        encoding = ENCODING_MSGPACK if value & FRAME_MSGPACK_FLAG else ENCODING_JSON
+        return value & FRAME_LENGTH_MASK, encoding
+    
     @staticmethod
     def validate_request(message: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
         """Validate request message structure"""
@@ -86,9 +180,30 @@ class MessageHandler:
         
         request_type = message['request_type']
         
-        if request_type == 'RECOGNIZE':
+        if 'face_box' in message and not MessageHandler._is_valid_face_box(message['face_box']):
+            return False, "'face_box' must be [top, right, bottom, left] or an object with those keys"
+        
+        if not MessageHandler.is_valid_deadline(message.get('deadline_ms')):
+            return False, "'deadline_ms' must be a non-negative number of milliseconds"
+        
+        if request_type in ('RECOGNIZE', 'RECOGNIZE_MULTI'):
             if 'image_data' not in message:
-                return False, "Missing 'image_data' field for RECOGNIZE request"
+                return False, f"Missing 'image_data' field for {request_type} request"
+        
+        elif request_type == 'RECOGNIZE_BATCH':
+            if not message.get('stream') and not isinstance(message.get('images'), list):
+                return False, "RECOGNIZE_BATCH needs an 'images' list or 'stream': true"
+        
+        elif request_type == 'RECOGNIZE_STREAM':
+            # Frames follow the opening message; nothing else is required
+            pass
+        
+        elif request_type in ('STATS', 'VISIT_ROLLUPS', 'PROFILE'):
+            pass
+        
+        elif request_type in ('ORDER_HISTORY', 'DELETE_CUSTOMER'):
+            if 'customer_id' not in message:
+                return False, f"Missing 'customer_id' field for {request_type} request"
         
         elif request_type == 'REGISTER':
             required_fields = ['image_data', 'customer_name', 'order_details']
@@ -100,4 +215,27 @@ class MessageHandler:
             return False, f"Unknown request_type: {request_type}"
         
         return True, None
-
+    
+    @staticmethod
+    def is_valid_deadline(deadline_ms: Any) -> bool:
+        """Check an optional client deadline: absent, or a finite non-negative number"""
+        if deadline_ms is None:
+            return True
+        if not isinstance(deadline_ms, (int, float)) or isinstance(deadline_ms, bool):
+            return False
+        return math.isfinite(deadline_ms) and deadline_ms >= 0
+    
+    @staticmethod
+    def _is_valid_face_box(face_box: Any) -> bool:
+        """Check that a face box hint has four non-negative numeric coordinates"""
+        if isinstance(face_box, dict):
+            values = [face_box.get(key) for key in ('top', 'right', 'bottom', 'left')]
+        elif isinstance(face_box, (list, tuple)) and len(face_box) == 4:
+            values = list(face_box)
+        else:
+            return False
+        
+        return all(
+            isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+            for value in values
+        )